@@ -0,0 +1,237 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+sys.path.append(str(project_root / "src" / "processing"))
+from benchmarks.syntheticData import parseGrid, writeSyntheticFiles
+
+# Peak resident set size of the current process in MB (ru_maxrss is in kB on Linux and in bytes on macOS)
+def peakRssMB():
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss / 1024**2 if sys.platform == "darwin" else maxRss / 1024
+
+
+def benchUpdateTopN(paths, config):
+    import xarray as xr
+    from processing_functions import update_top_n
+    dataset = xr.open_dataset(paths["windgust"]).load()
+    return (lambda: update_top_n(dataset, "i10fg", memoryBudget=config.TOP_N_MEMORY_BUDGET),
+            dataset.i10fg.size, "cells")
+
+
+def benchGetConnectedEvents(paths, config):
+    import xarray as xr
+    from processing_functions import getConnectedEvents
+    dataset = xr.open_dataset(paths["windgust"]).load()
+    return (lambda: getConnectedEvents(dataset, "i10fg", config.EVENT_THRESHOLDS["windgustHourly"], columnar=True,
+                                       footprints=config.STORE_EVENT_FOOTPRINTS),
+            dataset.i10fg.size, "cells")
+
+
+def benchInsertEvents(paths, config):
+    import xarray as xr
+    from processing_functions import getConnectedEvents
+    from databaseFunctions import insertEventsIntoDatabase
+    dataset = xr.open_dataset(paths["windgust"]).load()
+    events = getConnectedEvents(dataset, "i10fg", config.EVENT_THRESHOLDS["windgustHourly"], columnar=True,
+                                footprints=config.STORE_EVENT_FOOTPRINTS)
+    dataset.close()
+    return (lambda: insertEventsIntoDatabase(config.RESULT_DATABASE, "windgustHourly", events),
+            len(events["eventTime"]), "events")
+
+
+def processorBenchmark(variable, mainVariable):
+    def bench(paths, config):
+        import xarray as xr
+        from processingFactory import ProcessingFactory
+        with xr.open_dataset(paths[variable]) as dataset:
+            cells = dataset[mainVariable].size
+        processor = ProcessingFactory.getProcessor(variable)
+        return lambda: processor(paths[variable]), cells, "cells"
+    return bench
+
+
+# Benchmark cases: name -> (synthetic variables needed, setup function returning the timed call,
+# the amount of work and its unit)
+CASES = {
+    "update_top_n": (["windgust"], benchUpdateTopN),
+    "getConnectedEvents": (["windgust"], benchGetConnectedEvents),
+    "insertEventsIntoDatabase": (["windgust"], benchInsertEvents),
+    "processPrecipitation": (["precipitation"], processorBenchmark("precipitation", "tp")),
+    "processTemperature": (["temperature"], processorBenchmark("temperature", "t")),
+    "processWind": (["wind"], processorBenchmark("wind", "u10")),
+    "processWindgust": (["windgust"], processorBenchmark("windgust", "i10fg")),
+}
+
+
+def caseWorker(case, paths, workFolder, processingMode, queue):
+    """
+    Runs one benchmark case in a fresh process, so the peak RSS belongs to this case only.
+    The result paths are pointed to workFolder before any processing module reads the config.
+    """
+    try:
+        import src.config as config
+        config.PROCESSING_FOLDER = workFolder
+        config.PROCESSING_DATABASE = os.path.join(workFolder, "processing.db")
+        config.RESULT_FOLDER = os.path.join(workFolder, "results/")
+        config.RESULT_DATABASE = os.path.join(config.RESULT_FOLDER, "results.db")
+        config.PROCESSING_MODE = processingMode
+        os.makedirs(config.RESULT_FOLDER, exist_ok=True)
+
+        import dask
+        from databaseFunctions import createResultDatabase, createSpatioTemporalTable
+        createResultDatabase(config.RESULT_DATABASE)
+        createSpatioTemporalTable(config.RESULT_DATABASE)
+
+        run, amount, unit = CASES[case][1](paths, config)
+        setupRss = peakRssMB()
+
+        with dask.config.set(scheduler="threads", num_workers=config.DASK_NUM_WORKERS):
+            start = time.perf_counter()
+            run()
+            wallSeconds = time.perf_counter() - start
+
+        queue.put({"wallSeconds": wallSeconds, "amount": amount, "unit": unit,
+                   "setupRssMB": setupRss, "peakRssMB": peakRssMB()})
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def runCase(case, paths, repeat, processingMode):
+    """
+    Runs a benchmark case repeat times, each in its own process and work folder.
+    :return: The fastest wall time, throughput and the highest peak RSS of all runs
+    """
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        workFolder = tempfile.mkdtemp(prefix=f"benchmark-{case}-") + "/"
+        queue = context.Queue()
+        process = context.Process(target=caseWorker, args=(case, paths, workFolder, processingMode, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        shutil.rmtree(workFolder, ignore_errors=True)
+        if "error" in result:
+            raise RuntimeError(f"Benchmark {case} failed: {result['error']}")
+        runs.append(result)
+
+    fastest = min(runs, key=lambda run: run["wallSeconds"])
+    return {
+        "wallSeconds": fastest["wallSeconds"],
+        "throughput": fastest["amount"] / fastest["wallSeconds"],
+        "throughputUnit": f"{fastest['unit']}/s",
+        "amount": fastest["amount"],
+        "setupRssMB": max(run["setupRssMB"] for run in runs),
+        "peakRssMB": max(run["peakRssMB"] for run in runs),
+        "repeat": repeat,
+    }
+
+
+def compareResults(results, baseline, timeTolerance = 0.2, memoryTolerance = 0.1):
+    """
+    Compares benchmark results against a baseline run.
+    :param results: Results of this run, as stored in the "results" entry of the JSON output
+    :param baseline: Results of the baseline run
+    :param timeTolerance: Allowed relative increase of the wall time
+    :param memoryTolerance: Allowed relative increase of the peak RSS
+    :return: A list of regression messages, empty if there is none
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        for metric, tolerance in (("wallSeconds", timeTolerance), ("peakRssMB", memoryTolerance)):
+            ratio = result[metric] / baseline[case][metric]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{case}: {metric} {baseline[case][metric]:.2f} -> {result[metric]:.2f} "
+                                   f"({ratio - 1:+.0%}, tolerance {tolerance:.0%})")
+    return regressions
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the processing hot paths on synthetic ERA5 shaped data.")
+    parser.add_argument("--grid", default="181x360", help="Grid size as latitudes x longitudes, ERA5 is 721x1440")
+    parser.add_argument("--days", type=int, default=7, help="Length of the time axis in days")
+    parser.add_argument("--exceedance", type=float, default=0.001, help="Fraction of cells above the thresholds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case, the fastest one is reported")
+    parser.add_argument("--processing-mode", choices=["eager", "dask"], default="eager")
+    parser.add_argument("--data-folder", default=os.path.join(tempfile.gettempdir(), "extreme-weather-db-benchmarks"),
+                        help="Folder for the synthetic datasets, which are reused between runs")
+    parser.add_argument("--output", default=f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare against")
+    parser.add_argument("--time-tolerance", type=float, default=0.2)
+    parser.add_argument("--memory-tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    nLat, nLon = parseGrid(args.grid)
+    dataFolder = os.path.join(args.data_folder, f"{nLat}x{nLon}_{args.days}d_{args.exceedance}_{args.seed}")
+    variables = sorted(set(variable for case in args.cases for variable in CASES[case][0]))
+    print(f"Generating synthetic data in {dataFolder}")
+    paths = writeSyntheticFiles(dataFolder, nLat, nLon, args.days, exceedance=args.exceedance, seed=args.seed,
+                                variables=variables)
+
+    results = {}
+    for case in args.cases:
+        results[case] = runCase(case, paths, args.repeat, args.processing_mode)
+        result = results[case]
+        print(f"{case:<26} {result['wallSeconds']:9.3f} s  {result['throughput']:14.0f} {result['throughputUnit']:<9}"
+              f"  peak RSS {result['peakRssMB']:8.1f} MB")
+
+    output = {
+        "metadata": {
+            "grid": [nLat, nLon],
+            "days": args.days,
+            "exceedance": args.exceedance,
+            "seed": args.seed,
+            "processingMode": args.processing_mode,
+            "commit": gitCommit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpuCount": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        for key in ["grid", "days", "exceedance", "processingMode"]:
+            if baseline["metadata"].get(key) != output["metadata"][key]:
+                print(f"Warning: baseline was run with {key} = {baseline['metadata'].get(key)}")
+
+        regressions = compareResults(results, baseline["results"], args.time_tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import xarray as xr
+from scipy.ndimage import zoom
+
+# Time axis of the processor inputs: hourly files are processed per hour (or coarsened to days by the processor),
+# daily files are processed per day
+TIME_STEPS = {
+    "precipitation": "h",
+    "windgust": "h",
+    "wind": "D",
+    "temperature": "D",
+}
+
+
+def parseGrid(grid):
+    """
+    Parses a grid size like "721x1440" into the number of latitudes and longitudes.
+    """
+    nLat, nLon = (int(x) for x in grid.lower().split("x"))
+    return nLat, nLon
+
+
+def gridCoordinates(nLat, nLon):
+    """
+    Returns ERA5 like coordinates: latitudes from 90 to -90 and longitudes from 0 to 360 east.
+    """
+    return np.linspace(90, -90, nLat), np.arange(nLon) * (360 / nLon)
+
+
+def timeCoordinate(year, nTimes, step):
+    return (np.datetime64(f"{year}-01-01T00", "h") + np.arange(nTimes) * np.timedelta64(1, step)).astype("datetime64[ns]")
+
+
+def smoothField(rng, nTimes, nLat, nLon, coarsening = 8, persistence = 0.8):
+    """
+    Generates a standardized random field that is smooth in space and persistent in time, so exceedances form
+    connected regions that live for several timesteps like weather systems.
+    :param rng: A numpy random generator
+    :param nTimes: Number of timesteps
+    :param nLat: Number of latitudes
+    :param nLon: Number of longitudes
+    :param coarsening: Size of the structures in grid cells
+    :param persistence: Lag one autocorrelation of the field in time
+    :return: Array of float32 with dims (time, latitude, longitude)
+    """
+    coarseShape = (max(2, -(-nLat // coarsening)), max(2, -(-nLon // coarsening)))
+    noise = rng.standard_normal((nTimes,) + coarseShape).astype(np.float32)
+
+    # AR(1) in time, scaled to unit variance
+    for t in range(1, nTimes):
+        noise[t] = persistence * noise[t - 1] + np.sqrt(1 - persistence**2) * noise[t]
+
+    field = zoom(noise, (1, nLat / coarseShape[0], nLon / coarseShape[1]), order=1)[:, :nLat, :nLon]
+    return (field - field.mean()) / field.std()
+
+
+def exceedanceField(rng, shape, threshold, exceedance, scale):
+    """
+    Generates a smooth field where about the fraction exceedance of all cells lies above the threshold.
+    :param rng: A numpy random generator
+    :param shape: Tuple of the number of timesteps, latitudes and longitudes
+    :param threshold: The threshold
+    :param exceedance: Fraction of cells above the threshold
+    :param scale: Spread of the values around the threshold
+    :return: Array of float32 with the given shape
+    """
+    field = smoothField(rng, *shape)
+    quantile = np.quantile(field, 1 - exceedance)
+    return (threshold + scale * (field - quantile)).astype(np.float32)
+
+
+def makeSyntheticDataset(variable, nLat, nLon, days, year = 2000, exceedance = 0.001, seed = 0):
+    """
+    Creates a synthetic dataset shaped like the downloaded ERA5 file of a processor variable, with the variables,
+    coordinates and time axis the processor expects. Threshold variables exceed their first configured threshold
+    in about the fraction exceedance of all cells.
+    :param variable: One of "precipitation", "windgust", "wind" and "temperature"
+    :param nLat: Number of latitudes
+    :param nLon: Number of longitudes
+    :param days: Length of the time axis in days
+    :param year: Year of the time axis
+    :param exceedance: Fraction of cells above the threshold
+    :param seed: Seed of the random generator
+    :return: The dataset
+    """
+    from src.config import EVENT_THRESHOLDS
+
+    if variable not in TIME_STEPS:
+        raise ValueError(f"No synthetic data for {variable}")
+
+    rng = np.random.default_rng(seed)
+    step = TIME_STEPS[variable]
+    nTimes = days * 24 if step == "h" else days
+    shape = (nTimes, nLat, nLon)
+    dims = ["valid_time", "latitude", "longitude"]
+    latitudes, longitudes = gridCoordinates(nLat, nLon)
+    coords = {"valid_time": timeCoordinate(year, nTimes, step), "latitude": latitudes, "longitude": longitudes}
+    expver = ("valid_time", np.array(["0001"] * nTimes))
+
+    if variable == "precipitation":
+        tp = np.maximum(exceedanceField(rng, shape, EVENT_THRESHOLDS["rainHourly"][0], exceedance, 0.02), 0)
+        # Mostly rain, some snow and a few cells without a precipitation type
+        ptype = rng.choice(np.array([0, 1, 3, 5, 6, 7, 8, 12], dtype=np.float32), shape,
+                           p=[0.1, 0.5, 0.05, 0.2, 0.05, 0.03, 0.02, 0.05])
+        return xr.Dataset({"tp": (dims, tp), "ptype": (dims, ptype), "number": 0, "expver": expver}, coords=coords)
+
+    if variable == "windgust":
+        i10fg = np.maximum(exceedanceField(rng, shape, EVENT_THRESHOLDS["windgustHourly"][0], exceedance, 5.0), 0)
+        return xr.Dataset({"i10fg": (dims, i10fg), "number": 0, "expver": expver}, coords=coords)
+
+    if variable == "wind":
+        speed = np.maximum(exceedanceField(rng, shape, EVENT_THRESHOLDS["windspeedDaily"][0], exceedance, 4.0), 0)
+        direction = np.pi * smoothField(rng, *shape)
+        gust = (speed * 1.4).astype(np.float32)
+        return xr.Dataset({"u10": (dims, (speed * np.cos(direction)).astype(np.float32)),
+                           "v10": (dims, (speed * np.sin(direction)).astype(np.float32)),
+                           "i10fg": (dims, gust), "number": 0}, coords=coords)
+
+    temperature = (285 + 15 * smoothField(rng, *shape)).astype(np.float32)
+    return xr.Dataset({"t": (["valid_time", "pressure_level", "latitude", "longitude"], temperature[:, None]),
+                       "number": 0}, coords={**coords, "pressure_level": [1000.0]})
+
+
+def writeSyntheticFiles(folder, nLat, nLon, days, year = 2000, exceedance = 0.001, seed = 0, variables = None):
+    """
+    Writes synthetic datasets for the processors to folder, named like the downloaded files (variable_year.nc).
+    Existing files are kept, so the datasets of a grid are generated once.
+    :return: A dict of variable to file path
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = {}
+    for variable in variables or TIME_STEPS:
+        path = os.path.join(folder, f"{variable}_{year}.nc")
+        if not os.path.exists(path):
+            makeSyntheticDataset(variable, nLat, nLon, days, year, exceedance, seed).to_netcdf(path)
+        paths[variable] = path
+    return paths
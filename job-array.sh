@@ -0,0 +1,12 @@
+#!/bin/bash -l
+#SBATCH --job-name=process-extreme-events  # Job name
+#SBATCH --output=output_%a.log    # Standard output file per array task
+#SBATCH --error=error_%a.log      # Standard error file per array task
+#SBATCH --array=0-7                # Array tasks, each claims files from the processing database
+#SBATCH --mem=64GB                  # Memory per array task
+#SBATCH --time=48:00:00            # Maximum runtime (hh:mm:ss)
+#SBATCH --account=ag-schultz
+
+module load tools/poetry
+poetry install
+poetry run python src/processing/processor.py
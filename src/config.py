@@ -12,11 +12,115 @@ PROCESSING_DATABASE = f"{PROCESSING_FOLDER}processing.db"
 RESULT_FOLDER = os.path.abspath(PROJECT_ROOT) + "/results/"
 RESULT_DATABASE = RESULT_FOLDER + "results.db"
 RESULT_TABLENAME = "thresholdResults"
+SPATIOTEMPORAL_TABLENAME = "spatioTemporalResults"
+FOOTPRINT_TABLENAME = "eventFootprints"
 
 DOWNLOAD_FOLDER = "/scratch/ag-schultz/"
 DOWNLOAD_DATABASE = f"{DOWNLOAD_FOLDER}download_database.db"
 
 MAX_WORKERS_DOWNLOAD = 4
 MAX_WORKERS_PROCESSING = 1
+# Memory in bytes for all processing jobs of a node. Jobs are started while their estimated memory fits into the
+# budget, with shorter time chunks if needed, so MAX_WORKERS_PROCESSING can be the number of cores.
+# None: 80% of the memory of the SLURM allocation, the cgroup or the machine
+PROCESSING_MEMORY_BUDGET = None
+# "thread" runs the processors in a thread pool, "process" in a pool of MAX_WORKERS_PROCESSING worker processes,
+# which send all database writes to the main process
+PROCESSING_EXECUTOR = "thread"
+# Read-ahead of the input of the next claimed file while the current files are processed. "cache" reads the first
+# PREFETCH_MEMORY_BYTES of it into the page cache, "scratch" copies it to PREFETCH_SCRATCH_FOLDER (a node-local disk)
+# if all copies fit into PREFETCH_DISK_BYTES and the processor reads the copy, "off" disables read-ahead.
+PREFETCH_MODE = "cache"
+PREFETCH_MEMORY_BYTES = 4 * 1024**3
+PREFETCH_DISK_BYTES = 200 * 1024**3
+PREFETCH_SCRATCH_FOLDER = os.environ.get("TMPDIR", "/tmp/")
+# Files are fingerprinted by size and modification time, a changed file (e.g. a re-merged year) is processed again.
+# With PROCESSING_FINGERPRINT_HASH, a hash of the contents is compared as well, so touched or copied files with
+# unchanged contents are not processed again. Hashing reads every new or changed file once.
+PROCESSING_FINGERPRINT_HASH = False
+# Files are claimed from the processing database with a lease, which the claiming node renews while it processes
+# the file. Several nodes (e.g. the tasks of a SLURM array job) can share the processing database this way, and
+# files of a crashed node are claimed again once their lease expired.
+PROCESSING_LEASE_SECONDS = 15 * 60
+
+# Processing mode: "eager" opens the inputs without chunks and computes everything on one core,
+# "dask" opens them with DASK_TIME_CHUNK timesteps per chunk and runs reading, derived fields, labeling and top N
+# of every dask chunk on a local multi-threaded dask scheduler with DASK_NUM_WORKERS threads. The files processed
+# concurrently on a node share these threads. Events across time and space are labeled on the whole year at once in
+# both modes.
+# DASK_TIME_CHUNK should be a multiple of 24, so daily coarsening doesn't cross chunks.
+PROCESSING_MODE = "eager"
+DASK_TIME_CHUNK = 24 * 7
+DASK_NUM_WORKERS = os.cpu_count()
+
+# Chunks of the Zarr stores the merged years can be converted to (convertToZarr.py, or merge_script.py with
+# CONVERT_INPUTS_TO_ZARR). The processors read <variable>_<year>.zarr instead of <variable>_<year>.nc if it exists,
+# so parallel workers and dask threads read separate chunk objects instead of one HDF5 file. Requires zarr.
+CONVERT_INPUTS_TO_ZARR = False
+ZARR_TIME_CHUNK = 24 * 7
+ZARR_SPACE_CHUNK = 256
+
+# Number of days of a year file read and processed at once. Progress is checkpointed after every chunk, so an
+# interrupted file resumes at its first unfinished chunk. Precipitation is split into rain and snow and summed up
+# to days chunk by chunk. In dask mode a chunk should span several DASK_TIME_CHUNKs to keep all dask workers busy.
+PROCESSING_CHUNK_DAYS = 7
+
+# Threshold event labeling: "slice" labels every timestep on its own (one row per event and timestep in
+# RESULT_TABLENAME), "spatiotemporal" labels across time and space (one row per event in SPATIOTEMPORAL_TABLENAME),
+# "both" does both
+EVENT_LABELING_MODE = "slice"
+
+# Threshold levels per event type. Events of all levels of an event type are extracted in one labeling pass
+# and stored with their threshold, e.g. a Beaufort ladder for windspeedDaily: [20.8, 24.5, 28.5, 32.7]
+EVENT_THRESHOLDS = {
+    "rainHourly": [0.1],
+    "rainDaily": [0.2],
+    "snowDaily": [0.1],
+    "windspeedDaily": [20.8],
+    "windgustHourly": [24.5],
+}
+
+# Writes of the processors go through one writer thread per node (resultSink.ResultWriter), which owns the connection
+# to the result database. Up to RESULT_WRITER_QUEUE_SIZE writes wait in its queue, processors block when it is full.
+# Events are committed every RESULT_WRITER_BATCH_ROWS rows or RESULT_WRITER_BATCH_SECONDS seconds. WAL journaling
+# lets queries read the result database while it is written; use "DELETE" if nodes on different machines share the
+# result database over a network file system, where WAL doesn't work.
+RESULT_DATABASE_JOURNAL_MODE = "WAL"
+RESULT_WRITER_QUEUE_SIZE = 64
+RESULT_WRITER_BATCH_ROWS = 100000
+RESULT_WRITER_BATCH_SECONDS = 5.0
+# "database": the writers of all nodes write into RESULT_DATABASE, one at a time. "shards": the writer of every
+# process writes into its own shard database in RESULT_SHARD_FOLDER, without waiting for the others. The last node to
+# finish merges the shards into RESULT_DATABASE (or src/processing/mergeShards.py), and builds its indexes once.
+RESULT_WRITE_MODE = "database"
+RESULT_SHARD_FOLDER = f"{RESULT_FOLDER}shards/"
+# Also store the slice events in a Parquet dataset partitioned by event type and year (needs pyarrow), which
+# src.querying.queryFunctions.getEvents scans reading only the needed partitions and columns. Every writer buffers up
+# to EVENT_STORE_FILE_ROWS events before it writes them into one file per partition.
+WRITE_EVENT_STORE = False
+EVENT_STORE_FOLDER = f"{RESULT_FOLDER}events/"
+EVENT_STORE_FILE_ROWS = 1000000
+
+# Store the exact cells of every slice event as a run-length encoded footprint in FOOTPRINT_TABLENAME,
+# which allows exact point-in-event queries instead of bounding box matches
+STORE_EVENT_FOOTPRINTS = True
+
+# Record wall time, CPU time, peak RSS, bytes read and events emitted of every stage of processing a file in
+# METRICS_TABLENAME of the processing database, summarized by src/processing/metricsReport.py
+RECORD_PROCESSING_METRICS = True
+METRICS_TABLENAME = "processingMetrics"
+
+# Sampling profiler of single processing jobs, writing a folded stack profile per job to PROCESSING_FOLDER/profiles/.
+# Jobs matching a pattern of PROFILING_JOBS (like "2021:precipitation" or "*:wind", overridden by the comma separated
+# patterns of the environment variable PROCESSING_PROFILE) and a random PROFILING_SAMPLE_FRACTION of the other jobs
+# are profiled, taking a sample every PROFILING_INTERVAL seconds. Jobs that aren't profiled have no overhead.
+PROFILING_JOBS = []
+PROFILING_SAMPLE_FRACTION = 0.0
+PROFILING_INTERVAL = 0.01
+
+# Approximate memory in bytes used for merging one time chunk into a top N, bounds peak memory of update_top_n
+TOP_N_MEMORY_BUDGET = 8 * 1024**3
+# Number of threads merging the per-year top N partials into the final top 10 files
+MAX_WORKERS_TOP_N_MERGE = 4
 
 METADATA = os.path.abspath(PROJECT_ROOT) + "/metadata.yaml"
\ No newline at end of file
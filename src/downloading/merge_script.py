@@ -1,7 +1,12 @@
 import glob
 import os
 import sys
+from pathlib import Path
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
 import xarray
+from src.config import CONVERT_INPUTS_TO_ZARR
+from src.processing.processing_functions import convertToZarr
 
 
 
@@ -23,6 +28,10 @@ def main():
     merged_dataset.to_netcdf(f"{project_folder}{variable}_{year}.nc")
     merged_dataset.close()
 
+    # chunked zarr store read by the processors instead of the netcdf file
+    if CONVERT_INPUTS_TO_ZARR:
+        convertToZarr(f"{project_folder}{variable}_{year}.nc")
+
     # remove now unneeded monthly files # dont do for now
     #for file in files:
     #    os.remove(file)
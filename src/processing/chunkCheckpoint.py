@@ -0,0 +1,133 @@
+import os
+import shutil
+import numpy as np
+from topNAccumulator import TopNAccumulator, topNPartialPath, topNResumePath
+from databaseFunctions import getChunkProgress
+from resultSink import getResultSink
+from stageMetrics import stage
+from src.utils.eventTimes import epochSeconds
+from src.config import RESULT_FOLDER, PROCESSING_DATABASE, TOP_N_MEMORY_BUDGET
+
+
+def timestepsPerDay(times):
+    """
+    Returns the number of timesteps per day of a time coordinate, 1 if it has less than two timesteps.
+    """
+    times = np.asarray(times)
+    if times.size < 2:
+        return 1
+    return max(1, round(np.timedelta64(1, "D") / np.median(np.diff(times))))
+
+
+class ChunkCheckpoint:
+    """
+    Progress of processing one year file in time chunks. After every chunk the top N accumulators are written to
+    resume checkpoints and the index of the next timestep is stored in the processing database. If processing of
+    the file was interrupted, it resumes at the first unfinished chunk: the top N are loaded from their resume
+    checkpoints and the events the interrupted run inserted after the last finished chunk are deleted, so no event
+    is stored twice.
+    """
+
+    def __init__(self, variable, year, times, eventTypes, topN, resultFolder = RESULT_FOLDER,
+                 processingDatabase = PROCESSING_DATABASE):
+        """
+        :param variable: Variable of the file, as in the processing database
+        :param year: Year of the file
+        :param times: Time coordinate of the file
+        :param eventTypes: Event types the processor stores for this file
+        :param topN: A dict of top N name to a new TopNAccumulator, see updateTopNPartial
+        :param resultFolder: Folder containing the top N partials and resume checkpoints
+        :param processingDatabase: Path to the processing database
+        """
+        self.variable = variable
+        self.year = year
+        self.times = np.asarray(times)
+        self.eventTypes = list(eventTypes)
+        self.resultFolder = resultFolder
+        self.sink = getResultSink()
+
+        self.topN = {}
+        for name, accumulator in topN.items():
+            resumePath = topNResumePath(resultFolder, name, year)
+            if os.path.exists(os.path.join(resumePath, "metadata.json")):
+                accumulator = TopNAccumulator.load(resumePath)
+            self.topN[name] = accumulator
+
+        progress = getChunkProgress(processingDatabase, year, variable)
+        if progress is None:
+            self.start = 0
+            self.sink.updateChunkProgress(year, variable, 0)
+        else:
+            # A top N without a resume checkpoint has to start over, and with it the events
+            self.start = min([progress] + [accumulator.progress for accumulator in self.topN.values()])
+            if self.times.size:
+                # Events across time and space are only stored after the last chunk, they are always recomputed
+                seconds = epochSeconds(self.times)
+                startTime = int(seconds[self.start]) if self.start < self.times.size else None
+                self.sink.deleteEvents(self.eventTypes, startTime, int(seconds[-1]), int(seconds[0]))
+
+    def chunkSize(self, chunkDays):
+        """
+        Returns the number of timesteps of chunkDays days.
+        """
+        return max(1, int(chunkDays * timestepsPerDay(self.times)))
+
+    def chunks(self, chunkDays, includeDone = False):
+        """
+        Yields the (start, stop) timestep indices of the chunks to process.
+        :param chunkDays: Length of a chunk in days
+        :param includeDone: Also yield the chunks finished by an interrupted run, see pending
+        """
+        chunkSize = self.chunkSize(chunkDays)
+        if includeDone:
+            for start in range(0, self.start, chunkSize):
+                yield start, min(start + chunkSize, self.start)
+        for start in range(self.start, self.times.size, chunkSize):
+            yield start, min(start + chunkSize, self.times.size)
+
+    def pending(self, start):
+        """
+        Returns if the chunk starting at start was not finished by an interrupted run.
+        """
+        return start >= self.start
+
+    def updateTopN(self, name, dataset, start, stop):
+        """
+        Merges a chunk into a top N, unless the top N already holds it.
+        :param name: Name of the top N
+        :param dataset: The chunk
+        :param start: Index of the first timestep of the chunk
+        :param stop: Index after the last timestep of the chunk
+        """
+        accumulator = self.topN[name]
+        if start >= accumulator.progress:
+            with stage("topN"):
+                accumulator.update(dataset, memoryBudget=TOP_N_MEMORY_BUDGET)
+            accumulator.progress = stop
+
+    def commit(self, stop):
+        """
+        Marks all timesteps before stop as processed. Called after all events of a chunk are inserted.
+        """
+        # The top N are written first. If the process is killed in between, they are ahead of the stored
+        # progress and skip the chunks they already hold on resume.
+        with stage("checkpoint"):
+            for name, accumulator in self.topN.items():
+                accumulator.checkpoint(topNResumePath(self.resultFolder, name, self.year))
+            self.sink.updateChunkProgress(self.year, self.variable, stop)
+
+    def finish(self):
+        """
+        Stores the top N as the partials of the year and removes the resume checkpoints.
+        :return: The dict of top N name to accumulator
+        """
+        with stage("checkpoint"):
+            for name, accumulator in self.topN.items():
+                accumulator.progress = 0
+                accumulator.checkpoint(topNPartialPath(self.resultFolder, name, self.year))
+                resumePath = topNResumePath(self.resultFolder, name, self.year)
+                # Without its metadata the resume checkpoint is incomplete, even if the removal is interrupted
+                if os.path.exists(os.path.join(resumePath, "metadata.json")):
+                    os.remove(os.path.join(resumePath, "metadata.json"))
+                shutil.rmtree(resumePath, ignore_errors=True)
+        return self.topN
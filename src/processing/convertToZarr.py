@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+import argparse
+import glob
+import os
+from src.processing.databaseFunctions import splitFilename
+from src.processing.processing_functions import convertToZarr, processingInputPath
+from src.config import PROCESSING_FOLDER, ZARR_TIME_CHUNK, ZARR_SPACE_CHUNK
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the merged yearly NetCDF files into chunked Zarr stores, "
+                                                 "which the processors read instead.")
+    parser.add_argument("files", nargs="*",
+                        help="NetCDF files to convert. Default: all files of the processing folder without an "
+                             "up-to-date Zarr store")
+    parser.add_argument("--folder", default=PROCESSING_FOLDER, help="Processing folder")
+    parser.add_argument("--time-chunk", type=int, default=ZARR_TIME_CHUNK, help="Timesteps per chunk")
+    parser.add_argument("--space-chunk", type=int, default=ZARR_SPACE_CHUNK,
+                        help="Latitudes and longitudes per chunk")
+    parser.add_argument("--force", action="store_true", help="Also convert files with an up-to-date store")
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        files = []
+        for path in sorted(glob.glob(os.path.join(args.folder, "*.nc"))):
+            variable, year = splitFilename(os.path.basename(path))
+            if (variable, year) == (None, None):
+                continue
+            if args.force or processingInputPath(os.path.join(args.folder, ""), variable, year) == path:
+                files.append(path)
+
+    for path in files:
+        print(f"Converting {path}")
+        print(f"Written {convertToZarr(path, timeChunk=args.time_chunk, spaceChunk=args.space_chunk)}")
+
+
+if __name__ == "__main__":
+    main()
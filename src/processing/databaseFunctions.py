@@ -1,16 +1,21 @@
 import glob
+import hashlib
 import os.path
 import sqlite3
 import os
+import time
 import pandas as pd
-from src.config import PROCESSING_FOLDER, PROCESSING_DATABASE, RESULT_DATABASE
+from src.utils.eventTimes import epochSeconds, epochSecondsToDatetime
+from src.config import PROCESSING_FOLDER, PROCESSING_DATABASE, RESULT_DATABASE, SPATIOTEMPORAL_TABLENAME, \
+    FOOTPRINT_TABLENAME, METRICS_TABLENAME, PROCESSING_FINGERPRINT_HASH, RESULT_SHARD_FOLDER
 
 def splitFilename(filename):
     try:
         var, year = filename.split("_", maxsplit = 1)
     except ValueError:
         return (None, None)
-    year = year[0:-3]
+    # .nc files and .zarr stores
+    year = os.path.splitext(year)[0]
 
     # In case of single months being in the same directory
     if(len(year)>4):
@@ -19,101 +24,422 @@ def splitFilename(filename):
         return (var, year)
 
 
-def createProcessingDatabase(pathToFiles = PROCESSING_FOLDER, pathToProcessingDB = PROCESSING_DATABASE, tablename = "processing"):
+def createProcessingDatabase(pathToFiles = PROCESSING_FOLDER, pathToProcessingDB = PROCESSING_DATABASE, tablename = "processing",
+                             contentHash = PROCESSING_FINGERPRINT_HASH):
     """
-    Creates a table for storing the processing status of all .nc files contained in pathToFiles.
+    Creates a table for storing the processing status of all .nc files and .zarr stores contained in pathToFiles.
     :param pathToFiles: Path to files to process. Default: PROCESSING_FOLDER path specified in config
     :param pathToProcessingDB: Path to the processing database. Default: PROCESSING_DATABASE path specified in config
     :param tablename: Name for the processing table. Default: processing
+    :param contentHash: Also store a hash of the file contents, see fileFingerprint
     """
     # establish sql connection to database
     connection = sqlite3.connect(pathToProcessingDB)
     cursor = connection.cursor()
 
     # Create table
-    cursor.execute(f"CREATE TABLE {tablename} (id INTEGER PRIMARY KEY, variable TEXT, year INTEGER, status TEXT)")
-
-    # get all .nc files in directory
-    files = [x for x in glob.glob(f"{pathToFiles}*.nc")]
-
-    # read filenames into data
-    data = []
-    for file in files:
-        # remove path from the file
-        file = os.path.basename(file)
-        x = splitFilename(file)
-        if(x == (None,None)):
-            continue
-        else:
-            data.append(x)
-
-    # Insert all results into the table
-    connection.executemany(f"INSERT INTO {tablename} (variable, year,  status) VALUES (?,?,'unprocessed')", data)
+    cursor.execute(f"CREATE TABLE {tablename} (id INTEGER PRIMARY KEY, variable TEXT, year INTEGER, status TEXT, "
+                   f"claimedBy TEXT, leaseExpiry FLOAT, fileSize INTEGER, fileMtime FLOAT, fileHash TEXT)")
+    cursor.execute(f"CREATE UNIQUE INDEX {tablename}_file ON {tablename} (variable, year)")
     connection.commit()
 
     # Close the connection
     cursor.close()
     connection.close()
 
+    # Insert all .nc files and .zarr stores in directory
+    updateProcessingDatabase(pathToFiles, pathToProcessingDB, tablename, contentHash)
 
-def updateProcessingDatabase(pathToFiles = PROCESSING_FOLDER, pathToProcessingDB = PROCESSING_DATABASE, tablename="processing"):
+
+def fileFingerprint(path, contentHash = False, blockSize = 64 * 1024**2):
+    """
+    Returns the size, modification time and optionally a hash of the contents of a file. Of a directory, e.g. a
+    Zarr store, the total size, latest modification time and a hash of all files in it are returned.
+    :param path: Path to the file or directory
+    :param contentHash: Compute a BLAKE2 hash of the contents, which reads the whole file
+    :param blockSize: Number of bytes hashed at once
+    :return: A tuple of size in bytes, modification time and hash, which is None if contentHash is False
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    stats = [os.stat(file) for file in files]
+    size = sum(stat.st_size for stat in stats)
+    mtime = max([stat.st_mtime for stat in stats], default=os.stat(path).st_mtime)
+
+    digest = None
+    if contentHash:
+        hasher = hashlib.blake2b(digest_size=20)
+        for filePath in files:
+            if filePath != path:
+                hasher.update(os.path.relpath(filePath, path).encode())
+            with open(filePath, "rb") as file:
+                for block in iter(lambda: file.read(blockSize), b""):
+                    hasher.update(block)
+        digest = hasher.hexdigest()
+    return size, mtime, digest
+
+
+def addFingerprintColumns(connection, tablename = "processing"):
+    """
+    Adds the fingerprint columns and the unique (variable, year) index to a processing table created before files
+    were fingerprinted. Duplicate rows of a file are removed, keeping the first one.
     """
+    addMissingColumn(connection, tablename, "fileSize", "INTEGER")
+    addMissingColumn(connection, tablename, "fileMtime", "FLOAT")
+    addMissingColumn(connection, tablename, "fileHash", "TEXT")
+    connection.execute(f"DELETE FROM {tablename} WHERE id NOT IN "
+                       f"(SELECT min(id) FROM {tablename} GROUP BY variable, year)")
+    connection.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {tablename}_file ON {tablename} (variable, year)")
+    connection.commit()
 
+
+def updateProcessingDatabase(pathToFiles = PROCESSING_FOLDER, pathToProcessingDB = PROCESSING_DATABASE, tablename="processing",
+                             contentHash = PROCESSING_FINGERPRINT_HASH, changedFiles = None):
+    """
+    Adds new .nc files and .zarr stores to the processing table and marks files that changed since they were
+    recorded as unprocessed, e.g. a re-downloaded or re-merged year. A year with both is fingerprinted by its .nc
+    file, so converting it to Zarr doesn't process it again. A file changed if its size or modification time differ from
+    its stored fingerprint, and with contentHash also its hash, so a file that was only touched or copied isn't
+    processed again. Files recorded without a fingerprint get one and don't count as changed.
     :param pathToFiles: Path to files to process. Default: PROCESSING_FOLDER path specified in config
     :param pathToProcessingDB: Path to the processing database. Default: PROCESSING_DATABASE path specified in config
     :param tablename: Name for the processing table. Default: processing
+    :param contentHash: Compare hashes of the file contents. Default: PROCESSING_FINGERPRINT_HASH specified in config
+    :param changedFiles: A list the (variable, year) of the changed files are appended to, e.g. to invalidate their
+    results. Default: None
     :return: The number of new records created in the database
     """
 
     # Establish SQL connection to the database
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    addFingerprintColumns(connection, tablename)
+
+    stored = {(variable, year): (size, mtime, digest) for variable, year, size, mtime, digest in connection.execute(
+        f"SELECT variable, year, fileSize, fileMtime, fileHash FROM {tablename}").fetchall()}
+
+    # Get all .nc files and .zarr stores in the directory
+    paths = {}
+    for path in sorted(glob.glob(f"{pathToFiles}*.zarr")) + sorted(glob.glob(f"{pathToFiles}*.nc")):
+        variable, year = splitFilename(os.path.basename(path))
+        # Stray files like wind_tmp.nc aren't inputs
+        if (variable, year) == (None, None) or not year.isdigit():
+            continue
+        paths[(variable, int(year))] = path
+
+    fingerprints = []
+    changed = []
+    numNewRecords = 0
+    for key, path in sorted(paths.items()):
+
+        if key not in stored:
+            numNewRecords += 1
+        else:
+            size, mtime, digest = stored[key]
+            if size is not None and (size, mtime) == fileFingerprint(path)[:2]:
+                continue
+        fingerprint = fileFingerprint(path, contentHash)
+
+        if key in stored and stored[key][0] is not None:
+            storedDigest = stored[key][2]
+            if not (contentHash and storedDigest is not None and storedDigest == fingerprint[2]):
+                changed.append(key)
+        fingerprints.append(key + fingerprint)
+
+    # Insert new records and update the fingerprints of the others in one transaction
+    connection.executemany(f"INSERT INTO {tablename} (variable, year, status, fileSize, fileMtime, fileHash) "
+                           f"VALUES (?, ?, 'unprocessed', ?, ?, ?) ON CONFLICT (variable, year) DO UPDATE SET "
+                           f"fileSize = excluded.fileSize, fileMtime = excluded.fileMtime, "
+                           f"fileHash = coalesce(excluded.fileHash, fileHash)", fingerprints)
+    connection.executemany(f"UPDATE {tablename} SET status = 'unprocessed' WHERE variable = ? AND year = ?",
+                           changed)
+    connection.commit()
+    connection.close()
+
+    if changedFiles is not None:
+        changedFiles.extend(changed)
+    return numNewRecords
+
+def updateProcessingStatus(pathToProcessingDB, year, var, status):
     connection = sqlite3.connect(pathToProcessingDB)
     cursor = connection.cursor()
 
-    # Get all .nc files in the directory
-    files = [x for x in glob.glob(f"{pathToFiles}*.nc")]
+    cursor.execute(f"UPDATE processing SET status = '{status}' WHERE year={year} AND variable = '{var}'")
+    connection.commit()
 
-    # Read filenames into data
-    data = []
-    for file in files:
-        file = os.path.basename(file)
-        x = splitFilename(file)  # Assuming this function extracts (variable, year)
-        if x == (None, None):
-            continue
+    cursor.close()
+    connection.close()
 
-        variable, year = x
+def addLeaseColumns(pathToProcessingDB, tablename = "processing"):
+    """
+    Adds the claim columns to a processing table created before work was distributed with leases.
+    """
+    connection = sqlite3.connect(pathToProcessingDB)
+    addMissingColumn(connection, tablename, "claimedBy", "TEXT")
+    addMissingColumn(connection, tablename, "leaseExpiry", "FLOAT")
+    connection.close()
 
-        # Check if the record already exists
-        cursor.execute(f"SELECT COUNT(*) FROM {tablename} WHERE variable = ? AND year = ?", (variable, year))
-        exists = cursor.fetchone()[0]
 
-        if exists == 0:
-            data.append((variable, year))
+def claimNextFile(pathToProcessingDB, workerId, leaseSeconds, excluded = (), runtimes = None,
+                  tablename = "processing"):
+    """
+    Atomically claims the next file that is not processed and not claimed by another worker, or whose lease
+    expired because its worker crashed. The claim holds until leaseExpiry and has to be renewed with renewLeases.
+    :param pathToProcessingDB: Path to the processing database
+    :param workerId: Unique id of the claiming worker
+    :param leaseSeconds: Duration of the lease
+    :param excluded: (year, variable) tuples not to claim, e.g. files this worker already failed on
+    :param runtimes: Dict of variable to the runtime of its files in seconds, see memoryScheduler.pastRuntimes.
+    Of the variables with the fewest files in progress, the longest running is claimed first, so its files don't
+    finish last while the other workers are idle. Default: no preference
+    :param tablename: Name for the processing table. Default: processing
+    :return: A tuple of year and variable of the claimed file, or None if there is no claimable file
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60, isolation_level=None)
+    try:
+        # Take the write lock before reading, so no other worker can claim the same file in between
+        connection.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        # Variables with the fewest files in progress come first, so workers started together process different
+        # variables, which read different files and write different top N partials
+        candidates = connection.execute(f"SELECT id, year, variable, (SELECT count(*) FROM {tablename} "
+                                        f"WHERE variable = file.variable AND claimedBy IS NOT NULL "
+                                        f"AND leaseExpiry >= ?) AS inProgress FROM {tablename} AS file "
+                                        f"WHERE NOT status = 'processed' AND (claimedBy IS NULL OR leaseExpiry < ?) "
+                                        f"ORDER BY inProgress, year DESC",
+                                        (now, now)).fetchall()
+        if runtimes:
+            # Stable, the years stay in descending order
+            candidates.sort(key=lambda candidate: (candidate[3], -runtimes.get(candidate[2], 0)))
+        excluded = set(excluded)
+        claimed = next(((rowId, year, var) for rowId, year, var, _ in candidates if (year, var) not in excluded),
+                       None)
+        if claimed is not None:
+            connection.execute(f"UPDATE {tablename} SET claimedBy = ?, leaseExpiry = ?, status = 'processing' "
+                               f"WHERE id = ?", (workerId, now + leaseSeconds, claimed[0]))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+    return None if claimed is None else (claimed[1], claimed[2])
+
+
+def renewLeases(pathToProcessingDB, workerId, leaseSeconds, tablename = "processing"):
+    """
+    Extends the leases of all files claimed by a worker.
+    :return: The number of files still claimed by the worker
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    renewed = connection.execute(f"UPDATE {tablename} SET leaseExpiry = ? WHERE claimedBy = ?",
+                                 (time.time() + leaseSeconds, workerId)).rowcount
+    connection.commit()
+    connection.close()
+    return renewed
 
-    # Insert new records
-    if data:
-        cursor.executemany(f"INSERT INTO {tablename} (variable, year, status) VALUES (?, ?, 'unprocessed')", data)
-        connection.commit()
-        numNewRecords = len(data)
-    else:
-        numNewRecords = 0
 
-    # Close the connection
-    cursor.close()
+def releaseClaim(pathToProcessingDB, year, var, workerId, tablename = "processing"):
+    """
+    Releases the claim of a worker on a file, after its final status is written.
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    connection.execute(f"UPDATE {tablename} SET claimedBy = NULL, leaseExpiry = NULL "
+                       f"WHERE year = ? AND variable = ? AND claimedBy = ?", (year, var, workerId))
+    connection.commit()
     connection.close()
 
-    return numNewRecords
 
-def updateProcessingStatus(pathToProcessingDB, year, var, status):
+def getClaimingWorkers(pathToProcessingDB, tablename = "processing"):
+    """
+    Returns the ids of all workers holding a claim, expired or not.
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    workerIds = [row[0] for row in connection.execute(f"SELECT DISTINCT claimedBy FROM {tablename} "
+                                                      f"WHERE claimedBy IS NOT NULL").fetchall()]
+    connection.close()
+    return workerIds
+
+
+def releaseAllClaims(pathToProcessingDB, workerId, tablename = "processing"):
+    """
+    Releases all claims of a worker, e.g. of a worker known to be dead.
+    :return: The number of released claims
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    released = connection.execute(f"UPDATE {tablename} SET claimedBy = NULL, leaseExpiry = NULL WHERE claimedBy = ?",
+                                  (workerId,)).rowcount
+    connection.commit()
+    connection.close()
+    return released
+
+
+def countActiveClaims(pathToProcessingDB, tablename = "processing"):
+    """
+    Returns the number of files claimed by any worker with a lease that did not expire.
+    """
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    count = connection.execute(f"SELECT count(*) FROM {tablename} WHERE claimedBy IS NOT NULL AND leaseExpiry >= ?",
+                               (time.time(),)).fetchone()[0]
+    connection.close()
+    return count
+
+
+def createChunkProgressTable(pathToProcessingDB, tableName = "chunkProgress"):
+    """
+    Creates the table for the progress within the files, if it doesn't exist yet. Every row holds the index of the
+    first timestep of a file that is not processed completely yet.
+    :param pathToProcessingDB: Path to the processing database
+    :param tableName: Name of the table. Default: chunkProgress
+    """
     connection = sqlite3.connect(pathToProcessingDB)
-    cursor = connection.cursor()
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {tableName} (variable TEXT, year INTEGER, nextTimeIndex INTEGER, "
+                       f"PRIMARY KEY (variable, year))")
+    connection.commit()
+    connection.close()
 
-    cursor.execute(f"UPDATE processing SET status = '{status}' WHERE year={year} AND variable = '{var}'")
+
+def getChunkProgress(pathToProcessingDB, year, var, tableName = "chunkProgress"):
+    """
+    Returns the index of the first timestep of a file that is not processed completely yet.
+    :param pathToProcessingDB: Path to the processing database
+    :param year: Year of the file
+    :param var: Variable of the file
+    :param tableName: Name of the table. Default: chunkProgress
+    :return: The timestep index or None if processing of the file never started
+    """
+    connection = sqlite3.connect(pathToProcessingDB)
+    exists = connection.execute("SELECT exists(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                                (tableName,)).fetchone()[0]
+    row = None
+    if exists:
+        row = connection.execute(f"SELECT nextTimeIndex FROM {tableName} WHERE variable = ? AND year = ?",
+                                 (var, year)).fetchone()
+    connection.close()
+    return None if row is None else row[0]
+
+
+def updateChunkProgress(pathToProcessingDB, year, var, nextTimeIndex, tableName = "chunkProgress"):
+    """
+    Stores the index of the first timestep of a file that is not processed completely yet.
+    None removes the progress of the file, once the file is processed.
+    """
+    createChunkProgressTable(pathToProcessingDB, tableName)
+    connection = sqlite3.connect(pathToProcessingDB)
+    if nextTimeIndex is None:
+        connection.execute(f"DELETE FROM {tableName} WHERE variable = ? AND year = ?", (var, year))
+    else:
+        connection.execute(f"INSERT OR REPLACE INTO {tableName} (variable, year, nextTimeIndex) VALUES (?, ?, ?)",
+                           (var, year, nextTimeIndex))
     connection.commit()
+    connection.close()
 
-    cursor.close()
+
+def createMetricsTable(pathToProcessingDB, tableName = METRICS_TABLENAME):
+    """
+    Creates the table for the stage metrics of the processed files, if it doesn't exist yet. Every row holds the
+    summed up metrics of one stage of one file, see stageMetrics.FileMetrics.
+    """
+    connection = sqlite3.connect(pathToProcessingDB)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {tableName} (id INTEGER PRIMARY KEY, variable TEXT, "
+                       f"year INTEGER, recordedAt TEXT, stage TEXT, calls INTEGER, wallSeconds FLOAT, "
+                       f"cpuSeconds FLOAT, peakRssMB FLOAT, bytesRead INTEGER, events INTEGER)")
+    connection.commit()
+    connection.close()
+
+
+def insertStageMetrics(pathToProcessingDB, year, var, recordedAt, rows, tableName = METRICS_TABLENAME):
+    """
+    Inserts the stage metrics of a processed file. Metrics of earlier runs of the file are kept.
+    :param pathToProcessingDB: Path to the processing database
+    :param year: Year of the file
+    :param var: Variable of the file
+    :param recordedAt: Time the processing of the file started, the same for all stages
+    :param rows: Tuples of stage, calls, wallSeconds, cpuSeconds, peakRssMB, bytesRead and events
+    :param tableName: Name of the table. Default: METRICS_TABLENAME specified in config
+    """
+    createMetricsTable(pathToProcessingDB, tableName)
+    connection = sqlite3.connect(pathToProcessingDB, timeout=60)
+    connection.executemany(f"INSERT INTO {tableName} (variable, year, recordedAt, stage, calls, wallSeconds, "
+                           f"cpuSeconds, peakRssMB, bytesRead, events) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(var, int(year), recordedAt) + tuple(row) for row in rows])
+    connection.commit()
+    connection.close()
+
+
+def readStageMetrics(pathToProcessingDB, latestOnly = True, tableName = METRICS_TABLENAME):
+    """
+    Reads the stage metrics of the processed files into a dataframe.
+    :param pathToProcessingDB: Path to the processing database
+    :param latestOnly: Only the metrics of the latest run of every file
+    :param tableName: Name of the table. Default: METRICS_TABLENAME specified in config
+    :return: A dataframe with one row per file and stage
+    """
+    createMetricsTable(pathToProcessingDB, tableName)
+    query = f"SELECT * FROM {tableName}"
+    if latestOnly:
+        query += (f" AS metrics WHERE recordedAt = (SELECT max(recordedAt) FROM {tableName} "
+                  f"WHERE variable = metrics.variable AND year = metrics.year)")
+    connection = sqlite3.connect(pathToProcessingDB)
+    df = pd.read_sql_query(query, connection)
+    connection.close()
+    return df
+
+
+def deleteEventsInTimeRange(pathToResultDB, eventTypes, startTime, endTime, spatioTemporalStartTime = None,
+                            tableName = "thresholdResults", spatioTemporalTableName = SPATIOTEMPORAL_TABLENAME,
+                            footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Deletes the events of the given types that occurred from startTime to endTime, including their footprints,
+    and the events across time and space starting from spatioTemporalStartTime to endTime. Used to remove the
+    events of an interrupted file that are processed again.
+    :param pathToResultDB: Path to the result database
+    :param eventTypes: List of event types
+    :param startTime: First event time to delete, see epochSeconds for the accepted formats. None deletes no events
+    :param endTime: Last event time to delete
+    :param spatioTemporalStartTime: First start time of the events across time and space to delete. Default: startTime
+    :return: The number of deleted events
+    """
+    connection = sqlite3.connect(pathToResultDB)
+    deleted = deleteEventRows(connection, eventTypes, startTime, endTime, spatioTemporalStartTime, tableName,
+                              spatioTemporalTableName, footprintTableName)
+    connection.commit()
     connection.close()
+    return deleted
+
 
-def createResultDatabase(pathToResultDB, tableName = "thresholdResults"):
+def deleteEventRows(connection, eventTypes, startTime, endTime, spatioTemporalStartTime = None,
+                    tableName = "thresholdResults", spatioTemporalTableName = SPATIOTEMPORAL_TABLENAME,
+                    footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Deletes events like deleteEventsInTimeRange on an open connection, without committing.
+    """
+    spatioTemporalStartTime = startTime if spatioTemporalStartTime is None else spatioTemporalStartTime
+    startTime, endTime, spatioTemporalStartTime = [None if value is None else epochSeconds(value)
+                                                   for value in (startTime, endTime, spatioTemporalStartTime)]
+    typePlaceholders = ",".join("?" * len(eventTypes))
+
+    tables = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+    deleted = 0
+    if startTime is not None and tableName in tables:
+        condition = f"eventType IN ({typePlaceholders}) AND eventTime >= ? AND eventTime <= ?"
+        parameters = (*eventTypes, startTime, endTime)
+        if footprintTableName in tables:
+            connection.execute(f"DELETE FROM {footprintTableName} WHERE eventId IN "
+                               f"(SELECT id FROM {tableName} WHERE {condition})", parameters)
+        deleted += connection.execute(f"DELETE FROM {tableName} WHERE {condition}", parameters).rowcount
+    if spatioTemporalStartTime is not None and spatioTemporalTableName in tables:
+        deleted += connection.execute(f"DELETE FROM {spatioTemporalTableName} WHERE eventType IN ({typePlaceholders}) "
+                                      f"AND startTime >= ? AND startTime <= ?",
+                                      (*eventTypes, spatioTemporalStartTime, endTime)).rowcount
+    return deleted
+
+
+def createResultDatabase(pathToResultDB, tableName = "thresholdResults", footprintTableName = FOOTPRINT_TABLENAME,
+                         indexes = True):
     # establish sql connection to database
     connection = sqlite3.connect(pathToResultDB)
     cursor = connection.cursor()
@@ -123,7 +449,7 @@ def createResultDatabase(pathToResultDB, tableName = "thresholdResults"):
         # Create table
         cursor.execute(f"CREATE TABLE {tableName} (id INTEGER PRIMARY KEY, "
                        f"eventType TEXT, "
-                       f"eventTime DATE, "
+                       f"eventTime INTEGER, "
                        f"minLatitude FLOAT, "
                        f"maxLatitude FLOAT, "
                        f"minLongitude FLOAT, "
@@ -132,54 +458,360 @@ def createResultDatabase(pathToResultDB, tableName = "thresholdResults"):
                        f"centroidLongitude FLOAT, "
                        f"maxEventValue FLOAT, "
                        f"meanEventValue FLOAT, "
-                       f"eventArea INT)")
+                       f"eventArea INT, "
+                       f"threshold FLOAT)")
 
         connection.commit()
+    else:
+        # Tables created before multi-threshold extraction have no threshold column yet
+        addMissingColumn(connection, tableName, "threshold", "FLOAT")
+        migrateEventTimes(connection, tableName, ["eventTime"])
+
+    if indexes:
+        createEventIndexes(connection, tableName, "eventTime")
+
+    # Exact cells of the events, keyed by the id of the event row
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {footprintTableName} (eventId INTEGER PRIMARY KEY, footprint BLOB)")
+    connection.commit()
 
     # Close the connection
     cursor.close()
     connection.close()
 
 
-def insertEventsIntoDatabase(pathToResultDB, eventType,events, tableName = "thresholdResults"):
-    # establish sql connection to database
+def boundingBoxTableName(tableName):
+    """
+    Returns the name of the R*Tree over the bounding boxes of the events of a result table.
+    """
+    return f"{tableName}_rtree"
+
+
+def createEventIndexes(connection, tableName, timeColumn):
+    """
+    Creates the indexes of a result table, if they don't exist yet: an index on the event type and time, and an
+    R*Tree over the bounding boxes of the events, which triggers keep in sync with the inserts and deletes of the
+    table. Events already in the table are added to a new R*Tree. Events without a bounding box are not indexed.
+    :param connection: An open sqlite connection
+    :param tableName: Name of the result table
+    :param timeColumn: Column of the event time, eventTime or startTime
+    """
+    rtreeName = boundingBoxTableName(tableName)
+    rtreeExists = connection.execute("SELECT exists(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                                     (rtreeName,)).fetchone()[0]
+
+    connection.execute(f"CREATE INDEX IF NOT EXISTS {tableName}_type_time ON {tableName} (eventType, {timeColumn})")
+    connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {rtreeName} "
+                       f"USING rtree(id, minLatitude, maxLatitude, minLongitude, maxLongitude)")
+    connection.execute(f"CREATE TRIGGER IF NOT EXISTS {tableName}_rtree_insert AFTER INSERT ON {tableName} "
+                       f"WHEN NEW.minLatitude IS NOT NULL AND NEW.minLongitude IS NOT NULL BEGIN "
+                       f"INSERT INTO {rtreeName} VALUES (NEW.id, NEW.minLatitude, NEW.maxLatitude, NEW.minLongitude, "
+                       f"NEW.maxLongitude); END")
+    connection.execute(f"CREATE TRIGGER IF NOT EXISTS {tableName}_rtree_delete AFTER DELETE ON {tableName} BEGIN "
+                       f"DELETE FROM {rtreeName} WHERE id = OLD.id; END")
+    if not rtreeExists:
+        connection.execute(f"INSERT INTO {rtreeName} SELECT id, minLatitude, maxLatitude, minLongitude, maxLongitude "
+                           f"FROM {tableName} WHERE minLatitude IS NOT NULL AND minLongitude IS NOT NULL")
+    connection.commit()
+
+
+def dropEventIndexes(connection, tableName):
+    """
+    Drops the indexes createEventIndexes created for a result table.
+    """
+    connection.execute(f"DROP TRIGGER IF EXISTS {tableName}_rtree_insert")
+    connection.execute(f"DROP TRIGGER IF EXISTS {tableName}_rtree_delete")
+    connection.execute(f"DROP TABLE IF EXISTS {boundingBoxTableName(tableName)}")
+    connection.execute(f"DROP INDEX IF EXISTS {tableName}_type_time")
+    connection.commit()
+
+
+def shardDatabasePath(workerId, shardFolder = RESULT_SHARD_FOLDER):
+    """
+    Returns the path of the result shard of a worker.
+    :param workerId: Id of the worker, like "host:pid:task3"
+    :param shardFolder: Folder of the shards. Default: RESULT_SHARD_FOLDER specified in config
+    """
+    return os.path.join(shardFolder, f"results_{workerId.replace(':', '_')}.db")
+
+
+def shardDatabasePaths(shardFolder = RESULT_SHARD_FOLDER):
+    """
+    Returns the paths of all result shards in a folder.
+    """
+    return sorted(glob.glob(os.path.join(shardFolder, "results_*.db")))
+
+
+def mergeResultShards(pathToResultDB, shardPaths, removeShards = True, tableName = "thresholdResults",
+                      spatioTemporalTableName = SPATIOTEMPORAL_TABLENAME, footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Moves the events of result shards into the result database. Every shard is attached and copied in one
+    transaction, which also empties the shard, so an interrupted merge can be run again. The event ids of a shard
+    are shifted behind the ids of the result database, together with the ids of their footprints. The indexes of the
+    result database are dropped before the first shard and built once after the last. Without shards the result
+    database is left untouched, e.g. when another node already merged them.
+    :param pathToResultDB: Path to the result database
+    :param shardPaths: Paths of the shards
+    :param removeShards: Remove the shards after they are merged
+    :return: The number of merged events
+    """
+    shardPaths = [path for path in shardPaths if os.path.exists(path)]
+    if not shardPaths:
+        return 0
+
+    createResultDatabase(pathToResultDB, tableName, footprintTableName, indexes=False)
+    createSpatioTemporalTable(pathToResultDB, spatioTemporalTableName, indexes=False)
+
+    connection = sqlite3.connect(pathToResultDB, timeout=60)
+    dropEventIndexes(connection, tableName)
+    dropEventIndexes(connection, spatioTemporalTableName)
+
+    merged = 0
+    for shardPath in shardPaths:
+        connection.execute("ATTACH DATABASE ? AS shard", (shardPath,))
+        shardTables = set(row[0] for row in
+                          connection.execute("SELECT name FROM shard.sqlite_master WHERE type = 'table'"))
+        connection.execute("BEGIN IMMEDIATE")
+        if tableName in shardTables:
+            offset = connection.execute(f"SELECT COALESCE(MAX(id), 0) FROM main.{tableName}").fetchone()[0]
+            columns = ", ".join(row[1] for row in connection.execute(f"PRAGMA shard.table_info({tableName})")
+                                if row[1] != "id")
+            merged += connection.execute(f"INSERT INTO main.{tableName} (id, {columns}) "
+                                         f"SELECT id + ?, {columns} FROM shard.{tableName}", (offset,)).rowcount
+            if footprintTableName in shardTables:
+                connection.execute(f"INSERT INTO main.{footprintTableName} (eventId, footprint) "
+                                   f"SELECT eventId + ?, footprint FROM shard.{footprintTableName}", (offset,))
+                connection.execute(f"DELETE FROM shard.{footprintTableName}")
+            connection.execute(f"DELETE FROM shard.{tableName}")
+        if spatioTemporalTableName in shardTables:
+            columns = ", ".join(row[1] for row in connection.execute(f"PRAGMA shard.table_info({spatioTemporalTableName})")
+                                if row[1] != "id")
+            merged += connection.execute(f"INSERT INTO main.{spatioTemporalTableName} ({columns}) "
+                                         f"SELECT {columns} FROM shard.{spatioTemporalTableName}").rowcount
+            connection.execute(f"DELETE FROM shard.{spatioTemporalTableName}")
+        connection.commit()
+        connection.execute("DETACH DATABASE shard")
+
+        if removeShards:
+            for path in (shardPath, f"{shardPath}-wal", f"{shardPath}-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    createEventIndexes(connection, tableName, "eventTime")
+    createEventIndexes(connection, spatioTemporalTableName, "startTime")
+    connection.close()
+    return merged
+
+
+def migrateEventTimes(connection, tableName, columns):
+    """
+    Converts the time columns of a result table of an older version, which stored times as strings like
+    '2010-01-01T00:00:00.000000000', to integer seconds since the epoch. The table is rebuilt with INTEGER columns,
+    keeping the ids of the events. Its indexes are dropped with the old table, createEventIndexes creates them again.
+    :param connection: An open sqlite connection
+    :param tableName: Name of the table
+    :param columns: Names of the time columns
+    :return: True if the table was migrated
+    """
+    tableInfo = connection.execute(f"PRAGMA table_info({tableName})").fetchall()
+    if all(columnType.upper() == "INTEGER" for _, name, columnType, *_ in tableInfo if name in columns):
+        return False
+
+    definitions = ", ".join(f"{name} {'INTEGER' if name in columns else columnType}{' PRIMARY KEY' if primaryKey else ''}"
+                            for _, name, columnType, _, _, primaryKey in tableInfo)
+    # Fractions of seconds are dropped, the times are whole hours
+    values = ", ".join(f"CASE WHEN typeof({name}) = 'text' THEN CAST(strftime('%s', substr({name}, 1, 19)) AS INTEGER) "
+                       f"ELSE {name} END" if name in columns else name for _, name, *_ in tableInfo)
+    connection.execute("BEGIN IMMEDIATE")
+    connection.execute(f"CREATE TABLE {tableName}_migrated ({definitions})")
+    connection.execute(f"INSERT INTO {tableName}_migrated SELECT {values} FROM {tableName}")
+    connection.execute(f"DROP TABLE {tableName}")
+    connection.execute(f"ALTER TABLE {tableName}_migrated RENAME TO {tableName}")
+    connection.commit()
+    return True
+
+
+def addMissingColumn(connection, tableName, columnName, columnType):
+    """
+    Adds a column to an existing table, if the table doesn't have it yet.
+    :param connection: An open sqlite connection
+    :param tableName: Name of the table
+    :param columnName: Name of the column
+    :param columnType: SQL type of the column
+    """
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({tableName})").fetchall()]
+    if columnName not in columns:
+        connection.execute(f"ALTER TABLE {tableName} ADD COLUMN {columnName} {columnType}")
+        connection.commit()
+
+
+def createSpatioTemporalTable(pathToResultDB, tableName = SPATIOTEMPORAL_TABLENAME, indexes = True):
+    """
+    Creates the table for events labeled across time and space (one row per event over its whole lifetime),
+    if it doesn't exist yet.
+    :param pathToResultDB: Path to the result database
+    :param tableName: Name of the table. Default: SPATIOTEMPORAL_TABLENAME specified in config
+    :param indexes: Create the indexes of the table, see createEventIndexes. Result shards have none
+    """
     connection = sqlite3.connect(pathToResultDB)
     cursor = connection.cursor()
 
-    # SQL statement to insert event data
-    insert_query = f"""
-    INSERT INTO {tableName} (
-        eventType, eventTime, minLatitude, maxLatitude, minLongitude, maxLongitude,
-        centroidLatitude, centroidLongitude, maxEventValue, meanEventValue, eventArea
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {tableName} (id INTEGER PRIMARY KEY, "
+                   f"eventType TEXT, "
+                   f"startTime INTEGER, "
+                   f"endTime INTEGER, "
+                   f"peakTime INTEGER, "
+                   f"durationHours FLOAT, "
+                   f"minLatitude FLOAT, "
+                   f"maxLatitude FLOAT, "
+                   f"minLongitude FLOAT, "
+                   f"maxLongitude FLOAT, "
+                   f"centroidLatitude FLOAT, "
+                   f"centroidLongitude FLOAT, "
+                   f"maxEventValue FLOAT, "
+                   f"meanEventValue FLOAT, "
+                   f"eventArea INT, "
+                   f"cellHours FLOAT, "
+                   f"threshold FLOAT)")
+    addMissingColumn(connection, tableName, "threshold", "FLOAT")
+    migrateEventTimes(connection, tableName, ["startTime", "endTime", "peakTime"])
+    if indexes:
+        createEventIndexes(connection, tableName, "startTime")
+    connection.commit()
+
+    cursor.close()
+    connection.close()
+
+
+def insertSpatioTemporalEventsIntoDatabase(pathToResultDB, eventType, events, tableName = SPATIOTEMPORAL_TABLENAME):
+    """
+    Inserts columnar events from getSpatioTemporalEvents into the spatio-temporal table.
+    :param pathToResultDB: Path to the result database
+    :param eventType: The event type stored with every row
+    :param events: Columnar events (dict of arrays)
+    :param tableName: Name of the table. Default: SPATIOTEMPORAL_TABLENAME specified in config
     """
+    connection = sqlite3.connect(pathToResultDB)
+    insertSpatioTemporalEventRows(connection, eventType, events, tableName)
+    connection.commit()
+    connection.close()
 
-    # Prepare the data for insertion
-    event_data = [
-        (
-            eventType, event['eventTime'], event['minLatitude'], event['maxLatitude'],
-            event['minLongitude'], event['maxLongitude'], event['centroidLatitude'],
-            event['centroidLongitude'], event['maxEventValue'], event['meanEventValue'],
-            event['areaInCells']
-        )
-        for event in events
-    ]
-
-    # Execute the batch insert
-    connection.executemany(insert_query, event_data)
+
+def insertSpatioTemporalEventRows(connection, eventType, events, tableName = SPATIOTEMPORAL_TABLENAME):
+    """
+    Inserts events like insertSpatioTemporalEventsIntoDatabase on an open connection, without committing.
+    :return: The number of inserted rows
+    """
+    columns = ['startTime', 'endTime', 'peakTime', 'durationHours', 'minLatitude', 'maxLatitude', 'minLongitude',
+               'maxLongitude', 'centroidLatitude', 'centroidLongitude', 'maxEventValue', 'meanEventValue',
+               'areaInCells', 'cellHours', 'threshold']
+    values = [(epochSeconds(events[column]).tolist() if column in ('startTime', 'endTime', 'peakTime')
+               else events[column].tolist()) if column in events else [None] * len(events['startTime'])
+              for column in columns]
+
+    rows = [(eventType, *row) for row in zip(*values)]
+    connection.executemany(f"INSERT INTO {tableName} (eventType, startTime, endTime, peakTime, durationHours, "
+                           f"minLatitude, maxLatitude, minLongitude, maxLongitude, centroidLatitude, centroidLongitude, "
+                           f"maxEventValue, meanEventValue, eventArea, cellHours, threshold) "
+                           f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def eventRows(eventType, events):
+    """
+    Creates the rows for an insert into the result table from events.
+    :param eventType: The event type stored with every row
+    :param events: A list of event dicts or columnar events (dict of arrays) as returned by getConnectedEvents.
+    Event times in other formats than seconds since the epoch are converted, see epochSeconds
+    :return: An iterable of row tuples
+    """
+    columns = ['eventTime', 'minLatitude', 'maxLatitude', 'minLongitude', 'maxLongitude',
+               'centroidLatitude', 'centroidLongitude', 'maxEventValue', 'meanEventValue', 'areaInCells', 'threshold']
+
+    # Columnar events: zip the columns directly, without building a dict per event.
+    # Events without a threshold (e.g. from older callers) are stored with NULL.
+    if isinstance(events, dict):
+        numEvents = len(events['eventTime'])
+        values = [[None] * numEvents if column not in events
+                  else events[column].tolist() if hasattr(events[column], "tolist") else list(events[column])
+                  for column in columns[1:]]
+        return [(eventType, *row) for row in zip(epochSeconds(events['eventTime']).tolist(), *values)]
+
+    return [(eventType, None if event.get('eventTime') is None else epochSeconds(event['eventTime']),
+             *[event.get(column) for column in columns[1:]]) for event in events]
+
+
+def eventFootprints(events):
+    """
+    Returns the footprints of events, or None if they have none.
+    """
+    if isinstance(events, dict) and 'footprint' in events:
+        return events['footprint']
+    elif not isinstance(events, dict) and events and 'footprint' in events[0]:
+        return [event['footprint'] for event in events]
+    return None
+
+
+def insertEventsIntoDatabase(pathToResultDB, eventType,events, tableName = "thresholdResults",
+                             footprintTableName = FOOTPRINT_TABLENAME):
+    # establish sql connection to database
+    connection = sqlite3.connect(pathToResultDB)
+
+    if eventFootprints(events) is not None:
+        # Footprints are keyed by the event id, so the ids are assigned in insertEventRows. The write lock is taken
+        # first, so no other writer can claim the same ids in between.
+        connection.execute("BEGIN IMMEDIATE")
+    insertEventRows(connection, eventType, events, tableName, footprintTableName)
     connection.commit()
     # Close the connection
-    cursor.close()
     connection.close()
 
 
+def insertEventRows(connection, eventType, events, tableName = "thresholdResults",
+                    footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Inserts events like insertEventsIntoDatabase on an open connection, without committing. Events with footprints
+    must be inserted in a write transaction (BEGIN IMMEDIATE), see insertEventsIntoDatabase.
+    :return: The number of inserted rows
+    """
+    # Prepare the data for insertion
+    event_data = eventRows(eventType, events)
+    footprints = eventFootprints(events)
+
+    if footprints is None:
+        # SQL statement to insert event data
+        insert_query = f"""
+        INSERT INTO {tableName} (
+            eventType, eventTime, minLatitude, maxLatitude, minLongitude, maxLongitude,
+            centroidLatitude, centroidLongitude, maxEventValue, meanEventValue, eventArea, threshold
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """
+
+        # Execute the batch insert
+        connection.executemany(insert_query, event_data)
+    else:
+        firstId = connection.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {tableName}").fetchone()[0]
+        ids = range(firstId, firstId + len(event_data))
+
+        connection.executemany(f"""
+        INSERT INTO {tableName} (
+            id, eventType, eventTime, minLatitude, maxLatitude, minLongitude, maxLongitude,
+            centroidLatitude, centroidLongitude, maxEventValue, meanEventValue, eventArea, threshold
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+        """, [(eventId, *row) for eventId, row in zip(ids, event_data)])
+        connection.executemany(f"INSERT INTO {footprintTableName} (eventId, footprint) VALUES (?, ?)",
+                               [(eventId, sqlite3.Binary(footprint)) for eventId, footprint in zip(ids, footprints)])
+    return len(event_data)
+
+
 def resultDatabaseRecordsToDataframe(records):
     """
-    Converts records from the result database into a dataframe. Also changes eventTime to datetime format.
+    Converts records from the result database into a dataframe. Also changes eventTime from seconds since the epoch
+    to datetime format.
     :param records: Records from the result database
     :return: A dataframe containing the records.
     """
     df =  pd.DataFrame(records, columns=["id", "eventType", "eventTime", "minLatitude", "maxLatitude", "minLongitude", "maxLongitude",
-                                        "centroidLatitude", "centroidLongitude", "maxEventValue", "meanEventValue", "eventArea"])
-    df["eventTime"] = pd.to_datetime(df["eventTime"])
+                                        "centroidLatitude", "centroidLongitude", "maxEventValue", "meanEventValue", "eventArea",
+                                        "threshold"])
+    df["eventTime"] = epochSecondsToDatetime(df["eventTime"])
     return df
@@ -0,0 +1,130 @@
+import glob
+import os
+import uuid
+import pandas as pd
+from databaseFunctions import eventRows
+from src.utils.eventTimes import epochSeconds, epochSecondsToDatetime
+from src.config import EVENT_STORE_FOLDER, EVENT_STORE_FILE_ROWS
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    # Optional, only needed for the columnar event store
+    pa = None
+
+# Columns of the files, as in the result table. The event type and year are the partitions of the dataset.
+EVENT_SCHEMA = None if pa is None else pa.schema([
+    ("eventTime", pa.timestamp("ns")),
+    ("minLatitude", pa.float64()),
+    ("maxLatitude", pa.float64()),
+    ("minLongitude", pa.float64()),
+    ("maxLongitude", pa.float64()),
+    ("centroidLatitude", pa.float64()),
+    ("centroidLongitude", pa.float64()),
+    ("maxEventValue", pa.float64()),
+    ("meanEventValue", pa.float64()),
+    ("eventArea", pa.int64()),
+    ("threshold", pa.float64()),
+])
+
+
+def eventTable(eventType, events):
+    """
+    Converts events into an arrow table of the event store.
+    :param eventType: The event type of the events
+    :param events: A list of event dicts or columnar events (dict of arrays) as returned by getConnectedEvents
+    :return: A pyarrow Table with the columns of EVENT_SCHEMA
+    """
+    frame = pd.DataFrame(eventRows(eventType, events), columns=["eventType"] + EVENT_SCHEMA.names)
+    frame["eventTime"] = epochSecondsToDatetime(frame["eventTime"])
+    return pa.Table.from_pandas(frame.drop(columns="eventType"), schema=EVENT_SCHEMA, preserve_index=False)
+
+
+def writeTable(table, path):
+    # Written under a hidden name first, which readers of the dataset skip
+    temporaryPath = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, temporaryPath)
+    os.replace(temporaryPath, path)
+
+
+class EventStore:
+    """
+    Parquet dataset of the slice events, partitioned by event type and year (eventType=rainDaily/year=2010/). Every
+    writer writes its own files, so writers on different nodes don't wait for each other. Inserted events are
+    buffered and written as one file per partition, sorted by time. The ResultWriter flushes the buffer before it
+    stores the progress of a file, so the stored progress never gets ahead of the events in the store.
+    """
+
+    def __init__(self, folder = EVENT_STORE_FOLDER, maxRows = EVENT_STORE_FILE_ROWS):
+        """
+        :param folder: Folder of the dataset. Default: EVENT_STORE_FOLDER specified in config
+        :param maxRows: Number of buffered events that are written at once. Default: EVENT_STORE_FILE_ROWS
+        specified in config
+        """
+        if pa is None:
+            raise ImportError("The event store needs pyarrow, install it with the parquet extra")
+        self.folder = folder
+        self.maxRows = maxRows
+        self.name = uuid.uuid4().hex[:12]
+        self.files = 0
+        self.pending = {}
+        self.rows = 0
+
+    def partitionFolder(self, eventType, year):
+        return os.path.join(self.folder, f"eventType={eventType}", f"year={year}")
+
+    def insertEvents(self, eventType, events):
+        table = eventTable(eventType, events)
+        if table.num_rows == 0:
+            return
+        years = pc.year(table["eventTime"])
+        for year in pc.unique(years).to_pylist():
+            self.pending.setdefault((eventType, year), []).append(table.filter(pc.equal(years, year)))
+        self.rows += table.num_rows
+        if self.rows >= self.maxRows:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered events, one file per partition.
+        """
+        for (eventType, year), tables in self.pending.items():
+            folder = self.partitionFolder(eventType, year)
+            os.makedirs(folder, exist_ok=True)
+            self.files += 1
+            writeTable(pa.concat_tables(tables).sort_by("eventTime"),
+                       os.path.join(folder, f"part-{self.name}-{self.files:06d}.parquet"))
+        self.pending = {}
+        self.rows = 0
+
+    def deleteEvents(self, eventTypes, startTime, endTime, spatioTemporalStartTime = None):
+        """
+        Deletes the events of the given types that occurred from startTime to endTime, like deleteEventsInTimeRange,
+        from the files of all writers. Files without any other events are removed, the others are rewritten.
+        :param spatioTemporalStartTime: Ignored, the store has no events across time and space
+        :return: The number of deleted events
+        """
+        self.flush()
+        if startTime is None:
+            return 0
+        start, end = epochSecondsToDatetime([epochSeconds(startTime), epochSeconds(endTime)])
+        years = range(start.astype("datetime64[Y]").astype(int) + 1970, end.astype("datetime64[Y]").astype(int) + 1971)
+        start = pa.scalar(start, pa.timestamp("ns"))
+        end = pa.scalar(end, pa.timestamp("ns"))
+
+        deleted = 0
+        for eventType in eventTypes:
+            for year in years:
+                for path in sorted(glob.glob(os.path.join(self.partitionFolder(eventType, year), "*.parquet"))):
+                    times = pq.ParquetFile(path).read(columns=["eventTime"])["eventTime"]
+                    keep = pc.or_(pc.less(times, start), pc.greater(times, end))
+                    numKept = pc.sum(keep).as_py() or 0
+                    if numKept == len(times):
+                        continue
+                    deleted += len(times) - numKept
+                    if numKept == 0:
+                        os.remove(path)
+                    else:
+                        writeTable(pq.ParquetFile(path).read().filter(keep), path)
+        return deleted
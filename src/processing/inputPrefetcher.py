@@ -0,0 +1,185 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from src.config import PREFETCH_MODE, PREFETCH_MEMORY_BYTES, PREFETCH_DISK_BYTES, PREFETCH_SCRATCH_FOLDER
+
+# Bytes read or copied at once, the prefetch checks between two blocks if it was cancelled
+BLOCK_SIZE = 16 * 1024**2
+
+
+def inputFiles(path):
+    """
+    Returns the files of an input file or Zarr store with their sizes, in the order they are read ahead. The chunks
+    of a store are sorted by name, so the first time chunks come first.
+    """
+    if os.path.isdir(path):
+        files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    return [(file, os.path.getsize(file)) for file in files]
+
+
+class Prefetch:
+    """
+    Read-ahead of one input file in a background thread.
+    """
+
+    def __init__(self, path, localPath = None, maxBytes = None):
+        """
+        :param path: Path to the input file or Zarr store
+        :param localPath: Path of a local copy. Default: no copy, the file is only read into the page cache
+        :param maxBytes: Number of bytes read into the page cache. Default: the whole file
+        """
+        self.path = path
+        self.localPath = localPath
+        self.maxBytes = maxBytes
+        self.bytesRead = 0
+        self.complete = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="Prefetch", daemon=True)
+
+    def run(self):
+        try:
+            if self.localPath is None:
+                self.readAhead()
+            else:
+                self.copy()
+        except OSError as e:
+            logging.warning("Prefetching %s failed: %s", self.path, str(e))
+
+    def readAhead(self):
+        buffer = memoryview(bytearray(BLOCK_SIZE))
+        for file, _ in inputFiles(self.path):
+            with open(file, "rb", buffering=0) as source:
+                while not self.stopped.is_set() and (self.maxBytes is None or self.bytesRead < self.maxBytes):
+                    count = source.readinto(buffer)
+                    if not count:
+                        break
+                    self.bytesRead += count
+        self.complete = not self.stopped.is_set()
+
+    def copy(self):
+        temporaryPath = f"{self.localPath}.tmp"
+        for file, _ in inputFiles(self.path):
+            target = temporaryPath if file == self.path else os.path.join(temporaryPath,
+                                                                           os.path.relpath(file, self.path))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(file, "rb") as source, open(target, "wb") as destination:
+                for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+                    if self.stopped.is_set():
+                        return
+                    destination.write(block)
+                    self.bytesRead += len(block)
+        os.replace(temporaryPath, self.localPath)
+        self.complete = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def remove(self):
+        """
+        Stops the prefetch and removes its local copy.
+        """
+        self.stop()
+        if self.localPath is not None:
+            for path in (self.localPath, f"{self.localPath}.tmp"):
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+
+
+class InputPrefetcher:
+    """
+    Reads the input files of claimed jobs ahead while other jobs are processed, so their reads overlap with the
+    computations instead of waiting for the shared file system.
+    In "cache" mode, the first memoryBytes of a file are read into the page cache, where the processor finds them.
+    In "scratch" mode, the file is copied to a local scratch folder if it fits into diskBytes next to the other
+    copies, and the processor reads the copy. A copy is removed when its job finished.
+    """
+
+    def __init__(self, mode = PREFETCH_MODE, memoryBytes = PREFETCH_MEMORY_BYTES, diskBytes = PREFETCH_DISK_BYTES,
+                 scratchFolder = PREFETCH_SCRATCH_FOLDER):
+        """
+        :param mode: "off", "cache" or "scratch". Default: PREFETCH_MODE specified in config
+        :param memoryBytes: Bytes of a file read into the page cache. Default: PREFETCH_MEMORY_BYTES specified in config
+        :param diskBytes: Bytes of all local copies. Default: PREFETCH_DISK_BYTES specified in config
+        :param scratchFolder: Folder of the local copies. Default: PREFETCH_SCRATCH_FOLDER specified in config
+        """
+        if mode not in ("off", "cache", "scratch"):
+            raise ValueError(f"Unknown prefetch mode {mode}")
+        self.mode = mode
+        self.memoryBytes = memoryBytes
+        self.diskBytes = diskBytes
+        self.scratchFolder = scratchFolder
+        self.folder = None
+        self.prefetches = {}
+
+    def start(self, job, path):
+        """
+        Starts reading the input of a job ahead.
+        :param job: The job as "year:variable"
+        :param path: Path to the input file or Zarr store
+        """
+        if self.mode == "off" or job in self.prefetches:
+            return
+        localPath = None
+        maxBytes = self.memoryBytes
+        copyBytes = 0
+        if self.mode == "scratch":
+            copyBytes = sum(size for _, size in inputFiles(path))
+            if self.diskUsage() + copyBytes > self.diskBytes:
+                logging.info("Not prefetching %s, %.1f GB don't fit into the scratch folder", job, copyBytes / 1024**3)
+                return
+            if self.folder is None:
+                os.makedirs(self.scratchFolder, exist_ok=True)
+                self.folder = tempfile.mkdtemp(prefix="prefetch-", dir=self.scratchFolder)
+            # The copy keeps the name of the input, which the processors parse the year from
+            localPath = os.path.join(self.folder, os.path.basename(os.path.normpath(path)))
+            maxBytes = None
+        prefetch = Prefetch(path, localPath, maxBytes)
+        self.prefetches[job] = (prefetch, copyBytes)
+        prefetch.start()
+
+    def diskUsage(self):
+        return sum(size for _, size in self.prefetches.values())
+
+    def inputPath(self, job, path):
+        """
+        Returns the path a job reads its input from: the local copy if it is complete, else path. An incomplete
+        prefetch is stopped, so it doesn't compete with the processor for the file system.
+        :param job: The job as "year:variable"
+        :param path: Path to the input file or Zarr store
+        """
+        if job not in self.prefetches:
+            return path
+        prefetch, _ = self.prefetches[job]
+        if prefetch.localPath is not None and prefetch.complete:
+            return prefetch.localPath
+        if not prefetch.complete:
+            logging.info("Prefetch of %s incomplete after %.1f GB", job, prefetch.bytesRead / 1024**3)
+        self.release(job)
+        return path
+
+    def release(self, job):
+        """
+        Stops the prefetch of a job and removes its local copy.
+        """
+        if job in self.prefetches:
+            prefetch, _ = self.prefetches.pop(job)
+            prefetch.remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for job in list(self.prefetches):
+            self.release(job)
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
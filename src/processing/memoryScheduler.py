@@ -0,0 +1,152 @@
+import logging
+import os
+from processing_functions import openProcessingDataset
+from chunkCheckpoint import timestepsPerDay
+from productPipeline import TopNProduct, ThresholdEventsProduct
+from databaseFunctions import readStageMetrics
+from src.config import PROCESSING_MEMORY_BUDGET, PROCESSING_CHUNK_DAYS, TOP_N_MEMORY_BUDGET, EVENT_LABELING_MODE
+
+# Rough peak memory model of a pipeline job, in bytes per grid cell:
+# memory of the interpreter and libraries of a worker
+BASE_BYTES = 512 * 1024**2
+# temporaries of labeling one timestep of a thresholded field: mask, int32 labels of the current and the lower
+# threshold level and per-label statistics
+LABELING_BYTES = 16
+# values and int32 times of one rank of a top N, the accumulator and its checkpoint copy
+TOP_N_BYTES = 2 * (8 + 4)
+# mask and int32 labels of every timestep of a field labeled across time and space
+VOLUME_LABELING_BYTES = 1 + 4
+
+
+def availableMemory():
+    """
+    Returns the memory available to this job in bytes: the memory of the SLURM allocation, else the cgroup limit,
+    else the physical memory of the machine.
+    """
+    if "SLURM_MEM_PER_NODE" in os.environ:
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 1024**2
+    try:
+        with open("/sys/fs/cgroup/memory.max") as limit:
+            value = limit.read().strip()
+            if value != "max":
+                return int(value)
+    except (OSError, ValueError):
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class JobEstimate:
+    """
+    Estimated peak memory of a job, as fixed bytes plus bytes per day of a time chunk, and its estimated runtime.
+    """
+
+    def __init__(self, fixedBytes, bytesPerChunkDay, seconds = None):
+        self.fixedBytes = fixedBytes
+        self.bytesPerChunkDay = bytesPerChunkDay
+        self.seconds = seconds
+
+    def memory(self, chunkDays):
+        return self.fixedBytes + self.bytesPerChunkDay * chunkDays
+
+    def largestChunkDays(self, availableBytes, maxChunkDays = PROCESSING_CHUNK_DAYS):
+        """
+        Returns the longest time chunk of at most maxChunkDays days that fits into availableBytes, or None if not
+        even a chunk of one day fits.
+        """
+        if self.bytesPerChunkDay <= 0:
+            return maxChunkDays if self.fixedBytes <= availableBytes else None
+        chunkDays = min(maxChunkDays, int((availableBytes - self.fixedBytes) // self.bytesPerChunkDay))
+        return chunkDays if chunkDays >= 1 else None
+
+
+def estimateJob(datasetPath, pipeline, labelingMode = EVENT_LABELING_MODE, pastSeconds = None):
+    """
+    Estimates the peak memory of processing a file with a pipeline from the header of the file: the grid, the
+    number of timesteps and the dtypes of the variables the products need.
+    :param datasetPath: Path to the input file or Zarr store
+    :param pipeline: The FilePipeline of the file
+    :param labelingMode: Labeling mode of the threshold events
+    :param pastSeconds: Runtime of earlier files of the variable, see pastRuntimes
+    :return: A JobEstimate
+    """
+    with openProcessingDataset(datasetPath, processingMode="eager") as dataset:
+        if pipeline.prepare is not None:
+            dataset = pipeline.prepare(dataset)
+        nCells = dataset.sizes["latitude"] * dataset.sizes["longitude"]
+        nTimes = dataset.sizes["valid_time"]
+        stepsPerDay = timestepsPerDay(dataset.valid_time.values[:2])
+        fieldNames = [product.field for product in pipeline.products]
+        itemSize = {name: dataset[name].dtype.itemsize for name in pipeline.inputVariables(fieldNames)}
+
+    largestItem = max(itemSize.values(), default=8)
+
+    def fieldBytes(name):
+        # Bytes per cell and timestep of the input file, daily fields have one timestep per day
+        size = itemSize.get(name, largestItem)
+        return size / stepsPerDay if pipeline.isDaily(name) else size
+
+    # Everything held for one timestep of a chunk: inputs, derived fields and labeling temporaries
+    perStep = sum(itemSize.values()) + sum(fieldBytes(name) for name in pipeline.fields)
+    eventProducts = [product for product in pipeline.products if isinstance(product, ThresholdEventsProduct)]
+    if labelingMode in ("slice", "both"):
+        perStep += sum(LABELING_BYTES / (stepsPerDay if pipeline.isDaily(product.field) else 1)
+                       for product in eventProducts)
+    bytesPerChunkDay = perStep * stepsPerDay * nCells
+
+    topNProducts = [product for product in pipeline.products if isinstance(product, TopNProduct)]
+    fixedBytes = BASE_BYTES + len(topNProducts) * 10 * TOP_N_BYTES * nCells
+    if topNProducts:
+        # Merging a chunk into the top N is bounded by the memory budget of the merge
+        fixedBytes += min(TOP_N_MEMORY_BUDGET, 10 * TOP_N_BYTES * nCells * stepsPerDay * PROCESSING_CHUNK_DAYS)
+    if labelingMode in ("spatiotemporal", "both"):
+        # The event fields of the whole year
+        for name in set(product.field for product in eventProducts):
+            fixedBytes += (fieldBytes(name) + VOLUME_LABELING_BYTES) * nTimes * nCells
+
+    return JobEstimate(int(fixedBytes), int(bytesPerChunkDay), pastSeconds)
+
+
+def pastRuntimes(pathToProcessingDB):
+    """
+    Returns the median runtime in seconds of the processed files of every variable, from the recorded stage metrics.
+    """
+    try:
+        metrics = readStageMetrics(pathToProcessingDB)
+    except Exception as e:
+        logging.warning("Reading the processing metrics failed: %s", str(e))
+        return {}
+    files = metrics[metrics["stage"] == "file"]
+    return files.groupby("variable")["wallSeconds"].median().to_dict()
+
+
+class MemoryBudget:
+    """
+    Memory reserved by the running jobs of this process. Jobs are started only if their estimated memory fits
+    into the rest of the budget, with their time chunk shortened if needed.
+    """
+
+    def __init__(self, budgetBytes = PROCESSING_MEMORY_BUDGET):
+        """
+        :param budgetBytes: Memory for all jobs. Default: PROCESSING_MEMORY_BUDGET specified in config, if None
+        80% of availableMemory
+        """
+        self.budgetBytes = int(0.8 * availableMemory()) if budgetBytes is None else int(budgetBytes)
+        self.reserved = {}
+
+    def available(self):
+        return self.budgetBytes - sum(self.reserved.values())
+
+    def fit(self, estimate, maxChunkDays = PROCESSING_CHUNK_DAYS):
+        """
+        Returns the time chunk length in days for a job to fit into the available memory, or None if it doesn't fit.
+        Without an estimate, the job runs with maxChunkDays.
+        """
+        if estimate is None:
+            return maxChunkDays
+        return estimate.largestChunkDays(self.available(), maxChunkDays)
+
+    def reserve(self, job, estimate, chunkDays):
+        self.reserved[job] = 0 if estimate is None else estimate.memory(chunkDays)
+
+    def release(self, job):
+        self.reserved.pop(job, None)
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+import argparse
+from src.processing.databaseFunctions import mergeResultShards, shardDatabasePaths
+from src.config import RESULT_DATABASE, RESULT_SHARD_FOLDER
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merges the result shards written in the \"shards\" write mode into "
+                                                 "the result database and builds its indexes. Run it only while no "
+                                                 "processing job writes to the shards.")
+    parser.add_argument("shards", nargs="*", help="Shards to merge. Default: all shards of the shard folder")
+    parser.add_argument("--folder", default=RESULT_SHARD_FOLDER, help="Shard folder")
+    parser.add_argument("--database", default=RESULT_DATABASE, help="Result database")
+    parser.add_argument("--keep", action="store_true", help="Keep the emptied shards")
+    args = parser.parse_args()
+
+    shards = args.shards or shardDatabasePaths(args.folder)
+    print(f"Merging {len(shards)} shards into {args.database}")
+    merged = mergeResultShards(args.database, shards, removeShards=not args.keep)
+    print(f"Merged {merged} events")
+
+
+if __name__ == "__main__":
+    main()
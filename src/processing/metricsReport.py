@@ -0,0 +1,66 @@
+import sys
+from pathlib import Path
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+import argparse
+import pandas as pd
+from src.processing.databaseFunctions import readStageMetrics
+from src.config import PROCESSING_DATABASE
+
+
+def summarizeFiles(metrics):
+    """
+    Summarizes the throughput of every processed file.
+    :param metrics: Stage metrics as read by readStageMetrics
+    :return: A dataframe with one row per variable and year
+    """
+    files = metrics[metrics["stage"] == "file"].copy()
+    files["readMB"] = files["bytesRead"] / 1024**2
+    files["readMBPerSecond"] = files["readMB"] / files["wallSeconds"]
+    files["eventsPerSecond"] = files["events"] / files["wallSeconds"]
+    files["cpuUtilization"] = files["cpuSeconds"] / files["wallSeconds"]
+    columns = ["variable", "year", "wallSeconds", "cpuSeconds", "cpuUtilization", "peakRssMB", "readMB",
+               "readMBPerSecond", "events", "eventsPerSecond"]
+    return files[columns].sort_values(["variable", "year"]).reset_index(drop=True)
+
+
+def summarizeStages(metrics):
+    """
+    Summarizes where the processing time of every variable goes.
+    :param metrics: Stage metrics as read by readStageMetrics
+    :return: A dataframe with one row per variable and stage, with the share of the stage in the wall time of
+    the files
+    """
+    stages = metrics[metrics["stage"] != "file"].groupby(["variable", "stage"], as_index=False).agg(
+        calls=("calls", "sum"), wallSeconds=("wallSeconds", "sum"), cpuSeconds=("cpuSeconds", "sum"),
+        peakRssMB=("peakRssMB", "max"), bytesRead=("bytesRead", "sum"), events=("events", "sum"))
+    fileSeconds = metrics[metrics["stage"] == "file"].groupby("variable")["wallSeconds"].sum()
+    stages["shareOfFile"] = stages["wallSeconds"] / stages["variable"].map(fileSeconds)
+    return stages.sort_values(["variable", "wallSeconds"], ascending=[True, False]).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarizes the stage metrics recorded while processing files.")
+    parser.add_argument("--database", default=PROCESSING_DATABASE, help="Path to the processing database")
+    parser.add_argument("--variable", help="Only report this variable")
+    parser.add_argument("--stages", action="store_true", help="Also report the time spent per stage")
+    parser.add_argument("--all-runs", action="store_true",
+                        help="Include earlier runs of reprocessed files, not only the latest one")
+    args = parser.parse_args()
+
+    metrics = readStageMetrics(args.database, latestOnly=not args.all_runs)
+    if args.variable:
+        metrics = metrics[metrics["variable"] == args.variable]
+    if metrics.empty:
+        print("No metrics recorded yet")
+        return
+
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.2f}".format):
+        print(summarizeFiles(metrics).to_string(index=False))
+        if args.stages:
+            print()
+            print(summarizeStages(metrics).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
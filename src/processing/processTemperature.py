@@ -1,44 +1,15 @@
-import xarray as xr
-from processing_functions import getExistingTopTen, update_top_n
-from src.config import RESULT_FOLDER
-
-def processTemperature(datasetPath):
-
-    # open dataset
-    temperatureDS = xr.open_dataset(datasetPath)
-
-    # Preprocessing:
-    # - select pressure level
-    # - drop pressure level coordinate and useless number coordinate
-    temperatureDS = temperatureDS.isel(pressure_level = 0).drop_vars(["pressure_level", "number"])
-
-
-    # Get current top 10, if it already exists
-    currentTopTenDS = getExistingTopTen(RESULT_FOLDER, "temperatureHigh")
-
-    # Get top 10 highest values
-    temperatureTop10 = update_top_n(temperatureDS, "t",oldTop10= currentTopTenDS ,highest=True)
-
-    if currentTopTenDS:
-        currentTopTenDS.close()
-
-    # save and close
-    temperatureTop10.to_netcdf(f"{RESULT_FOLDER}/top10temperatureHigh.nc")
-    temperatureTop10.close()
-
-
-    # Get current top 10, if it already exists
-    currentTopTenDS = getExistingTopTen(RESULT_FOLDER, "temperatureLow")
-
-    # Get low 10
-    temperatureLow10 = update_top_n(temperatureDS, "t", oldTop10= currentTopTenDS, highest=False)
-
-    if currentTopTenDS:
-        currentTopTenDS.close()
-
-    # save and close
-    temperatureLow10.to_netcdf(f"{RESULT_FOLDER}/top10temperatureLow.nc")
-    temperatureLow10.close()
-
-
-    temperatureDS.close()
\ No newline at end of file
+from productPipeline import FilePipeline, TopNProduct
+from src.config import EVENT_LABELING_MODE, PROCESSING_CHUNK_DAYS
+
+# Preprocessing: select the pressure level and drop its coordinate
+temperaturePipeline = FilePipeline(
+    "temperature",
+    prepare=lambda dataset: dataset.isel(pressure_level = 0).drop_vars(["pressure_level"]),
+    products=[
+        # Top 10 highest and lowest values of this year, merged into top10temperatureHigh.nc and top10temperatureLow.nc
+        TopNProduct("temperatureHigh", "t", highest=True),
+        TopNProduct("temperatureLow", "t", highest=False),
+    ])
+
+def processTemperature(datasetPath, labelingMode = EVENT_LABELING_MODE, chunkDays = PROCESSING_CHUNK_DAYS):
+    temperaturePipeline.process(datasetPath, labelingMode, chunkDays)
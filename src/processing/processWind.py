@@ -1,38 +1,20 @@
-import xarray as xr
-from processing_functions import getConnectedEvents, getExistingTopTen, update_top_n
-from databaseFunctions import insertEventsIntoDatabase
-from src.config import RESULT_FOLDER, RESULT_DATABASE
 import numpy as np
-
-def processWind(datasetFilepath):
-
-    filename = "wind"
-    # open dataset
-    windDataset = xr.open_dataset(datasetFilepath)
-
-    # Preprocessing:
-    # - combine u and v components to form windspeed
-    # - drop not needed variables: u,v, i10fg and number
-
-    windspeed = np.sqrt(windDataset["u10"]**2 + windDataset["v10"]**2)
-    windDataset["windspeed"] = windspeed
-    windDataset = windDataset.drop_vars(["v10","u10","i10fg", "number"])
-
-    # Get current top 10, if it already exists
-    currentTopTenDS = getExistingTopTen(RESULT_FOLDER, filename)
-
-    # get new top 10
-    windTop10 = update_top_n(windDataset, "windspeed", oldTop10=currentTopTenDS)
-
-    # close old top 10 file
-    if currentTopTenDS:
-       currentTopTenDS.close()
-
-    windTop10.to_netcdf(f"{RESULT_FOLDER}top10{filename}.nc")
-    windTop10.close()
-
-    # threshold beaufort 9
-    windspeedThreshold = getConnectedEvents(windDataset, "windspeed", 20.8)
-    insertEventsIntoDatabase(RESULT_DATABASE, "windspeedDaily", windspeedThreshold)
-
-    windDataset.close()
\ No newline at end of file
+from productPipeline import FilePipeline, Field, TopNProduct, ThresholdEventsProduct
+from src.config import EVENT_LABELING_MODE, PROCESSING_CHUNK_DAYS
+
+# The windspeed is combined from the u and v components once per chunk and used by all products.
+# The file also holds the gusts (i10fg), which products can use without another read of the file.
+windPipeline = FilePipeline(
+    "wind",
+    fields=[
+        Field("windspeed", ["u10", "v10"], lambda u10, v10: np.sqrt(u10**2 + v10**2)),
+    ],
+    products=[
+        # Top 10 of this year, merged into top10wind.nc
+        TopNProduct("wind", "windspeed"),
+        # threshold beaufort 9, levels configured in EVENT_THRESHOLDS
+        ThresholdEventsProduct("windspeedDaily", "windspeed"),
+    ])
+
+def processWind(datasetFilepath, labelingMode = EVENT_LABELING_MODE, chunkDays = PROCESSING_CHUNK_DAYS):
+    windPipeline.process(datasetFilepath, labelingMode, chunkDays)
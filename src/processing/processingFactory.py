@@ -1,11 +1,35 @@
 class ProcessingFactory:
 
     processingFunctions = {}
+    pipelines = {}
 
     @classmethod
     def registerProcessor(cls, variableName, function):
         cls.processingFunctions[variableName] = function
 
+    @classmethod
+    def registerPipeline(cls, pipeline):
+        """
+        Registers the pipeline of a variable as its processor, see productPipeline.
+        """
+        cls.pipelines[pipeline.variable] = pipeline
+        cls.registerProcessor(pipeline.variable, pipeline.process)
+
+    @classmethod
+    def registerProduct(cls, variableName, product):
+        """
+        Adds a product to the pipeline of a variable. It is computed from the same read of the input file as the
+        other products of the variable.
+        """
+        cls.getPipeline(variableName).addProduct(product)
+
+    @classmethod
+    def getPipeline(cls, variableName):
+        pipeline = cls.pipelines.get(variableName)
+        if not pipeline:
+            raise ValueError(f"No pipeline found for variable {variableName}")
+        return pipeline
+
     @classmethod
     def getProcessor(cls, variableName):
         function = cls.processingFunctions.get(variableName)
@@ -15,12 +39,12 @@ class ProcessingFactory:
 
 # Register processors
 
-from processPrecipitation import processPrecipitation
-from processWindgust import processWindgust
-from processTemperature import processTemperature
-from processWind import processWind
+from processPrecipitation import precipitationPipeline
+from processWindgust import windgustPipeline
+from processTemperature import temperaturePipeline
+from processWind import windPipeline
 
-ProcessingFactory.registerProcessor("precipitation", lambda path: processPrecipitation(path))
-ProcessingFactory.registerProcessor("temperature", lambda path: processTemperature(path))
-ProcessingFactory.registerProcessor("wind", lambda path: processWind(path))
-ProcessingFactory.registerProcessor("windgust", lambda path: processWindgust(path))
\ No newline at end of file
+ProcessingFactory.registerPipeline(precipitationPipeline)
+ProcessingFactory.registerPipeline(temperaturePipeline)
+ProcessingFactory.registerPipeline(windPipeline)
+ProcessingFactory.registerPipeline(windgustPipeline)
@@ -1,14 +1,204 @@
+import os
+import shutil
+import dask
 import numpy as np
 import xarray as xr
-from scipy.ndimage import label
+from scipy.ndimage import label, generate_binary_structure
 from xarray import apply_ufunc
+from src.config import PROCESSING_MODE, DASK_TIME_CHUNK, ZARR_TIME_CHUNK, ZARR_SPACE_CHUNK
+from src.utils.footprints import encodeFootprints
+from src.utils.eventTimes import epochSeconds
+try:
+    import zarr
+except ImportError:
+    # Optional, only needed for Zarr input stores
+    zarr = None
+
+# Labeling a box cut out of a slice costs about as much as labeling this many more cells, see labelNestedLevel
+LABEL_CALL_CELLS = 16384
+
+# Approximate number of bytes held per grid cell and candidate row while merging a chunk into the top N
+# (candidate values, their NaN-filled copy and the argpartition indices)
+TOP_N_BYTES_PER_CELL = 32
+
+def mergeTopN(topValues, topTimes, newValues, newTimes, highest = True):
+    """
+    Merges new candidate values into a running top N per spatial point.
 
-def update_top_n(dataset, data_var, time_var="valid_time", oldTop10=None, highest = True, topN=10, ):
+    Parameters
+    ----------
+    topValues : numpy.ndarray
+        Current top values with shape (topN, n_points), NaN where a rank is still empty.
+    topTimes : numpy.ndarray
+        Times corresponding to topValues, same shape. Any dtype (datetime64 or integer offsets).
+    newValues : numpy.ndarray
+        Candidate values with shape (n_time, n_points).
+    newTimes : numpy.ndarray
+        Times of the candidates, either one-dimensional (n_time,) or with shape (n_time, n_points).
+    highest : bool, default True
+        If true, keeps the highest values, if False, the lowest values.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The merged top values and times with shape (topN, n_points), sorted by rank.
+    """
+    topN = topValues.shape[0]
+    N = topValues.shape[1]
+
+    # Combine the current top values with the new data along the time axis
+    all_values = np.concatenate([topValues, newValues], axis=0)
+
+    # Replace NaNs with -infinity or infinity so they are never selected as top values, depending on if high or low values are wanted
+    if(highest):
+        filled_values = np.where(np.isnan(all_values), -np.inf, all_values)
+    else:
+        filled_values = np.where(np.isnan(all_values), np.inf, all_values)
+    del all_values
+
+    # Use np.argpartition to quickly select indices of the top n values per spatial point
+    if(highest):
+        top_indices_unsorted = np.argpartition(-filled_values, kth=topN - 1, axis=0)[:topN, :]
+    else:
+        top_indices_unsorted = np.argpartition(filled_values, kth=topN - 1, axis=0)[:topN, :]
+    col_idx = np.arange(N)[None, :]  # shape: (1, N)
+
+    # Gather the top n (unsorted) values.
+    top_values_unsorted = filled_values[top_indices_unsorted, col_idx]
+
+    # Values tied with the last rank are kept by their earliest time, argpartition would pick any of them and the
+    # result would depend on how the candidates were split into chunks. Missing values aren't ranked by time.
+    if(highest):
+        boundary = top_values_unsorted.min(axis=0)
+    else:
+        boundary = top_values_unsorted.max(axis=0)
+    tied = np.flatnonzero(np.isfinite(boundary) &
+                          ((filled_values == boundary).sum(axis=0) > (top_values_unsorted == boundary).sum(axis=0)))
+    if tied.size > 0:
+        if newTimes.ndim == 1:
+            tiedNewTimes = np.broadcast_to(newTimes[:, None], (newTimes.shape[0], tied.size))
+        else:
+            tiedNewTimes = newTimes[:, tied]
+        tiedTimes = np.concatenate([topTimes[:, tied], tiedNewTimes], axis=0)
+        tiedValues = filled_values[:, tied]
+        top_indices_unsorted[:, tied] = np.lexsort((tiedTimes, -tiedValues if highest else tiedValues), axis=0)[:topN]
+        top_values_unsorted[:, tied] = tiedValues[top_indices_unsorted[:, tied], np.arange(tied.size)[None, :]]
+
+    # Gather the times: indices below topN point into the old top N, the others into the new candidates.
+    # One-dimensional candidate times are indexed directly instead of being repeated for every point.
+    fromOld = top_indices_unsorted < topN
+    oldTimes = topTimes[np.minimum(top_indices_unsorted, topN - 1), col_idx]
+    newIndices = np.maximum(top_indices_unsorted - topN, 0)
+    if newTimes.ndim == 1:
+        candidateTimes = newTimes[newIndices]
+    else:
+        candidateTimes = newTimes[newIndices, col_idx]
+    top_times_unsorted = np.where(fromOld, oldTimes, candidateTimes)
+
+    # Sort the top values in descending or ascending order for each spatial point, equal values by time.
+    # Missing values keep the order of argsort behind them.
+    if(highest):    # descending
+        valueOrder = np.argsort(top_values_unsorted, axis=0)[::-1, :]
+    else:           # ascending
+        valueOrder = np.argsort(top_values_unsorted, axis=0)
+    missingRank = np.empty_like(valueOrder)
+    np.put_along_axis(missingRank, valueOrder, np.arange(topN)[:, None], axis=0)
+    missingRank[np.isfinite(top_values_unsorted)] = 0
+    if(highest):
+        order = np.lexsort((top_times_unsorted, missingRank, -top_values_unsorted), axis=0)
+    else:
+        order = np.lexsort((top_times_unsorted, missingRank, top_values_unsorted), axis=0)
+
+    top_values_sorted = np.take_along_axis(top_values_unsorted, order, axis=0)
+    top_times_sorted = np.take_along_axis(top_times_unsorted, order, axis=0)
+
+    # Convert any -infinity or infinity values back to NaN. Only necessary if the input data contains less than topN timesteps
+    if(highest):
+        top_values_sorted = np.where(top_values_sorted == -np.inf, np.nan, top_values_sorted)
+    else:
+        top_values_sorted = np.where(top_values_sorted == np.inf, np.nan, top_values_sorted)
+
+    return top_values_sorted, top_times_sorted
+
+def topNChunkSize(nPoints, topN, memoryBudget):
+    """
+    Returns the number of timesteps that can be merged into a top N at once without exceeding the memory budget.
+    :param nPoints: Number of spatial points
+    :param topN: Number of top values tracked
+    :param memoryBudget: Memory budget in bytes
+    :return: The number of timesteps per chunk, at least 1
+    """
+    return max(1, int(memoryBudget // (TOP_N_BYTES_PER_CELL * max(1, nPoints))) - topN)
+
+def iterTopNChunks(dataset, data_var, time_var="valid_time", topN=10, timeChunkSize = None, memoryBudget = None):
+    """
+    Iterates over a dataset in chunks along the time axis, yielding the values and times of each chunk in the
+    layout expected by :func:`mergeTopN`. Only one chunk is read at a time.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        Dataset with the data variable of dims (time, latitude, longitude).
+    data_var : str
+        Name of the data variable.
+    time_var : str, default "valid_time"
+        Name of the time variable, one-dimensional or with spatial dims.
+    topN : int, default 10
+        Number of top values tracked, used to derive the chunk size from the memory budget.
+    timeChunkSize : int, optional
+        Number of timesteps per chunk.
+    memoryBudget : int, optional
+        Approximate number of bytes to use for merging one chunk. Used if timeChunkSize is not given.
+        If neither is given, all timesteps are yielded as one chunk.
+
+    Yields
+    ------
+    tuple of numpy.ndarray
+        The chunk values with shape (n_time, n_points) and the chunk times, either one-dimensional (n_time,)
+        or with shape (n_time, n_points) if the time variable has spatial dims.
+    """
+    nPoints = dataset.latitude.size * dataset.longitude.size
+
+    # Determine the time dimension name (assumes dims other than 'latitude' and 'longitude').
+    time_dim = [dim for dim in dataset[data_var].dims if dim not in ['latitude', 'longitude']][0]
+    data = dataset[data_var].transpose(time_dim, 'latitude', 'longitude')
+    nTimes = data.shape[0]
+
+    # If the time variable already contains spatial dims, it is broadcast per chunk.
+    # Otherwise (the default case where the time variable is 1-dimensional), its values are indexed per point while merging.
+    spatialTimes = set(['latitude', 'longitude']).issubset(dataset[time_var].dims)
+    if spatialTimes:
+        times = dataset[time_var].broadcast_like(dataset[data_var]).transpose(time_dim, 'latitude', 'longitude')
+    else:
+        times = dataset[time_var].values.reshape(-1)
+
+    if timeChunkSize is not None:
+        chunkSize = max(1, int(timeChunkSize))
+    elif memoryBudget is not None:
+        chunkSize = topNChunkSize(nPoints, topN, memoryBudget)
+    else:
+        chunkSize = max(1, nTimes)
+
+    for start in range(0, nTimes, chunkSize):
+        chunkValues = data.isel({time_dim: slice(start, start + chunkSize)}).values
+        chunkValues = chunkValues.reshape(chunkValues.shape[0], -1)
+        if spatialTimes:
+            chunkTimes = times.isel({time_dim: slice(start, start + chunkSize)}).values.reshape(chunkValues.shape[0], -1)
+        else:
+            chunkTimes = times[start:start + chunkSize]
+        yield chunkValues, chunkTimes
+
+def update_top_n(dataset, data_var, time_var="valid_time", oldTop10=None, highest = True, topN=10, timeChunkSize = None,
+                 memoryBudget = None):
     """
     Given a dataset and the corresponding data variable data_var, creates or updates a top N of
     highest or lowest values using vectorized operations. Output is a dataset containing the values
     and their corresponding times.
 
+    The dataset is walked in chunks along the time axis, keeping only the running top N values and times per
+    grid cell. Peak memory therefore depends on the chunk size and N, not on the length of the time axis.
+    If neither timeChunkSize nor memoryBudget is given, all timesteps are merged at once.
+
 
     Parameters
     ----------
@@ -29,6 +219,11 @@ def update_top_n(dataset, data_var, time_var="valid_time", oldTop10=None, highes
         If true, returns the 10 highest values, if False, returns the 10 lowest values
     topN : int, default 10
         Number of top values to track.
+    timeChunkSize : int, optional
+        Number of timesteps read and merged at once.
+    memoryBudget : int, optional
+        Approximate number of bytes to use for merging one chunk. Used to derive the chunk size if
+        timeChunkSize is not given.
 
     Returns
     -------
@@ -43,100 +238,25 @@ def update_top_n(dataset, data_var, time_var="valid_time", oldTop10=None, highes
     nlon = dataset.longitude.size
     ranks = np.arange(1, topN + 1)
 
-    # If no old top 10 is provided, create a template with two variables
+    # Retrieve current top 10 values and times, stacked to (n_rank, n_points), or start from an empty top N.
     if oldTop10 is None:
-        top_data = xr.DataArray(
-            np.full((topN, nlat, nlon), np.nan),
-            coords={'rank': ranks, 'latitude': dataset.latitude, 'longitude': dataset.longitude},
-            dims=['rank', 'latitude', 'longitude']
-        )
-        top_time = xr.DataArray(
-            np.full((topN, nlat, nlon), np.datetime64("NaT", "ns")),
-            coords={'rank': ranks, 'latitude': dataset.latitude, 'longitude': dataset.longitude},
-            dims=['rank', 'latitude', 'longitude']
-        )
-        oldTop10 = xr.Dataset({
-            f"top_{data_var}": top_data,
-            f"top_{time_var}": top_time
-        })
-
-    # Stack the spatial dimensions into a single "point" dimension for the data variable
-    stacked_data = dataset[data_var].stack(point=['latitude', 'longitude'])
-
-    # Determine the time dimension name (assumes dims other than 'latitude' and 'longitude').
-    time_dim = [dim for dim in dataset[data_var].dims if dim not in ['latitude', 'longitude']][0]
-
-    # Prepare the time variable so that it has the same (time, point) shape as the data.
-    # If the time variable already contains spatial dims, we broadcast and stack it.
-    # Otherwise (the default case where the time variable is 1-dimensional), we repeat its values across all points.
-    if set(['latitude', 'longitude']).issubset(dataset[time_var].dims):
-        stacked_times = dataset[time_var].broadcast_like(dataset[data_var]).stack(point=['latitude', 'longitude'])
-    else:
-        n_points = stacked_data.shape[1]
-        # Ensure the time variable is 1-D.
-        time_vals = dataset[time_var].values.reshape(-1)
-        # Use np.repeat to create an array of shape (T, n_points)
-        tiled_times = np.repeat(time_vals[:, None], n_points, axis=1)
-        stacked_times = xr.DataArray(
-            tiled_times,
-            dims=(time_dim, 'point'),
-            coords={time_dim: dataset[time_var].values, 'point': stacked_data.point.values}
-        )
-
-    # Convert the stacked DataArrays to NumPy arrays.
-    data_values = stacked_data.values    # shape: (n_time, n_points)
-    time_values = stacked_times.values    # shape: (n_time, n_points)
-
-    # Retrieve current top 10 values and times (both stacked to (n_rank, n_points)).
-    current_values = oldTop10[f"top_{data_var}"].stack(point=['latitude', 'longitude']).values
-    current_times  = oldTop10[f"top_{time_var}"].stack(point=['latitude', 'longitude']).values
-
-    # Combine the current top values with the new data along the time axis
-    all_values = np.concatenate([current_values, data_values], axis=0)
-    all_times  = np.concatenate([current_times, time_values], axis=0)
-
-    # Replace NaNs with -infinity or infinity so they are never selected as top values, depending on if high or low values are wanted
-    if(highest):
-        filled_values = np.where(np.isnan(all_values), -np.inf, all_values)
-    else:
-        filled_values = np.where(np.isnan(all_values), np.inf, all_values)
-
-    T, N = filled_values.shape  # T: total number of rows, N: number of spatial points
-
-    # Use np.argpartition to quickly select indices of the top n values per spatial point
-    if(highest):
-        top_indices_unsorted = np.argpartition(-filled_values, kth=topN - 1, axis=0)[:topN, :]
+        current_values = np.full((topN, nlat * nlon), np.nan)
+        current_times = np.full((topN, nlat * nlon), np.datetime64("NaT", "ns"))
     else:
-        top_indices_unsorted = np.argpartition(filled_values, kth=topN - 1, axis=0)[:topN, :]
-    col_idx = np.arange(N)[None, :]  # shape: (1, N)
+        current_values = oldTop10[f"top_{data_var}"].transpose('rank', 'latitude', 'longitude').values.reshape(topN, -1)
+        current_times = oldTop10[f"top_{time_var}"].transpose('rank', 'latitude', 'longitude').values.reshape(topN, -1)
 
-    # Gather the top n (unsorted) values.
-    top_values_unsorted = filled_values[top_indices_unsorted, col_idx]
-
-    # Sort the top values in descending or ascending order for each spatial point
-    if(highest):    # descending
-        order = np.argsort(top_values_unsorted, axis=0)[::-1, :]
-    else:           # ascending
-        order = np.argsort(top_values_unsorted, axis=0)
-
-    top_indices_sorted = np.take_along_axis(top_indices_unsorted, order, axis=0)
-    top_values_sorted  = np.take_along_axis(top_values_unsorted, order, axis=0)
-    top_times_sorted   = np.take_along_axis(all_times[top_indices_sorted, col_idx], order, axis=0)
-
-    # Convert any -infinity or infinity values back to NaN. Only necessary if the input data contains less than topN timesteps
-    if(highest):
-        top_values_sorted = np.where(top_values_sorted == -np.inf, np.nan, top_values_sorted)
-    else:
-        top_values_sorted = np.where(top_values_sorted == np.inf, np.nan, top_values_sorted)
+    for chunkValues, chunkTimes in iterTopNChunks(dataset, data_var, time_var, topN, timeChunkSize, memoryBudget):
+        current_values, current_times = mergeTopN(current_values, current_times, chunkValues, chunkTimes, highest=highest)
 
     # Reshape the results to unstack the spatial dimensions
     result_data = xr.DataArray(
-        top_values_sorted.reshape(topN, nlat, nlon),
+        current_values.reshape(topN, nlat, nlon),
         dims=['rank', 'latitude', 'longitude'],
         coords={'rank': ranks, 'latitude': dataset.latitude, 'longitude': dataset.longitude}
     )
     result_time = xr.DataArray(
-        top_times_sorted.reshape(topN, nlat, nlon),
+        current_times.reshape(topN, nlat, nlon),
         dims=['rank', 'latitude', 'longitude'],
         coords={'rank': ranks, 'latitude': dataset.latitude, 'longitude': dataset.longitude}
     )
@@ -176,56 +296,616 @@ def getLabeledEvents(mask, latitudeDim = "latitude", longitudeDim = "longitude")
     )
     return labeledEvents
 
-def getConnectedEvents(dataset,variable, threshold, latitudeDim = "latitude", longitudeDim = "longitude", timeDim = "valid_time"):
+def labelVolume(volume_3d, diagonals = True):
+    """
+    Labels connected regions of a (time, latitude, longitude) mask in space and time together, so a region that
+    persists or moves over several timesteps gets a single label.
 
-    allEvents = []
+    Parameters
+    ----------
+    volume_3d : numpy.ndarray
+        Boolean mask with dims (time, latitude, longitude).
+    diagonals : bool, default True
+        If True, cells touching at edges or corners (also across adjacent timesteps) are connected.
+        If False, only face neighbours in space and the same cell in the adjacent timesteps are connected.
 
-    # Create a mask with the threshold
-    mask = dataset[variable] > threshold
+    Returns
+    -------
+    numpy.ndarray
+        Integer labels with the shape of the mask, 0 is background.
+    """
+    if diagonals:
+        event_structure = np.ones((3, 3, 3), dtype=int)
+    else:
+        event_structure = generate_binary_structure(3, 1)
 
-    labeledEvents = getLabeledEvents(mask, latitudeDim=latitudeDim, longitudeDim= longitudeDim)
+    labeled, _ = label(volume_3d, structure=event_structure)
+    return labeled
+
+def getLabeledStatistics(labels, values, latitudes, longitudes, perSlice = True, footprints = False):
+    """
+    Computes the statistics of all labeled events of one or more time slices in a single pass over the label array.
+    Instead of masking the full grid once per label, all labeled cells are gathered once, sorted by their
+    (slice, label) key and reduced segment-wise.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        Integer label array with dims (time, latitude, longitude) or (latitude, longitude). 0 is background, labels
+        are counted per slice as returned by :func:`labelSlice`.
+    values : numpy.ndarray
+        Values of the labeled variable, same shape as labels.
+    latitudes : numpy.ndarray
+        One-dimensional latitude coordinate of the grid.
+    longitudes : numpy.ndarray
+        One-dimensional longitude coordinate of the grid.
+    perSlice : bool, default True
+        If True, labels restart in every slice (2D labeling). If False, labels are unique over the whole array
+        (3D labeling, see :func:`labelVolume`) and an event may span several slices.
+    footprints : bool, default False
+        If True, also encodes the exact cells of every event as a run-length footprint
+        (see :mod:`src.utils.footprints`). Only supported with perSlice=True.
+
+    Returns
+    -------
+    dict
+        Columnar event statistics, one entry per event ordered by slice and label. Contains numpy arrays for
+        "sliceIndex" (first slice of the event), "lastSliceIndex", "peakSliceIndex", "eventID", "minLatitude",
+        "maxLatitude", "minLongitude", "maxLongitude", "centroidLatitude", "centroidLongitude", "maxEventValue",
+        "meanEventValue" and "areaInCells", plus "footprint" if requested.
+    """
+    if footprints and not perSlice:
+        raise ValueError("Footprints are only supported for events labeled per slice")
+
+    labels = np.asarray(labels)
+    values = np.asarray(values)
+
+    if labels.ndim == 2:
+        labels = labels[None, :, :]
+        values = values[None, :, :]
+
+    nSlices, nLat, nLon = labels.shape
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+
+    # Flat indices of all labeled cells in raster order
+    flatLabels = labels.reshape(-1)
+    cellIndices = np.flatnonzero(flatLabels)
+
+    # Key every cell by (slice, label), so labels restarting in every slice stay distinct
+    cellLabels = flatLabels[cellIndices].astype(np.int64)
+    cellSlices = cellIndices // (nLat * nLon)
+    if perSlice:
+        keys = cellSlices * (int(flatLabels.max(initial=0)) + 1) + cellLabels
+    else:
+        keys = cellLabels
+
+    # Sort the cells by key, every event then is a contiguous segment
+    order = np.argsort(keys, kind="stable")
+    sortedKeys = keys[order]
+    sortedCells = cellIndices[order]
+
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sortedKeys)) + 1]) if sortedKeys.size else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, sortedKeys.size))
+
+    # Coordinates and values of the sorted cells
+    cellLatitudes = latitudes[(sortedCells // nLon) % nLat]
+    cellLongitudes = longitudes[sortedCells % nLon]
+    cellValues = values.reshape(-1)[sortedCells].astype(np.float64)
+
+    if starts.size:
+        minLatitude = np.minimum.reduceat(cellLatitudes, starts)
+        maxLatitude = np.maximum.reduceat(cellLatitudes, starts)
+        minLongitude = np.minimum.reduceat(cellLongitudes, starts)
+        maxLongitude = np.maximum.reduceat(cellLongitudes, starts)
+        centroidLatitude = np.add.reduceat(cellLatitudes, starts) / counts
+        centroidLongitude = np.add.reduceat(cellLongitudes, starts) / counts
+        maxEventValue = np.maximum.reduceat(cellValues, starts)
+        meanEventValue = np.add.reduceat(cellValues, starts) / counts
+
+        # First cell of every event that holds the maximum value
+        sortedSlices = sortedCells // (nLat * nLon)
+        isPeak = cellValues == np.repeat(maxEventValue, counts)
+        peakPosition = np.minimum.reduceat(np.where(isPeak, np.arange(sortedCells.size), sortedCells.size), starts)
+        peakSliceIndex = sortedSlices[peakPosition]
+        lastSliceIndex = np.maximum.reduceat(sortedSlices, starts)
+    else:
+        minLatitude = maxLatitude = minLongitude = maxLongitude = np.zeros(0)
+        centroidLatitude = centroidLongitude = maxEventValue = meanEventValue = np.zeros(0)
+        peakSliceIndex = lastSliceIndex = np.zeros(0, dtype=np.int64)
+
+    statistics = {
+        'sliceIndex': sortedCells[starts] // (nLat * nLon),
+        'lastSliceIndex': lastSliceIndex,
+        'peakSliceIndex': peakSliceIndex,
+        'eventID': cellLabels[order][starts],
+        'minLatitude': minLatitude,
+        'maxLatitude': maxLatitude,
+        'minLongitude': minLongitude,
+        'maxLongitude': maxLongitude,
+        'centroidLatitude': centroidLatitude,
+        'centroidLongitude': centroidLongitude,
+        'maxEventValue': maxEventValue,
+        'meanEventValue': meanEventValue,
+        'areaInCells': counts.astype(np.int64)
+    }
+
+    if footprints:
+        # Within an event the cells are in raster order, a run continues while the next cell is its right neighbour
+        cellEvents = np.repeat(np.arange(starts.size), counts)
+        cellRows = (sortedCells // nLon) % nLat
+        cellColumns = sortedCells % nLon
+        newRun = np.ones(sortedCells.size, dtype=bool)
+        newRun[1:] = ((cellEvents[1:] != cellEvents[:-1]) | (cellRows[1:] != cellRows[:-1]) |
+                      (cellColumns[1:] != cellColumns[:-1] + 1))
+        runStarts = np.flatnonzero(newRun)
+        runLengths = np.diff(np.append(runStarts, sortedCells.size))
+        statistics['footprint'] = encodeFootprints(cellEvents[runStarts], cellRows[runStarts], cellColumns[runStarts],
+                                                   runLengths, starts.size, latitudes, longitudes)
+
+    return statistics
+
+def eventColumnsToRecords(eventColumns):
+    """
+    Converts columnar events as returned by :func:`getConnectedEvents` with columnar=True into a list of event dicts.
+    """
+    names = list(eventColumns.keys())
+    columns = [eventColumns[name].tolist() for name in names]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+def maskBoundingBox(mask, box):
+    """
+    Returns the bounding box of all True cells of a mask that was cut out of a larger array.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        Boolean mask with at least one True cell.
+    box : tuple of slice
+        The box the mask was cut out of, one slice with a start per axis.
+
+    Returns
+    -------
+    tuple of slice
+        The bounding box in the coordinates of the larger array.
+    """
+    boundingBox = []
+    for axis, outer in enumerate(box):
+        indices = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        boundingBox.append(slice(outer.start + indices[0], outer.start + indices[-1] + 1))
+    return tuple(boundingBox)
+
+def labelNestedLevel(slice_2d, threshold, lowerLabels, lowerCells, diagonals = True):
+    """
+    Labels the cells of a slice above a threshold, given the labels of the slice for a lower threshold. Every region
+    above the threshold lies inside one region of the lower level, so only the cells above the threshold inside
+    each of these lower regions are labeled, within their bounding box. If the regions are so many that the fixed
+    cost of labeling them one by one outweighs it, the bounding box of all cells above the threshold is labeled at
+    once instead. The labels equal those of labeling the full slice with :func:`labelSlice`.
+
+    Parameters
+    ----------
+    slice_2d : numpy.ndarray
+        Values with dims (latitude, longitude).
+    threshold : float
+        Threshold of this level.
+    lowerLabels : numpy.ndarray
+        Labels of the slice for a lower threshold, with the same connectivity.
+    lowerCells : numpy.ndarray
+        Flat indices of the labeled cells of the lower threshold in ascending order. Only these are compared
+        to the threshold.
+    diagonals : bool, default True
+        Connectivity passed to :func:`labelSlice`.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The int32 labels of this level and the flat indices of its labeled cells.
+    """
+    levelLabels = np.zeros(slice_2d.shape, dtype=np.int32)
+    cells = lowerCells[slice_2d.ravel()[lowerCells] > threshold]
+    if cells.size == 0:
+        return levelLabels, cells
+    above = np.zeros(slice_2d.shape, dtype=bool)
+    above.ravel()[cells] = True
+
+    # Bounding boxes of the cells above the threshold, per lower region and of all of them
+    rows, columns = np.divmod(cells, slice_2d.shape[1])
+    cellRegions = lowerLabels.ravel()[cells]
+    order = np.argsort(cellRegions, kind="stable")
+    regions, starts = np.unique(cellRegions[order], return_index=True)
+    top, bottom = np.minimum.reduceat(rows[order], starts), np.maximum.reduceat(rows[order], starts) + 1
+    left, right = np.minimum.reduceat(columns[order], starts), np.maximum.reduceat(columns[order], starts) + 1
+    regionsCost = int(((bottom - top) * (right - left)).sum()) + LABEL_CALL_CELLS * regions.size
+    box = (slice(rows.min(), rows.max() + 1), slice(columns.min(), columns.max() + 1))
+    if regionsCost >= above[box].size:
+        levelLabels[box] = labelSlice(above[box], diagonals)
+        return levelLabels, cells
+
+    numLabels = 0
+    for region, regionTop, regionBottom, regionLeft, regionRight in zip(regions, top, bottom, left, right):
+        regionBox = (slice(regionTop, regionBottom), slice(regionLeft, regionRight))
+        mask = above[regionBox] & (lowerLabels[regionBox] == region)
+        regionLabels = labelSlice(mask, diagonals)
+        levelLabels[regionBox][mask] = regionLabels[mask] + numLabels
+        numLabels += int(regionLabels.max())
+
+    # labelSlice numbers the regions in the order their first cell is scanned, renumber the regions labeled
+    # one lower region at a time the same way
+    cellLabels = levelLabels.ravel()[cells]
+    regionIds, firstCells = np.unique(cellLabels, return_index=True)
+    renumbered = np.zeros(numLabels + 1, dtype=np.int32)
+    renumbered[regionIds[np.argsort(firstCells)]] = np.arange(1, regionIds.size + 1, dtype=np.int32)
+    levelLabels.ravel()[cells] = renumbered[cellLabels]
+    return levelLabels, cells
+
+def labelNestedThresholds(slice_2d, thresholds, diagonals = True):
+    """
+    Labels a slice for several thresholds at once. The regions above a higher threshold are subsets of the regions
+    above a lower one, so every level only labels the regions of the level below that contain cells above its
+    threshold (see :func:`labelNestedLevel`), and the remaining levels are skipped as soon as a level is empty.
+    The labels equal those of labeling the full slice per threshold with :func:`labelSlice`.
+
+    Parameters
+    ----------
+    slice_2d : numpy.ndarray
+        Values with dims (latitude, longitude).
+    thresholds : list of float
+        Thresholds in ascending order.
+    diagonals : bool, default True
+        Connectivity passed to :func:`labelSlice`.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        One label array per threshold with the shape of the slice.
+    """
+    labels = [np.zeros(slice_2d.shape, dtype=np.int32) for _ in thresholds]
+
+    for level, threshold in enumerate(thresholds):
+        if level == 0:
+            mask = slice_2d > threshold
+            labels[level][:] = labelSlice(mask, diagonals)
+            cells = np.flatnonzero(mask)
+        else:
+            labels[level], cells = labelNestedLevel(slice_2d, threshold, labels[level - 1], cells, diagonals)
+        if cells.size == 0:
+            break
+
+    return labels
+
+def chunkEventStatistics(values, threshold, latitudes, longitudes, start = 0, footprints = False):
+    """
+    Labels every timestep of a chunk that exceeds the threshold(s) and computes the event statistics.
+    The threshold levels are labeled one after the other, only the labels of the current and the level below are
+    held, see :func:`labelNestedLevel`.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values with dims (time, latitude, longitude).
+    threshold : float or list of float
+        Cells strictly above a threshold are part of an event of that threshold level.
+    latitudes : numpy.ndarray
+        One-dimensional latitude coordinate of the grid.
+    longitudes : numpy.ndarray
+        One-dimensional longitude coordinate of the grid.
+    start : int, default 0
+        Index of the first timestep of the chunk, added to the slice indices.
+    footprints : bool, default False
+        If True, adds the "footprint" of every event.
+
+    Returns
+    -------
+    dict
+        Columnar event statistics as returned by :func:`getLabeledStatistics`, without the lifetime columns,
+        plus the "threshold" of every event. Ordered by threshold, slice and label.
+    """
+    values = np.asarray(values)
+    thresholds = np.unique(np.atleast_1d(np.asarray(threshold, dtype=np.float64)))
+
+    levelColumns = []
+    lowerLabels = None
+    # Flat indices of the labeled cells of every slice of the level below
+    cells = [None] * values.shape[0]
+    for levelThreshold in thresholds:
+        labels = np.zeros(values.shape, dtype=np.int32)
+        for idx, slice_2d in enumerate(values):
+            if lowerLabels is None:
+                mask = slice_2d > levelThreshold
+                labels[idx] = labelSlice(mask)
+                cells[idx] = np.flatnonzero(mask)
+            elif cells[idx].size > 0:
+                labels[idx], cells[idx] = labelNestedLevel(slice_2d, levelThreshold, lowerLabels[idx], cells[idx])
+
+        columns = getLabeledStatistics(labels, values, latitudes, longitudes, footprints=footprints)
+        columns['sliceIndex'] = columns['sliceIndex'] + start
+        del columns['lastSliceIndex'], columns['peakSliceIndex']
+        columns['threshold'] = np.full(columns['eventID'].size, levelThreshold)
+        levelColumns.append(columns)
+        lowerLabels = labels
+
+    return {name: np.concatenate([columns[name] for columns in levelColumns]) for name in levelColumns[0]}
+
+def connectedEventColumns(chunkColumns, times, footprints = False):
+    """
+    Combines the event statistics of time chunks from :func:`chunkEventStatistics` into the columnar events
+    returned by :func:`getConnectedEvents`.
+
+    Parameters
+    ----------
+    chunkColumns : list of dict
+        Columnar event statistics of the chunks, with slice indices into times.
+    times : numpy.ndarray
+        Time coordinate of the whole dataset.
+    footprints : bool, default False
+        If the chunk statistics contain footprints.
+
+    Returns
+    -------
+    dict
+        Columnar events ordered by threshold, time and label.
+    """
+    names = ['sliceIndex', 'eventID', 'minLatitude', 'maxLatitude', 'minLongitude', 'maxLongitude',
+             'centroidLatitude', 'centroidLongitude', 'maxEventValue', 'meanEventValue', 'areaInCells', 'threshold']
+    if footprints:
+        names.append('footprint')
+    events = {name: np.concatenate([columns[name] for columns in chunkColumns]) if chunkColumns else np.zeros(0)
+              for name in names}
+
+    # Chunks are ordered by time and by threshold within a chunk, order all events by threshold first
+    order = np.lexsort((events['eventID'], events['sliceIndex'], events['threshold']))
+    events = {name: column[order] for name, column in events.items()}
+
+    # Event times as seconds since the epoch, as the result database stores them
+    sliceIndex = events.pop('sliceIndex').astype(np.int64)
+    events = {'eventTime': epochSeconds(times)[sliceIndex], **events}
+    events['eventID'] = events['eventID'].astype(np.int64)
+    events['areaInCells'] = events['areaInCells'].astype(np.int64)
+
+    return events
+
+def getConnectedEvents(dataset,variable, threshold, latitudeDim = "latitude", longitudeDim = "longitude", timeDim = "valid_time",
+                       timeChunkSize = None, columnar = False, footprints = False):
+    """
+    Labels all connected regions of a dataset variable that exceed the threshold and computes their statistics.
+    If a list of thresholds is given, events of all threshold levels are extracted from one read of the data.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        Dataset containing the variable with dims (time, latitude, longitude).
+    variable : str
+        Name of the variable to threshold.
+    threshold : float or list of float
+        Cells strictly above a threshold are part of an event of that threshold level.
+    timeChunkSize : int, optional
+        Number of timesteps labeled at once. Bounds memory for long time axes, defaults to all timesteps,
+        or to the dask chunks if the dataset is dask backed.
+    columnar : bool, default False
+        If True, returns a dict of numpy arrays (one per event attribute) instead of a list of event dicts.
+    footprints : bool, default False
+        If True, every event also holds its exact cells as run-length "footprint" bytes.
+
+    Returns
+    -------
+    list or dict
+        One record per event, timestep and threshold level with eventTime (seconds since the epoch), eventID,
+        bounding box, centroid, max and mean value, the area in cells and the threshold. Ordered by threshold, time
+        and label.
+    """
+
+    latitudes = dataset[latitudeDim].values
+    longitudes = dataset[longitudeDim].values
+    times = dataset[timeDim].values
+
+    data = dataset[variable].transpose(timeDim, latitudeDim, longitudeDim)
+
+    if data.chunks is not None:
+        # Dask backed: label and reduce all time chunks in parallel on the active dask scheduler.
+        # Each chunk needs the full grid, the results are concatenated in time order as in the eager path.
+        if timeChunkSize is not None:
+            data = data.chunk({timeDim: timeChunkSize})
+        data = data.chunk({latitudeDim: -1, longitudeDim: -1})
+        starts = np.cumsum((0,) + data.chunks[0])[:-1]
+        tasks = [dask.delayed(chunkEventStatistics)(block, threshold, latitudes, longitudes, int(start), footprints)
+                 for block, start in zip(data.data.to_delayed().ravel(), starts)]
+        chunkColumns = list(dask.compute(*tasks))
+    else:
+        nTimes = times.size
+        chunkSize = max(1, nTimes) if timeChunkSize is None else max(1, int(timeChunkSize))
 
-    for idx, t in enumerate(dataset[timeDim]):
+        chunkColumns = []
+        for start in range(0, nTimes, chunkSize):
+            chunk = data.isel({timeDim: slice(start, start + chunkSize)}).values
+            chunkColumns.append(chunkEventStatistics(chunk, threshold, latitudes, longitudes, start, footprints))
 
-        # Get the slice for this timestep
-        labeledSlice = labeledEvents.isel({timeDim : idx})
+    events = connectedEventColumns(chunkColumns, times, footprints)
 
-        # Broadcast latitude and longitude to 2D so they match the grid
-        lat2d = dataset[latitudeDim].broadcast_like(labeledSlice)
-        lon2d = dataset[longitudeDim].broadcast_like(labeledSlice)
+    if columnar:
+        return events
+    return eventColumnsToRecords(events)
 
-        # For each labeled event in this time slice
-        for eventLabel in np.unique(labeledSlice.values):
+def getSpatioTemporalEvents(dataset, variable, threshold, latitudeDim = "latitude", longitudeDim = "longitude", timeDim = "valid_time",
+                            diagonals = True):
+    """
+    Labels the regions exceeding the threshold across time and space together and returns one record per event
+    (e.g. one per storm) instead of one per event and timestep. The whole time axis is labeled at once, so the
+    mask of the full dataset has to fit into memory. If a list of thresholds is given, the data is read once and
+    every higher level is only labeled inside the bounding box of the level below.
 
-            # Ignore 0, this is background
-            if (eventLabel == 0):
-                continue
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        Dataset containing the variable with dims (time, latitude, longitude).
+    variable : str
+        Name of the variable to threshold.
+    threshold : float or list of float
+        Cells strictly above a threshold are part of an event of that threshold level.
+    diagonals : bool, default True
+        Connectivity passed to :func:`labelVolume`.
 
-            eventMask = labeledSlice == eventLabel
+    Returns
+    -------
+    dict
+        Columnar events with "startTime", "endTime", "peakTime" (seconds since the epoch), "durationHours", the
+        bounding box swept over the whole lifetime, centroid, "maxEventValue", "meanEventValue", "areaInCells"
+        (cells over all timesteps), "cellHours" and "threshold". Ordered by threshold and label.
+    """
+    data = dataset[variable].transpose(timeDim, latitudeDim, longitudeDim)
+    values = data.values
+    times = dataset[timeDim].values
+    latitudes = dataset[latitudeDim].values
+    longitudes = dataset[longitudeDim].values
+
+    levelEvents = []
+    box = tuple(slice(0, size) for size in values.shape)
+    for levelThreshold in np.unique(np.atleast_1d(np.asarray(threshold, dtype=np.float64))):
+        mask = values[box] > levelThreshold
+        if not mask.any():
+            break
+
+        labeledEvents = np.zeros(values.shape, dtype=np.int32)
+        labeledEvents[box] = labelVolume(mask, diagonals=diagonals)
+        events = getLabeledStatistics(labeledEvents, values, latitudes, longitudes, perSlice=False)
+        events['threshold'] = np.full(events['eventID'].size, levelThreshold)
+        levelEvents.append(events)
+
+        # The next level can only contain cells inside the bounding box of this level
+        box = maskBoundingBox(mask, box)
+
+    if levelEvents:
+        events = {name: np.concatenate([level[name] for level in levelEvents]) for name in levelEvents[0]}
+    else:
+        events = getLabeledStatistics(np.zeros(values.shape, dtype=np.int32), values, latitudes, longitudes, perSlice=False)
+        events['threshold'] = np.zeros(0)
 
-            # Extract grid cell values that correspond to this event
-            eventLatitudes = lat2d.where(eventMask, drop= True)
-            eventLongitudes = lon2d.where(eventMask, drop = True)
-            eventVariableValues = dataset[variable].isel({timeDim: idx}).where(eventMask, drop = True)
+    # Length of one timestep in hours, inferred from the time axis (hourly if it can't be inferred)
+    if np.issubdtype(times.dtype, np.datetime64) and times.size > 1:
+        stepHours = float(np.median(np.diff(times)) / np.timedelta64(1, "h"))
+    else:
+        stepHours = 1.0
 
-            # Event data to save:
-            eventData = {
-                'eventTime': str(t.values),
-                'eventID': int(eventLabel),
-                'minLatitude': float(eventLatitudes.min().item()),
-                'maxLatitude': float(eventLatitudes.max().item()),
-                'minLongitude': float(eventLongitudes.min().item()),
-                'maxLongitude': float(eventLongitudes.max().item()),
-                'centroidLatitude': float(eventLatitudes.mean().item()),
-                'centroidLongitude': float(eventLongitudes.mean().item()),
-                'maxEventValue': float(eventVariableValues.max().item()),
-                'meanEventValue': float(eventVariableValues.mean().item()),
-                'areaInCells': int(eventMask.sum().item())
-            }
+    startIndex = events.pop('sliceIndex').astype(np.int64)
+    endIndex = events.pop('lastSliceIndex').astype(np.int64)
+    peakIndex = events.pop('peakSliceIndex').astype(np.int64)
+    if np.issubdtype(times.dtype, np.datetime64):
+        durationHours = (times[endIndex] - times[startIndex]) / np.timedelta64(1, "h") + stepHours
+    else:
+        durationHours = (endIndex - startIndex + 1) * stepHours
+
+    seconds = epochSeconds(times)
+    return {
+        'startTime': seconds[startIndex],
+        'endTime': seconds[endIndex],
+        'peakTime': seconds[peakIndex],
+        'durationHours': np.asarray(durationHours, dtype=np.float64),
+        **events,
+        'cellHours': events['areaInCells'] * stepHours
+    }
+
+def splitPrecipitationChunk(totalPrecipitation, precipitationType, rainTypes, snowTypes):
+    """
+    Splits one time chunk of hourly precipitation by precipitation type and sums it up to days, reading every
+    input value once. Equal to masking the hourly data with ptype.isin and coarsening the results to 24 hour sums.
 
-            allEvents.append(eventData)
+    Parameters
+    ----------
+    totalPrecipitation : numpy.ndarray
+        Hourly total precipitation with dims (time, latitude, longitude), the number of timesteps a multiple of 24.
+    precipitationType : numpy.ndarray
+        Hourly precipitation type, same shape as totalPrecipitation.
+    rainTypes : list of int
+        Precipitation types counted as rain.
+    snowTypes : list of int
+        Precipitation types counted as snow.
 
-    return allEvents
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Hourly rain, daily total, daily rain and daily snow precipitation. Missing values count as 0 in the sums.
+    """
+    nTimes = totalPrecipitation.shape[0]
+    if nTimes % 24 != 0:
+        raise ValueError(f"Chunk of {nTimes} hours doesn't consist of whole days")
+    days = (nTimes // 24, 24) + totalPrecipitation.shape[1:]
+
+    rainHourly = np.where(np.isin(precipitationType, rainTypes), totalPrecipitation, 0)
+    dailyTotal = np.nansum(totalPrecipitation.reshape(days), axis=1)
+    dailyRain = np.nansum(rainHourly.reshape(days), axis=1)
+    dailySnow = np.nansum(np.where(np.isin(precipitationType, snowTypes), totalPrecipitation, 0).reshape(days), axis=1)
+    return rainHourly, dailyTotal, dailyRain, dailySnow
+
+def openProcessingDataset(datasetPath, processingMode = PROCESSING_MODE, timeChunk = DASK_TIME_CHUNK):
+    """
+    Opens an input file for processing. In "dask" mode, the dataset is opened lazily with chunks along valid_time,
+    so the following computations run chunk-wise on the dask scheduler. In "eager" mode it is opened without chunks.
+    :param datasetPath: Path to the input file
+    :param processingMode: "eager" or "dask". Default: PROCESSING_MODE specified in config
+    :param timeChunk: Number of timesteps per chunk in dask mode. Default: DASK_TIME_CHUNK specified in config
+    :return: The opened dataset
+    """
+    # Zarr stores are directories ending in .zarr, see convertToZarr
+    engine = "zarr" if isZarrStore(datasetPath) else None
+    if processingMode == "dask":
+        return xr.open_dataset(datasetPath, engine=engine, chunks={"valid_time": timeChunk})
+    elif processingMode == "eager":
+        return xr.open_dataset(datasetPath, engine=engine)
+    else:
+        raise ValueError(f"Unknown processing mode {processingMode}")
+
+def isZarrStore(path):
+    return str(path).rstrip("/").endswith(".zarr")
+
+def processingInputPath(folder, variable, year):
+    """
+    Returns the path of the input of a variable and year: its Zarr store if there is one that is at least as new
+    as the NetCDF file, else the NetCDF file.
+    :param folder: Folder of the inputs
+    :param variable: Variable of the input
+    :param year: Year of the input
+    :return: Path to <variable>_<year>.zarr or <variable>_<year>.nc
+    """
+    netcdfPath = f"{folder}{variable}_{year}.nc"
+    zarrPath = f"{folder}{variable}_{year}.zarr"
+    if not os.path.isdir(zarrPath):
+        return netcdfPath
+    # A store converted before the NetCDF file was merged again is outdated
+    if os.path.exists(netcdfPath) and os.path.getmtime(zarrPath) < os.path.getmtime(netcdfPath):
+        return netcdfPath
+    return zarrPath
+
+def convertToZarr(netcdfPath, zarrPath = None, timeChunk = ZARR_TIME_CHUNK, spaceChunk = ZARR_SPACE_CHUNK):
+    """
+    Converts a merged NetCDF file into a Zarr store chunked along time and space and compressed with the default
+    compressor of zarr. Every chunk is a separate object of the store, so workers reading different time chunks or
+    regions don't contend for one file. The store is written under a temporary name first and moved into place
+    when complete, so processors never open a partial store.
+    :param netcdfPath: Path to the NetCDF file
+    :param zarrPath: Path of the store. Default: netcdfPath with the extension .zarr
+    :param timeChunk: Number of timesteps per chunk. Default: ZARR_TIME_CHUNK specified in config
+    :param spaceChunk: Number of latitudes and longitudes per chunk. Default: ZARR_SPACE_CHUNK specified in config
+    :return: Path of the store
+    """
+    if zarr is None:
+        raise ImportError("Converting inputs to Zarr requires the zarr package")
+    if zarrPath is None:
+        zarrPath = os.path.splitext(netcdfPath)[0] + ".zarr"
+    temporaryPath = f"{zarrPath}.tmp"
+    shutil.rmtree(temporaryPath, ignore_errors=True)
+
+    with xr.open_dataset(netcdfPath, chunks={}) as dataset:
+        chunks = {"valid_time": timeChunk, "latitude": spaceChunk, "longitude": spaceChunk}
+        dataset = dataset.chunk({dim: size for dim, size in chunks.items() if dim in dataset.dims})
+        for variable in dataset.variables.values():
+            # The NetCDF chunking and compression settings don't apply to Zarr, the CF encoding of times does
+            variable.encoding = {key: value for key, value in variable.encoding.items()
+                                 if key in ("units", "calendar", "dtype", "_FillValue", "scale_factor", "add_offset")}
+        dataset.to_zarr(temporaryPath, mode="w")
+
+    shutil.rmtree(zarrPath, ignore_errors=True)
+    os.replace(temporaryPath, zarrPath)
+    return zarrPath
 
 def getExistingTopTen(resultsFolder, varName):
     try:
@@ -2,28 +2,77 @@ import sys
 from pathlib import Path
 project_root = Path(__file__).parent.parent.parent
 sys.path.append(str(project_root))
+import os
+import socket
 import sqlite3
-from databaseFunctions import createProcessingDatabase, createResultDatabase, updateProcessingStatus, updateProcessingDatabase
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from databaseFunctions import createProcessingDatabase, createResultDatabase, updateProcessingDatabase, \
+    createSpatioTemporalTable, createChunkProgressTable, createMetricsTable, addLeaseColumns, claimNextFile, renewLeases, releaseClaim, \
+    countActiveClaims, getClaimingWorkers, releaseAllClaims, updateChunkProgress, shardDatabasePath, shardDatabasePaths, \
+    mergeResultShards
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import logging
-from src.config import PROCESSING_FOLDER, PROCESSING_DATABASE, RESULT_FOLDER, RESULT_DATABASE, MAX_WORKERS_PROCESSING
+from contextlib import nullcontext, contextmanager
+import dask
+from src.config import PROCESSING_FOLDER, PROCESSING_DATABASE, RESULT_FOLDER, RESULT_DATABASE, MAX_WORKERS_PROCESSING, \
+    EVENT_LABELING_MODE, MAX_WORKERS_TOP_N_MERGE, PROCESSING_MODE, DASK_NUM_WORKERS, PROCESSING_EXECUTOR, \
+    PROCESSING_LEASE_SECONDS, RESULT_WRITE_MODE, RESULT_SHARD_FOLDER, WRITE_EVENT_STORE
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the processing runs on a single machine
+    fcntl = None
 from processingFactory import ProcessingFactory
+from topNAccumulator import exportTopNPartials, removeTopNPartial
+from productPipeline import TopNProduct
+from resultSink import getResultSink, initQueueSink, coordinateWrites, useResultSink, ResultWriter
+from stageMetrics import recordFileMetrics
+from samplingProfiler import profileJob
+from processing_functions import processingInputPath
+from memoryScheduler import MemoryBudget, estimateJob, pastRuntimes
+from inputPrefetcher import InputPrefetcher
+from eventStore import EventStore
 
-def processingManager(arguments):
-    logging.info("Processing manager started for %s", arguments)
+def processingManager(arguments, chunkDays = None, filepath = None):
+    """
+    Processes one file and records its status.
+    :param arguments: The file as "year:variable"
+    :param chunkDays: Length of the time chunks in days. Default: the default of the processor
+    :param filepath: Path the input is read from, e.g. a local copy. Default: the input in PROCESSING_FOLDER
+    """
     year,var = arguments.split(":")
-    filepath = f"{PROCESSING_FOLDER}{var}_{year}.nc"
+    if filepath is None:
+        filepath = processingInputPath(PROCESSING_FOLDER, var, year)
+    logging.info("Processing manager started for %s, reading %s", arguments, filepath)
 
+    # Database writes go through the result sink, which sends them to the coordinator in worker processes
+    sink = getResultSink()
     try:
         processor = ProcessingFactory.getProcessor(var)
-        updateProcessingStatus(PROCESSING_DATABASE,year, var, "processing")
-        processor(filepath)
-        updateProcessingStatus(PROCESSING_DATABASE, year, var, "processed")
+        sink.updateStatus(year, var, "processing")
+
+        with recordFileMetrics(year, var) as metrics, profileJob(arguments):
+            if chunkDays is None:
+                processor(filepath)
+            else:
+                processor(filepath, chunkDays=chunkDays)
+
+        sink.updateStatus(year, var, "processed")
+        # The file is complete, a later reprocessing starts from its first chunk
+        sink.updateChunkProgress(year, var, None)
+        if metrics is not None:
+            sink.insertMetrics(year, var, metrics.recordedAt, metrics.rows())
         logging.info("Processing finished for %s", arguments)
     except ValueError as e:
         logging.error("Invalid processing type: %s - Error: %s", arguments, str(e))
+        sink.updateStatus(year, var, "failed")
     except Exception as e:
         logging.exception("Unexpected error while processing %s - %s", arguments, str(e))
+        sink.updateStatus(year, var, "failed")
+    finally:
+        sink.taskDone(arguments)
 
 
 def pack_records(records):
@@ -33,6 +82,281 @@ def pack_records(records):
         arguments.append(retVal)
     return arguments
 
+def getWorkerId():
+    """
+    Returns an id for the claims of this process, unique across the nodes sharing the processing database.
+    """
+    workerId = f"{socket.gethostname()}:{os.getpid()}"
+    if "SLURM_ARRAY_TASK_ID" in os.environ:
+        workerId += f":task{os.environ['SLURM_ARRAY_TASK_ID']}"
+    return workerId
+
+
+def invalidateFile(year, var):
+    """
+    Invalidates the results of a file that changed since it was processed. The top N partials of its year are
+    removed, and its chunk progress is reset to the first chunk, so processing it again deletes its old events
+    before inserting the new ones (see ChunkCheckpoint).
+    """
+    try:
+        pipeline = ProcessingFactory.getPipeline(var)
+    except ValueError:
+        return
+    for product in pipeline.products:
+        if isinstance(product, TopNProduct):
+            removeTopNPartial(RESULT_FOLDER, product.name, year)
+    updateChunkProgress(PROCESSING_DATABASE, year, var, 0)
+
+
+def releaseClaimsOfDeadProcesses():
+    """
+    Releases the claims of crashed or killed processes on this host right away, instead of waiting for their
+    leases to expire. A rerun on the same node then picks up the interrupted files at once.
+    """
+    hostname = socket.gethostname()
+    for workerId in getClaimingWorkers(PROCESSING_DATABASE):
+        host, pid = workerId.split(":")[:2]
+        if host != hostname or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            released = releaseAllClaims(PROCESSING_DATABASE, workerId)
+            logging.warning("Released %d files claimed by the dead process %s", released, workerId)
+        except PermissionError:
+            # The process exists, but belongs to another user
+            pass
+
+
+@contextmanager
+def initializationLock(path):
+    """
+    Holds an exclusive lock on a file next to the processing database, so only one node at a time creates or
+    updates the databases when several array tasks start together, or finalizes the results when they finish together.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+class LeaseHeartbeat:
+    """
+    Renews the leases of all files claimed by a worker in a background thread, until the context is left.
+    A worker that stops renewing, e.g. because its node crashed, loses its files to other workers when the
+    leases expire.
+    """
+
+    def __init__(self, workerId, leaseSeconds = PROCESSING_LEASE_SECONDS, processingDatabase = PROCESSING_DATABASE):
+        self.workerId = workerId
+        self.leaseSeconds = leaseSeconds
+        self.processingDatabase = processingDatabase
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        # Renew three times per lease, so a single slow renewal doesn't lose the claims
+        while not self.stopped.wait(self.leaseSeconds / 3):
+            try:
+                renewLeases(self.processingDatabase, self.workerId, self.leaseSeconds)
+            except sqlite3.Error as e:
+                logging.warning("Renewing the leases of %s failed: %s", self.workerId, str(e))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def estimateFile(year, var, pastSeconds = None):
+    """
+    Estimates the memory of processing a file of the processing folder, see estimateJob.
+    :return: A JobEstimate, or None if the file can't be estimated
+    """
+    try:
+        return estimateJob(processingInputPath(PROCESSING_FOLDER, var, year), ProcessingFactory.getPipeline(var),
+                           EVENT_LABELING_MODE, pastSeconds)
+    except Exception as e:
+        logging.warning("Estimating the memory of %s:%s failed: %s", year, var, str(e))
+        return None
+
+
+def createResultWriter(workerId, writeMode = RESULT_WRITE_MODE, writeEventStore = WRITE_EVENT_STORE):
+    """
+    Creates the result writer of this process. In "shards" mode it writes into the shard of the worker, without
+    indexes, and deletes the events of interrupted files also from the result database and the other shards.
+    :param workerId: Id of the worker, see getWorkerId
+    :param writeMode: "database" or "shards". Default: RESULT_WRITE_MODE specified in config
+    :param writeEventStore: Also write the events into the EventStore. Default: WRITE_EVENT_STORE specified in config
+    """
+    eventStore = EventStore() if writeEventStore else None
+    if writeMode == "database":
+        return ResultWriter(eventStore=eventStore)
+    if writeMode != "shards":
+        raise ValueError(f"Unknown result write mode {writeMode}")
+    shardPath = shardDatabasePath(workerId)
+    os.makedirs(RESULT_SHARD_FOLDER, exist_ok=True)
+    createResultDatabase(shardPath, indexes=False)
+    if EVENT_LABELING_MODE in ("spatiotemporal", "both"):
+        createSpatioTemporalTable(shardPath, indexes=False)
+    logging.info("Writing results to the shard %s", shardPath)
+    return ResultWriter(shardPath, otherDatabases=lambda: [RESULT_DATABASE] + shardDatabasePaths(),
+                        eventStore=eventStore)
+
+
+def useDaskScheduler(numWorkers, processingMode = PROCESSING_MODE):
+    """
+    In dask mode, runs the chunked computations of all files processed by this process on one shared pool of
+    threads. The dask configuration is global to the process, and without a shared pool the threaded scheduler
+    starts a pool of its own for every file processed concurrently.
+    :param numWorkers: Number of threads of the pool
+    :param processingMode: "eager" or "dask", nothing is set up in eager mode
+    """
+    if processingMode == "dask":
+        dask.config.set(scheduler="threads", pool=ThreadPoolExecutor(max_workers=max(1, numWorkers)))
+
+
+def initWorkerProcess(writeQueue, daskWorkers):
+    """
+    Initializer of the worker processes, which send their writes to the coordinator and share the cores of the
+    node for their dask computations.
+    :param writeQueue: Queue to the coordinator
+    :param daskWorkers: Number of dask threads of this worker process
+    """
+    initQueueSink(writeQueue)
+    useDaskScheduler(daskWorkers)
+
+
+def processClaimedFiles(workerId, maxWorkers = MAX_WORKERS_PROCESSING, executor = PROCESSING_EXECUTOR,
+                        leaseSeconds = PROCESSING_LEASE_SECONDS):
+    """
+    Claims files from the processing table and processes them, until no claimable file is left. Any number of
+    processes on any number of nodes can run this on the same processing database, every file is processed by
+    the worker holding its claim. Each file is claimed at most once by this worker, a failed file is left to
+    the next run.
+    With the "process" executor, workers send their events and status updates over a queue to the coordinator in
+    this process, which is the only writer of the result and processing database of this node.
+    Top N partials are separate files per variable and year and are merged by main after all workers finished.
+    A file is only started if its estimated memory fits into the MemoryBudget next to the running files, with
+    shorter time chunks if needed. Files that don't fit are left to other workers or claimed again after a running
+    file finished. Variables whose files took longest in earlier runs are claimed first.
+    While all workers are busy, one more file is claimed and its input read ahead by an InputPrefetcher, so it
+    starts from the page cache or a local copy once a worker is free.
+    :param workerId: Id of the claims, see getWorkerId
+    :param maxWorkers: Maximum number of files processed concurrently
+    :param executor: "thread" or "process"
+    :param leaseSeconds: Duration of the leases, renewed by a LeaseHeartbeat
+    :return: The number of files this worker processed
+    """
+    if executor == "process":
+        context = multiprocessing.get_context()
+        # Bounded, so workers wait for the coordinator instead of piling up events in memory
+        writeQueue = context.Queue(maxsize=4 * maxWorkers)
+        # The pool of the parent isn't usable after a fork, every worker process sets up its own share of the cores
+        pool = ProcessPoolExecutor(max_workers=maxWorkers, mp_context=context, initializer=initWorkerProcess,
+                                   initargs=(writeQueue, DASK_NUM_WORKERS // maxWorkers))
+    else:
+        pool = ThreadPoolExecutor(max_workers=maxWorkers)
+
+    budget = MemoryBudget()
+    runtimes = pastRuntimes(PROCESSING_DATABASE)
+    claimed = set()
+    # Files that didn't fit into the memory left by the running files
+    deferred = set()
+    # Claimed file whose input is read ahead, it is started next
+    lookahead = None
+    tasks = {}
+    poolBroken = False
+    # All writes go through one result writer. Thread workers use it as their sink, the writes of process workers
+    # reach it through the coordinator.
+    writer = createResultWriter(workerId)
+    workerSink = useResultSink(writer) if executor != "process" else nullcontext()
+    with writer, workerSink, pool, LeaseHeartbeat(workerId, leaseSeconds), InputPrefetcher() as prefetcher:
+        while True:
+            while not poolBroken and len(tasks) < maxWorkers:
+                if lookahead is not None:
+                    claim, lookahead = lookahead, None
+                else:
+                    claim = claimNextFile(PROCESSING_DATABASE, workerId, leaseSeconds, excluded=claimed | deferred,
+                                          runtimes=runtimes)
+                if claim is None:
+                    break
+                argument = pack_records([claim])[0]
+                year, var = claim
+
+                estimate = estimateFile(year, var, runtimes.get(var))
+                chunkDays = budget.fit(estimate)
+                if chunkDays is None and tasks:
+                    releaseClaim(PROCESSING_DATABASE, year, var, workerId)
+                    prefetcher.release(argument)
+                    deferred.add(claim)
+                    continue
+                if chunkDays is None:
+                    logging.warning("%s needs more memory than the budget of %.1f GB, processing it with chunks of "
+                                    "one day", argument, budget.budgetBytes / 1024**3)
+                    chunkDays = 1
+                if estimate is not None:
+                    logging.info("Starting %s with chunks of %d days, estimated memory %.1f GB, estimated runtime %s s",
+                                 argument, chunkDays, estimate.memory(chunkDays) / 1024**3, estimate.seconds)
+
+                claimed.add(claim)
+                budget.reserve(argument, estimate, chunkDays)
+                filepath = prefetcher.inputPath(argument, processingInputPath(PROCESSING_FOLDER, var, year))
+                try:
+                    tasks[argument] = pool.submit(processingManager, argument, chunkDays, filepath)
+                except BrokenProcessPool:
+                    # A killed worker breaks the pool, the remaining files are left to the other workers
+                    logging.error("Process pool is broken, not claiming more files")
+                    releaseClaim(PROCESSING_DATABASE, *claim, workerId)
+                    budget.release(argument)
+                    prefetcher.release(argument)
+                    poolBroken = True
+
+            if not poolBroken and prefetcher.mode != "off" and lookahead is None and len(tasks) == maxWorkers:
+                lookahead = claimNextFile(PROCESSING_DATABASE, workerId, leaseSeconds, excluded=claimed | deferred,
+                                          runtimes=runtimes)
+                if lookahead is not None:
+                    year, var = lookahead
+                    prefetcher.start(pack_records([lookahead])[0], processingInputPath(PROCESSING_FOLDER, var, year))
+            if not tasks:
+                break
+
+            if executor == "process":
+                doneTasks, diedTasks = coordinateWrites(writeQueue, writer, tasks, returnWhenAny=True)
+            else:
+                done, _ = wait(tasks.values(), return_when=FIRST_COMPLETED)
+                doneTasks, diedTasks = set(argument for argument, future in tasks.items() if future in done), set()
+
+            for argument in diedTasks:
+                year, var = argument.split(":")
+                logging.error("Worker process for %s died: %s", argument, tasks[argument].exception())
+                writer.updateStatus(year, var, "failed")
+            # A file is only released once its results are stored
+            writer.flush()
+            for argument in doneTasks | diedTasks:
+                year, var = argument.split(":")
+                releaseClaim(PROCESSING_DATABASE, year, var, workerId)
+                budget.release(argument)
+                prefetcher.release(argument)
+                del tasks[argument]
+            # The memory of the finished files may fit the deferred ones now
+            deferred.clear()
+
+        if lookahead is not None:
+            # The pool broke before the file read ahead was started
+            releaseClaim(PROCESSING_DATABASE, *lookahead, workerId)
+
+    return len(claimed)
+
+
 def main():
     # Initialize logging
     logging.basicConfig(
@@ -47,34 +371,58 @@ def main():
     logging.info(f"Result folder: {RESULT_FOLDER}")
     logging.info(f"Result db: {RESULT_DATABASE}")
 
-    # establish sql connection to database
-    connection = sqlite3.connect(PROCESSING_DATABASE)
-    cursor = connection.cursor()
-
-    exists = cursor.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'processing')").fetchone()[0]
-    if exists == 0:
-        logging.info("Processing database does not exist yet. Creating it...")
-        createProcessingDatabase(PROCESSING_FOLDER, PROCESSING_DATABASE)
-    else:
-        logging.info("Processing database table already exists. Updating records for new .nc files.")
-        numNewFiles = updateProcessingDatabase(PROCESSING_FOLDER, PROCESSING_DATABASE)
-        logging.info(f"{numNewFiles} added to processing database.")
-
-    # get everything that has either not been done yet or failed
-    res = cursor.execute(f"SELECT year,variable FROM processing WHERE NOT status = 'processed' ORDER BY year DESC")
-    records = res.fetchall()
+    # Array tasks starting together would all create the databases, one after the other updates them instead
+    with initializationLock(f"{PROCESSING_DATABASE}.lock"):
+        connection = sqlite3.connect(PROCESSING_DATABASE)
+        exists = connection.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'processing')").fetchone()[0]
+        connection.close()
+        if exists == 0:
+            logging.info("Processing database does not exist yet. Creating it...")
+            createProcessingDatabase(PROCESSING_FOLDER, PROCESSING_DATABASE)
+        else:
+            logging.info("Processing database table already exists. Updating records for new input files.")
+            addLeaseColumns(PROCESSING_DATABASE)
+            changedFiles = []
+            numNewFiles = updateProcessingDatabase(PROCESSING_FOLDER, PROCESSING_DATABASE, changedFiles=changedFiles)
+            logging.info(f"{numNewFiles} added to processing database.")
+            for var, year in changedFiles:
+                logging.info("%s_%d changed since it was processed, processing it again.", var, year)
+                invalidateFile(year, var)
 
-    cursor.close()
-    connection.close()
+        createChunkProgressTable(PROCESSING_DATABASE)
+        createMetricsTable(PROCESSING_DATABASE)
+        createResultDatabase(RESULT_DATABASE)
+        if EVENT_LABELING_MODE in ("spatiotemporal", "both"):
+            createSpatioTemporalTable(RESULT_DATABASE)
+        releaseClaimsOfDeadProcesses()
 
-    arguments = pack_records(records)
-    createResultDatabase(RESULT_DATABASE)
+    # Files are claimed one at a time from everything that has either not been done yet or failed,
+    # so any number of nodes can process the same processing database
+    workerId = getWorkerId()
+    # Thread workers share one dask pool, set up once instead of per file
+    useDaskScheduler(DASK_NUM_WORKERS)
+    logging.info("Starting parallel processing with %d %s workers as %s.", MAX_WORKERS_PROCESSING,
+                 PROCESSING_EXECUTOR, workerId)
+    numFiles = processClaimedFiles(workerId, MAX_WORKERS_PROCESSING, PROCESSING_EXECUTOR)
+    logging.info("Processed %d files.", numFiles)
 
+    # Only the last node to finish exports, the others would merge incomplete partials. The check is done under the
+    # lock, so nodes finishing together merge the shards and write the top10*.nc files one after the other instead
+    # of concurrently. A node finalizing after another one finds no shards left to merge.
+    with initializationLock(f"{PROCESSING_DATABASE}.lock"):
+        activeClaims = countActiveClaims(PROCESSING_DATABASE)
+        if activeClaims > 0:
+            logging.info("%d files are still processed by other workers, leaving the top N export to them.",
+                         activeClaims)
+            return
 
-    logging.info("Starting parallel processing with %d workers.", MAX_WORKERS_PROCESSING)
+        if RESULT_WRITE_MODE == "shards":
+            merged = mergeResultShards(RESULT_DATABASE, shardDatabasePaths())
+            logging.info("Merged %d events of the result shards into %s", merged, RESULT_DATABASE)
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS_PROCESSING) as executor:
-        executor.map(processingManager, arguments)
+        # Merge the per-year top N partials into their top10*.nc files
+        exportedTopN = exportTopNPartials(RESULT_FOLDER, MAX_WORKERS_TOP_N_MERGE)
+        logging.info("Exported top N files: %s", exportedTopN)
     logging.info("Processing completed successfully.")
 
 if __name__ == "__main__":
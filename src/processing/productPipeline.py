@@ -0,0 +1,245 @@
+import os
+import dask
+import numpy as np
+import xarray as xr
+from processing_functions import openProcessingDataset
+from topNAccumulator import TopNAccumulator
+from databaseFunctions import splitFilename
+from chunkCheckpoint import ChunkCheckpoint
+from thresholdEvents import processThresholdEvents, processChunkThresholdEvents
+from stageMetrics import stage
+from src.config import EVENT_THRESHOLDS, EVENT_LABELING_MODE, PROCESSING_CHUNK_DAYS, PROCESSING_MODE, RESULT_FOLDER, \
+    PROCESSING_DATABASE
+
+# A processor is a pipeline of one input file: the fields it derives from the variables of the file and the
+# products computed from them. The pipeline reads every time chunk of the file once, computes every field needed by
+# any product once, and hands it to all products. A new product of an existing file is one more consumer of the
+# chunks, not one more read of the file.
+
+
+class Field:
+    """
+    A field computed from variables of the input file or from other fields, one time chunk at a time.
+    """
+
+    def __init__(self, name, inputs, compute, daily = False, stageName = "derive"):
+        """
+        :param name: Name of the field, used by products and other fields
+        :param inputs: Names of the variables of the input file or of the fields the field is computed from
+        :param compute: Function computing the field of a chunk from the chunks of the inputs, in the order of inputs
+        :param daily: If the field has one timestep per day instead of one per timestep of the input file
+        :param stageName: Name of the computation in the stage metrics
+        """
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+        self.daily = daily
+        self.stageName = stageName
+
+
+class TopNProduct:
+    """
+    The top N of a field, stored as per-year partial and merged into top10{name}.nc at the end of the run.
+    """
+
+    def __init__(self, name, field, dataVar = None, highest = True):
+        """
+        :param name: Name of the top N
+        :param field: Name of the ranked field or input variable
+        :param dataVar: Name of the variable in the top N file. Default: the name of the field
+        :param highest: If the highest (True) or lowest (False) values are kept
+        """
+        self.name = name
+        self.field = field
+        self.dataVar = field if dataVar is None else dataVar
+        self.highest = highest
+
+
+class ThresholdEventsProduct:
+    """
+    The connected events of a field exceeding the thresholds configured for the event type in EVENT_THRESHOLDS.
+    """
+
+    def __init__(self, eventType, field):
+        """
+        :param eventType: Event type stored with the events
+        :param field: Name of the thresholded field or input variable
+        """
+        self.eventType = eventType
+        self.field = field
+
+
+class ChunkFields:
+    """
+    The input variables and fields of one time chunk. Everything is read or computed on first use only.
+    In "eager" mode they are numpy arrays. In "dask" mode they stay dask arrays, whose dask chunks are read and
+    computed in parallel on the dask scheduler and kept in memory, so every product labels and ranks them per dask
+    chunk in parallel as well.
+    """
+
+    def __init__(self, pipeline, dataset, start, stop, processingMode = PROCESSING_MODE):
+        self.pipeline = pipeline
+        self.dataset = dataset
+        self.start = start
+        self.stop = stop
+        self.processingMode = processingMode
+        self.values = {}
+
+    def get(self, name):
+        if name not in self.values:
+            field = self.pipeline.fields.get(name)
+            if field is None:
+                with stage("read"):
+                    variable = self.dataset[name].isel(valid_time = slice(self.start, self.stop)) \
+                        .transpose("valid_time", "latitude", "longitude")
+                    if self.processingMode == "dask":
+                        self.values[name] = dask.persist(variable.data)[0]
+                    else:
+                        self.values[name] = variable.values
+            else:
+                inputs = [self.get(inputName) for inputName in field.inputs]
+                with stage(field.stageName):
+                    values = field.compute(*inputs)
+                    # Kept in memory, so the products using the field don't compute it again
+                    self.values[name] = dask.persist(values)[0] if self.processingMode == "dask" else values
+        return self.values[name]
+
+    def timeSlice(self, name):
+        """
+        Returns the timesteps of a field in this chunk as a slice of the time coordinate of the field.
+        """
+        if self.pipeline.isDaily(name):
+            return slice(self.start // 24, self.stop // 24)
+        return slice(self.start, self.stop)
+
+
+class FilePipeline:
+    """
+    The fields and products of the files of one variable, see the module comment.
+    """
+
+    def __init__(self, variable, fields = (), products = (), prepare = None):
+        """
+        :param variable: Variable of the input files, as in the processing database
+        :param fields: The fields derived from the variables of the file
+        :param products: TopNProducts and ThresholdEventsProducts
+        :param prepare: Function preparing the opened dataset, e.g. selecting a pressure level
+        """
+        self.variable = variable
+        self.fields = {field.name: field for field in fields}
+        self.products = []
+        self.prepare = prepare
+        for product in products:
+            self.addProduct(product)
+
+    def addProduct(self, product):
+        if any(productKey(other) == productKey(product) for other in self.products):
+            raise ValueError(f"The {self.variable} pipeline already has the product {productKey(product)}")
+        self.products.append(product)
+
+    def isDaily(self, name):
+        field = self.fields.get(name)
+        return field is not None and (field.daily or any(self.isDaily(inputName) for inputName in field.inputs))
+
+    def inputVariables(self, names):
+        """
+        Returns the variables of the input file the given fields are computed from.
+        """
+        variables = set()
+        for name in names:
+            field = self.fields.get(name)
+            variables |= {name} if field is None else self.inputVariables(field.inputs)
+        return variables
+
+    def process(self, datasetPath, labelingMode = EVENT_LABELING_MODE, chunkDays = PROCESSING_CHUNK_DAYS,
+                processingMode = PROCESSING_MODE, resultFolder = RESULT_FOLDER, processingDatabase = PROCESSING_DATABASE):
+        """
+        Computes all products of one input file. Progress is checkpointed after every chunk, see ChunkCheckpoint.
+        :param datasetPath: Path to the input file
+        :param labelingMode: "slice", "spatiotemporal" or "both", see processThresholdEvents
+        :param chunkDays: Length of a time chunk in days
+        :param processingMode: "eager" or "dask", see ChunkFields. Default: PROCESSING_MODE specified in config
+        :param resultFolder: Folder of the top N partials and resume checkpoints. Default: RESULT_FOLDER
+        :param processingDatabase: Path to the processing database holding the chunk progress.
+        Default: PROCESSING_DATABASE
+        """
+        topNProducts = [product for product in self.products if isinstance(product, TopNProduct)]
+        eventProducts = [product for product in self.products if isinstance(product, ThresholdEventsProduct)]
+        sliceEvents = labelingMode in ("slice", "both")
+        spatioTemporalEvents = labelingMode in ("spatiotemporal", "both")
+
+        with stage("open"):
+            dataset = openProcessingDataset(datasetPath, processingMode)
+            _, year = splitFilename(os.path.basename(datasetPath))
+            if self.prepare is not None:
+                dataset = self.prepare(dataset)
+
+            missing = self.inputVariables(product.field for product in self.products) - set(dataset.data_vars)
+            if missing:
+                raise ValueError(f"{datasetPath} is missing the variables {sorted(missing)}")
+
+            latitudes = dataset.latitude.values
+            longitudes = dataset.longitude.values
+            times = {False: dataset.valid_time.values}
+            if any(self.isDaily(product.field) for product in self.products):
+                # Timestamps of the daily fields, as coarsening to 24 hour intervals assigns them
+                times[True] = dataset.valid_time.coarsen(valid_time = 24).mean().values
+
+        # Resumes at the first unfinished chunk if processing the file was interrupted
+        checkpoint = ChunkCheckpoint(self.variable, year, times[False], [product.eventType for product in eventProducts],
+                                     {product.name: TopNAccumulator(latitudes, longitudes, product.dataVar,
+                                                                    highest=product.highest)
+                                      for product in topNProducts},
+                                     resultFolder, processingDatabase)
+
+        # Events across time and space need the fields of the whole year, also of the chunks an interrupted run
+        # already finished
+        wholeYear = {product.field: None for product in eventProducts} if spatioTemporalEvents else {}
+
+        for start, stop in checkpoint.chunks(chunkDays, includeDone = spatioTemporalEvents):
+            chunk = ChunkFields(self, dataset, start, stop, processingMode)
+
+            for name in wholeYear:
+                # Events across time and space are labeled on the whole year at once, which needs it in memory
+                values = np.asarray(chunk.get(name))
+                if wholeYear[name] is None:
+                    wholeYear[name] = np.empty((times[self.isDaily(name)].size,) + values.shape[1:], values.dtype)
+                wholeYear[name][chunk.timeSlice(name)] = values
+
+            if not checkpoint.pending(start):
+                continue
+
+            for product in topNProducts:
+                fieldTimes = times[self.isDaily(product.field)][chunk.timeSlice(product.field)]
+                checkpoint.updateTopN(product.name, fieldDataset(chunk.get(product.field), product.dataVar, fieldTimes,
+                                                                 latitudes, longitudes), start, stop)
+
+            if sliceEvents:
+                for product in eventProducts:
+                    fieldTimes = times[self.isDaily(product.field)][chunk.timeSlice(product.field)]
+                    processChunkThresholdEvents(chunk.get(product.field), fieldTimes, latitudes, longitudes,
+                                                EVENT_THRESHOLDS[product.eventType], product.eventType)
+
+            checkpoint.commit(stop)
+
+        checkpoint.finish()
+
+        for product in eventProducts if spatioTemporalEvents else []:
+            yearDataset = fieldDataset(wholeYear[product.field], product.field, times[self.isDaily(product.field)],
+                                       latitudes, longitudes)
+            processThresholdEvents(yearDataset, product.field, EVENT_THRESHOLDS[product.eventType], product.eventType,
+                                   "spatiotemporal")
+
+        dataset.close()
+
+
+def productKey(product):
+    # Top N and event types are named independently, e.g. windgustHourly is both
+    if isinstance(product, TopNProduct):
+        return "topN", product.name
+    return "events", product.eventType
+
+
+def fieldDataset(values, name, times, latitudes, longitudes):
+    return xr.Dataset({name: (["valid_time", "latitude", "longitude"], values)},
+                      coords={"valid_time": times, "latitude": latitudes, "longitude": longitudes})
@@ -0,0 +1,384 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from databaseFunctions import insertEventsIntoDatabase, insertSpatioTemporalEventsIntoDatabase, \
+    updateProcessingStatus, updateChunkProgress, deleteEventsInTimeRange, insertStageMetrics, insertEventRows, \
+    insertSpatioTemporalEventRows, deleteEventRows
+from src.config import RESULT_DATABASE, PROCESSING_DATABASE, RESULT_DATABASE_JOURNAL_MODE, RESULT_WRITER_QUEUE_SIZE, \
+    RESULT_WRITER_BATCH_ROWS, RESULT_WRITER_BATCH_SECONDS
+
+# All writes of the processors to the result and processing database go through the result sink of the process.
+# In the main process the sink writes directly. Worker processes of the process pool get a QueueSink, which sends
+# the writes to the coordinator in the main process, the only process writing to the databases.
+
+
+class DatabaseSink:
+    """
+    Writes events and processing status directly into the databases.
+    """
+
+    def __init__(self, resultDatabase = RESULT_DATABASE, processingDatabase = PROCESSING_DATABASE):
+        self.resultDatabase = resultDatabase
+        self.processingDatabase = processingDatabase
+
+    def insertEvents(self, eventType, events):
+        insertEventsIntoDatabase(self.resultDatabase, eventType, events)
+
+    def insertSpatioTemporalEvents(self, eventType, events):
+        insertSpatioTemporalEventsIntoDatabase(self.resultDatabase, eventType, events)
+
+    def updateStatus(self, year, var, status):
+        updateProcessingStatus(self.processingDatabase, year, var, status)
+
+    def updateChunkProgress(self, year, var, nextTimeIndex):
+        updateChunkProgress(self.processingDatabase, year, var, nextTimeIndex)
+
+    def deleteEvents(self, eventTypes, startTime, endTime, spatioTemporalStartTime = None):
+        deleteEventsInTimeRange(self.resultDatabase, eventTypes, startTime, endTime, spatioTemporalStartTime)
+
+    def insertMetrics(self, year, var, recordedAt, rows):
+        insertStageMetrics(self.processingDatabase, year, var, recordedAt, rows)
+
+    def taskDone(self, arguments):
+        pass
+
+
+class QueueSink:
+    """
+    Sends events and processing status to the coordinator, see :func:`coordinateWrites`.
+    """
+
+    def __init__(self, writeQueue):
+        self.writeQueue = writeQueue
+
+    def insertEvents(self, eventType, events):
+        self.writeQueue.put(("insertEvents", (eventType, events)))
+
+    def insertSpatioTemporalEvents(self, eventType, events):
+        self.writeQueue.put(("insertSpatioTemporalEvents", (eventType, events)))
+
+    def updateStatus(self, year, var, status):
+        self.writeQueue.put(("updateStatus", (year, var, status)))
+
+    def updateChunkProgress(self, year, var, nextTimeIndex):
+        self.writeQueue.put(("updateChunkProgress", (year, var, nextTimeIndex)))
+
+    def deleteEvents(self, eventTypes, startTime, endTime, spatioTemporalStartTime = None):
+        self.writeQueue.put(("deleteEvents", (eventTypes, startTime, endTime, spatioTemporalStartTime)))
+
+    def insertMetrics(self, year, var, recordedAt, rows):
+        self.writeQueue.put(("insertMetrics", (year, var, recordedAt, rows)))
+
+    def taskDone(self, arguments):
+        self.writeQueue.put(("taskDone", (arguments,)))
+
+
+class ResultWriter:
+    """
+    Writes events and processing status in a dedicated thread, which owns the connection to the result database.
+    The sink methods only queue the write, so labeling continues while earlier events are written. The queue is
+    bounded: when the writer falls behind, the processors wait for it instead of piling up events in memory.
+    Events are committed in batches of batchRows rows or after batchSeconds. Writes to the processing database
+    (status, chunk progress, metrics) are applied after the events queued before them are committed, so the stored
+    progress of a file never gets ahead of its stored events.
+    """
+
+    def __init__(self, resultDatabase = RESULT_DATABASE, processingDatabase = PROCESSING_DATABASE,
+                 queueSize = RESULT_WRITER_QUEUE_SIZE, batchRows = RESULT_WRITER_BATCH_ROWS,
+                 batchSeconds = RESULT_WRITER_BATCH_SECONDS, journalMode = RESULT_DATABASE_JOURNAL_MODE,
+                 reportSeconds = 60.0, otherDatabases = None, eventStore = None):
+        """
+        :param resultDatabase: Path to the result database
+        :param processingDatabase: Path to the processing database
+        :param queueSize: Number of writes that can wait in the queue
+        :param batchRows: Number of event rows committed at once
+        :param batchSeconds: Maximum time in seconds between a write and its commit
+        :param journalMode: Journal mode of the result database, e.g. "WAL" or "DELETE"
+        :param reportSeconds: Interval for logging the throughput of the writer
+        :param otherDatabases: Function returning the paths of other result databases, which deleted events are also
+        deleted from. A result shard passes the result database and the other shards, an interrupted file may have
+        stored its events in any of them.
+        :param eventStore: An EventStore the events are also written to. Default: None, only the result database
+        """
+        self.resultDatabase = resultDatabase
+        self.otherDatabases = otherDatabases
+        self.eventStore = eventStore
+        self.processingDatabase = processingDatabase
+        self.batchRows = batchRows
+        self.batchSeconds = batchSeconds
+        self.journalMode = journalMode
+        self.reportSeconds = reportSeconds
+        self.databaseSink = DatabaseSink(resultDatabase, processingDatabase)
+        self.writeQueue = queue.Queue(maxsize=queueSize)
+        self.thread = threading.Thread(target=self.run, name="ResultWriter", daemon=True)
+        self.error = None
+
+        self.rows = 0
+        self.commits = 0
+        self.writeSeconds = 0.0
+        self.waitSeconds = 0.0
+        self.startTime = None
+
+    def insertEvents(self, eventType, events):
+        self.put("insertEvents", (eventType, events))
+
+    def insertSpatioTemporalEvents(self, eventType, events):
+        self.put("insertSpatioTemporalEvents", (eventType, events))
+
+    def updateStatus(self, year, var, status):
+        self.put("updateStatus", (year, var, status))
+
+    def updateChunkProgress(self, year, var, nextTimeIndex):
+        self.put("updateChunkProgress", (year, var, nextTimeIndex))
+
+    def deleteEvents(self, eventTypes, startTime, endTime, spatioTemporalStartTime = None):
+        self.put("deleteEvents", (eventTypes, startTime, endTime, spatioTemporalStartTime))
+
+    def insertMetrics(self, year, var, recordedAt, rows):
+        self.put("insertMetrics", (year, var, recordedAt, rows))
+
+    def taskDone(self, arguments):
+        pass
+
+    def put(self, method, arguments):
+        if self.error is not None:
+            raise RuntimeError("The result writer failed") from self.error
+        try:
+            self.writeQueue.put_nowait((method, arguments))
+        except queue.Full:
+            # Backpressure: the writer is behind, wait for it
+            start = time.perf_counter()
+            self.writeQueue.put((method, arguments))
+            self.waitSeconds += time.perf_counter() - start
+
+    def flush(self):
+        """
+        Waits until all writes queued so far are committed.
+        """
+        committed = threading.Event()
+        self.put("flush", (committed,))
+        while not committed.wait(1.0):
+            if not self.thread.is_alive():
+                break
+        if self.error is not None:
+            raise RuntimeError("The result writer failed") from self.error
+
+    def run(self):
+        connection = sqlite3.connect(self.resultDatabase, timeout=60, isolation_level=None)
+        connection.execute(f"PRAGMA journal_mode = {self.journalMode}")
+        if self.journalMode.upper() == "WAL":
+            # Durable against crashes of the process, a power loss may lose the last commits
+            connection.execute("PRAGMA synchronous = NORMAL")
+
+        batch = Batch(connection)
+        nextReport = time.monotonic() + self.reportSeconds
+        while True:
+            timeout = None if batch.started is None else max(0.0, batch.started + self.batchSeconds - time.monotonic())
+            try:
+                method, arguments = self.writeQueue.get(timeout=timeout)
+            except queue.Empty:
+                method, arguments = "commit", ()
+
+            if self.error is not None:
+                # Keep taking writes after a failure, so no processor waits forever for a full queue
+                if method == "flush":
+                    arguments[0].set()
+                elif method == "close":
+                    break
+                continue
+
+            try:
+                start = time.perf_counter()
+                if method in ("commit", "flush", "close"):
+                    self.commit(batch)
+                if method == "flush":
+                    arguments[0].set()
+                elif method == "close":
+                    if self.eventStore is not None:
+                        self.eventStore.flush()
+                    break
+                elif method != "commit":
+                    batch.apply(method, arguments)
+                    if method == "deleteEvents" and self.otherDatabases is not None:
+                        self.deleteFromOtherDatabases(arguments)
+                    if method in ("insertEvents", "deleteEvents") and self.eventStore is not None:
+                        getattr(self.eventStore, method)(*arguments)
+                    if batch.rows >= self.batchRows:
+                        self.commit(batch)
+                self.writeSeconds += time.perf_counter() - start
+            except Exception as e:
+                logging.exception("Result writer failed, stopping all writes: %s", str(e))
+                self.error = e
+                if connection.in_transaction:
+                    connection.rollback()
+                if method == "flush":
+                    arguments[0].set()
+                elif method == "close":
+                    break
+
+            if time.monotonic() >= nextReport:
+                self.report()
+                nextReport = time.monotonic() + self.reportSeconds
+        connection.close()
+
+    def deleteFromOtherDatabases(self, arguments):
+        for path in self.otherDatabases():
+            if path == self.resultDatabase or not os.path.exists(path):
+                continue
+            connection = sqlite3.connect(path, timeout=60)
+            deleteEventRows(connection, *arguments)
+            connection.commit()
+            connection.close()
+
+    def commit(self, batch):
+        if batch.started is None:
+            return
+        if batch.connection.in_transaction:
+            batch.connection.execute("COMMIT")
+        if batch.processingWrites and self.eventStore is not None:
+            self.eventStore.flush()
+        # The processing database is only updated once the events before are stored
+        for method, arguments in batch.processingWrites:
+            getattr(self.databaseSink, method)(*arguments)
+        self.rows += batch.rows
+        self.commits += 1
+        batch.reset()
+
+    def report(self):
+        """
+        Logs the throughput of the writer.
+        :return: The number of committed rows per second since the writer started
+        """
+        seconds = time.monotonic() - self.startTime
+        rowsPerSecond = self.rows / seconds if seconds > 0 else 0.0
+        logging.info("Result writer: %d rows in %d commits, %.0f rows/s, busy %.0f%% of %.0f s, processors waited "
+                     "%.1f s for the queue", self.rows, self.commits, rowsPerSecond,
+                     100 * self.writeSeconds / seconds if seconds > 0 else 0.0, seconds, self.waitSeconds)
+        return rowsPerSecond
+
+    def start(self):
+        self.startTime = time.monotonic()
+        self.thread.start()
+
+    def close(self):
+        """
+        Commits all queued writes and stops the writer.
+        """
+        self.writeQueue.put(("close", ()))
+        self.thread.join()
+        self.report()
+        if self.error is not None:
+            raise RuntimeError("The result writer failed") from self.error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Batch:
+    """
+    The uncommitted writes of a ResultWriter.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.reset()
+
+    def reset(self):
+        self.started = None
+        self.rows = 0
+        self.processingWrites = []
+
+    def apply(self, method, arguments):
+        if self.started is None:
+            self.started = time.monotonic()
+        if method in ("updateStatus", "updateChunkProgress", "insertMetrics"):
+            self.processingWrites.append((method, arguments))
+            return
+
+        if not self.connection.in_transaction:
+            # Takes the write lock, which also keeps the event ids assigned for footprints free of other writers
+            self.connection.execute("BEGIN IMMEDIATE")
+        if method == "insertEvents":
+            self.rows += insertEventRows(self.connection, *arguments)
+        elif method == "insertSpatioTemporalEvents":
+            self.rows += insertSpatioTemporalEventRows(self.connection, *arguments)
+        elif method == "deleteEvents":
+            deleteEventRows(self.connection, *arguments)
+        else:
+            raise ValueError(f"Unknown write {method}")
+
+
+_resultSink = DatabaseSink()
+
+
+def getResultSink():
+    return _resultSink
+
+
+def setResultSink(sink):
+    """
+    Replaces the result sink of this process.
+    :param sink: A DatabaseSink or QueueSink
+    """
+    global _resultSink
+    _resultSink = sink
+
+
+@contextmanager
+def useResultSink(sink):
+    """
+    Replaces the result sink of this process until the context is left.
+    """
+    previousSink = getResultSink()
+    setResultSink(sink)
+    try:
+        yield sink
+    finally:
+        setResultSink(previousSink)
+
+
+def initQueueSink(writeQueue):
+    """
+    Initializer of the worker processes, sends all writes of the worker to the coordinator.
+    """
+    setResultSink(QueueSink(writeQueue))
+
+
+def coordinateWrites(writeQueue, sink, tasks, pollSeconds = 1.0, returnWhenAny = False):
+    """
+    Applies the writes sent by the worker processes to the databases, until all tasks are done. A task is done
+    when its worker sent taskDone, or when its future failed without the worker being able to send it
+    (e.g. the worker process was killed).
+    :param writeQueue: The queue the workers send their writes to
+    :param sink: The sink writing to the databases, usually a DatabaseSink
+    :param tasks: A dict of the task arguments to their futures
+    :param pollSeconds: Interval for checking the futures while no writes arrive
+    :param returnWhenAny: Return as soon as any task is done, so the caller can submit the next one
+    :return: A tuple of the set of task arguments that finished and the set of those whose worker died before
+    sending taskDone
+    """
+    doneTasks = set()
+    while True:
+        diedTasks = set(argument for argument, future in tasks.items()
+                        if future.done() and future.exception() is not None) - doneTasks
+        if len(doneTasks) + len(diedTasks) >= len(tasks) or (returnWhenAny and (doneTasks or diedTasks)):
+            return doneTasks, diedTasks
+
+        try:
+            method, arguments = writeQueue.get(timeout=pollSeconds)
+        except queue.Empty:
+            continue
+
+        if method == "taskDone":
+            if arguments[0] in tasks:
+                doneTasks.add(arguments[0])
+        else:
+            getattr(sink, method)(*arguments)
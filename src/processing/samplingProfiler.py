@@ -0,0 +1,101 @@
+import logging
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from fnmatch import fnmatch
+from src.config import PROCESSING_FOLDER, PROFILING_JOBS, PROFILING_SAMPLE_FRACTION, PROFILING_INTERVAL
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of one thread at a fixed interval from a background thread. The samples are written
+    in the folded stack format, one line of semicolon separated frames and the number of samples per stack,
+    which flamegraph.pl, speedscope and most other flame graph tools read.
+    Samples are taken in wall time, so waiting, e.g. for dask workers or the write queue, shows up as well.
+    """
+
+    def __init__(self, threadId = None, interval = PROFILING_INTERVAL):
+        """
+        :param threadId: Ident of the sampled thread. Default: the thread creating the profiler
+        :param interval: Seconds between two samples
+        """
+        self.threadId = threading.get_ident() if threadId is None else threadId
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="SamplingProfiler", daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def writeFolded(self, path):
+        """
+        Writes the samples in the folded stack format.
+        :param path: Path of the profile
+        """
+        with open(path, "w") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def shouldProfile(arguments, jobs = None, sampleFraction = PROFILING_SAMPLE_FRACTION):
+    """
+    Decides if a job is profiled.
+    :param arguments: The job as "year:variable"
+    :param jobs: Patterns of jobs that are always profiled, like "2021:precipitation" or "*:wind". Default: the
+    comma separated patterns of the environment variable PROCESSING_PROFILE, else PROFILING_JOBS specified in config
+    :param sampleFraction: Fraction of the other jobs profiled at random
+    """
+    if jobs is None:
+        environment = os.environ.get("PROCESSING_PROFILE")
+        jobs = environment.split(",") if environment else PROFILING_JOBS
+    if any(fnmatch(arguments, pattern.strip()) for pattern in jobs):
+        return True
+    return sampleFraction > 0 and random.random() < sampleFraction
+
+
+@contextmanager
+def sampleJob(arguments, profileFolder):
+    year, var = arguments.split(":")
+    os.makedirs(profileFolder, exist_ok=True)
+    path = os.path.join(profileFolder, f"{var}_{year}_{datetime.now():%Y%m%d-%H%M%S}_{os.getpid()}.folded")
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.writeFolded(path)
+        logging.info("Profile of %s written to %s", arguments, path)
+
+
+def profileJob(arguments, profileFolder = f"{PROCESSING_FOLDER}profiles/"):
+    """
+    Profiles a job of processingManager with a SamplingProfiler, if shouldProfile selects it. Other jobs run
+    without any profiling overhead.
+    :param arguments: The job as "year:variable"
+    :param profileFolder: Folder of the profiles, next to processing.log by default
+    :return: A context manager around the job
+    """
+    if not shouldProfile(arguments):
+        return nullcontext()
+    return sampleJob(arguments, profileFolder)
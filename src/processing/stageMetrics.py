@@ -0,0 +1,132 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from src.config import RECORD_PROCESSING_METRICS
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is reported as None there
+    resource = None
+
+# Metrics of the file processed by the current thread, so concurrent files of the thread executor don't mix
+_current = threading.local()
+
+
+def peakRssMB():
+    """
+    Returns the peak resident set size of this process in MB, or None if it can't be determined.
+    """
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return maxRss / 1024**2 if sys.platform == "darwin" else maxRss / 1024
+
+
+def bytesReadSoFar():
+    """
+    Returns the number of bytes this process read from files so far, 0 if the platform doesn't report it.
+    """
+    try:
+        with open("/proc/self/io") as io:
+            for line in io:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class FileMetrics:
+    """
+    Wall time, CPU time, peak RSS, bytes read and events emitted of the stages of processing one file. A stage
+    entered several times, e.g. once per time chunk, is summed up into one row.
+    CPU time, peak RSS and bytes read are measured for the whole process, so with more than one thread worker they
+    include the other files processed at the same time.
+    """
+
+    def __init__(self, year, variable):
+        self.year = year
+        self.variable = variable
+        self.recordedAt = datetime.now().isoformat(timespec="seconds")
+        self.stages = {}
+        self.openStages = []
+
+    def addStage(self, name, wallSeconds, cpuSeconds, bytesRead, events):
+        stage = self.stages.setdefault(name, {"calls": 0, "wallSeconds": 0.0, "cpuSeconds": 0.0, "peakRssMB": None,
+                                              "bytesRead": 0, "events": 0})
+        stage["calls"] += 1
+        stage["wallSeconds"] += wallSeconds
+        stage["cpuSeconds"] += cpuSeconds
+        stage["peakRssMB"] = peakRssMB()
+        stage["bytesRead"] += bytesRead
+        stage["events"] += events
+
+    def rows(self):
+        """
+        Returns one tuple of stage, calls, wallSeconds, cpuSeconds, peakRssMB, bytesRead and events per stage,
+        see insertStageMetrics.
+        """
+        return [(name, stage["calls"], stage["wallSeconds"], stage["cpuSeconds"], stage["peakRssMB"],
+                 stage["bytesRead"], stage["events"]) for name, stage in self.stages.items()]
+
+
+@contextmanager
+def recordFileMetrics(year, variable, enabled = RECORD_PROCESSING_METRICS):
+    """
+    Collects the metrics of all stages entered by this thread while processing a file. The whole file is
+    recorded as the stage "file".
+    :param year: Year of the file
+    :param variable: Variable of the file
+    :param enabled: Collect metrics. Default: RECORD_PROCESSING_METRICS specified in config
+    :return: The FileMetrics of the file, or None if not enabled
+    """
+    if not enabled:
+        yield None
+        return
+
+    metrics = FileMetrics(year, variable)
+    _current.metrics = metrics
+    try:
+        with stage("file"):
+            yield metrics
+    finally:
+        _current.metrics = None
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures a stage of processing the current file. Does nothing outside of recordFileMetrics.
+    :param name: Name of the stage, e.g. "read" or "labeling"
+    """
+    metrics = getattr(_current, "metrics", None)
+    if metrics is None:
+        yield
+        return
+
+    events = [0]
+    metrics.openStages.append(events)
+    startWall, startCpu, startBytes = time.perf_counter(), time.process_time(), bytesReadSoFar()
+    try:
+        yield
+    finally:
+        # Stages of a thread are nested, so this stage is the innermost one
+        metrics.openStages.pop()
+        metrics.addStage(name, time.perf_counter() - startWall, time.process_time() - startCpu,
+                         bytesReadSoFar() - startBytes, events[0])
+
+
+def countEvents(events):
+    """
+    Adds emitted events to all stages of the current file that are in progress.
+    :param events: Columnar events (dict of arrays) or a list of events
+    """
+    metrics = getattr(_current, "metrics", None)
+    if metrics is None:
+        return
+    count = len(next(iter(events.values()), [])) if isinstance(events, dict) else len(events)
+    for openStage in metrics.openStages:
+        openStage[0] += count
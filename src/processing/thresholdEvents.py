@@ -0,0 +1,57 @@
+import xarray as xr
+from processing_functions import getConnectedEvents, getSpatioTemporalEvents
+from resultSink import getResultSink
+from stageMetrics import stage, countEvents
+from src.config import EVENT_LABELING_MODE, STORE_EVENT_FOOTPRINTS
+
+def processThresholdEvents(dataset, variable, threshold, eventType, labelingMode = EVENT_LABELING_MODE,
+                           footprints = STORE_EVENT_FOOTPRINTS):
+    """
+    Extracts the connected events of a variable exceeding the threshold and stores them in the result database.
+    Depending on the labeling mode, events are stored per timestep, per event over its whole lifetime or both.
+    :param dataset: The dataset containing the variable
+    :param variable: Name of the variable to threshold
+    :param threshold: A threshold or a list of threshold levels. Cells strictly above a threshold are part of an event of that level
+    :param eventType: Event type stored with the events
+    :param labelingMode: "slice", "spatiotemporal" or "both". Default: EVENT_LABELING_MODE specified in config
+    :param footprints: Store the exact cells of the slice events. Default: STORE_EVENT_FOOTPRINTS specified in config
+    """
+    if labelingMode not in ("slice", "spatiotemporal", "both"):
+        raise ValueError(f"Unknown event labeling mode {labelingMode}")
+
+    if labelingMode in ("slice", "both"):
+        with stage("labeling"):
+            events = getConnectedEvents(dataset, variable, threshold, columnar=True, footprints=footprints)
+            countEvents(events)
+        with stage("insert"):
+            getResultSink().insertEvents(eventType, events)
+
+    if labelingMode in ("spatiotemporal", "both"):
+        with stage("spatioTemporalLabeling"):
+            events = getSpatioTemporalEvents(dataset, variable, threshold)
+            countEvents(events)
+        with stage("insert"):
+            getResultSink().insertSpatioTemporalEvents(eventType, events)
+
+
+def processChunkThresholdEvents(values, times, latitudes, longitudes, threshold, eventType,
+                                footprints = STORE_EVENT_FOOTPRINTS):
+    """
+    Extracts the events of every timestep of one time chunk exceeding the threshold and stores them in the result
+    database, as processThresholdEvents does for the "slice" labeling mode. Used by processors that stream over
+    their input and never hold the whole dataset. Dask backed chunks are labeled per dask chunk in parallel.
+    :param values: Values of the chunk with dims (time, latitude, longitude), a numpy or dask array
+    :param times: Time coordinate of the chunk
+    :param latitudes: Latitude coordinate of the grid
+    :param longitudes: Longitude coordinate of the grid
+    :param threshold: A threshold or a list of threshold levels
+    :param eventType: Event type stored with the events
+    :param footprints: Store the exact cells of the events. Default: STORE_EVENT_FOOTPRINTS specified in config
+    """
+    chunk = xr.Dataset({"values": (["valid_time", "latitude", "longitude"], values)},
+                       coords={"valid_time": times, "latitude": latitudes, "longitude": longitudes})
+    with stage("labeling"):
+        events = getConnectedEvents(chunk, "values", threshold, columnar=True, footprints=footprints)
+        countEvents(events)
+    with stage("insert"):
+        getResultSink().insertEvents(eventType, events)
@@ -0,0 +1,405 @@
+import glob
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import dask
+import numpy as np
+import xarray as xr
+from processing_functions import mergeTopN, iterTopNChunks
+
+# Times are stored as minutes since the unix epoch in int32, which covers the years 0 to ~6000
+TIME_UNIT = "m"
+EMPTY_TIME = np.iinfo(np.int32).min
+
+# Folder inside the result folder holding the per-year top N partials as {name}/{year}
+PARTIAL_FOLDER = "topNPartials"
+# Folder inside the result folder holding the top N of files whose processing was interrupted as {name}/{year}
+RESUME_FOLDER = "topNResume"
+# Partial holding a top10{name}.nc file written before the per-year partials, stored as {name}/legacy
+LEGACY_PARTIAL = "legacy"
+# Attribute marking top10{name}.nc files exported from the partials, files without it are migrated once
+EXPORT_ATTRIBUTE = "topNPartials"
+
+
+def timesToOffsets(times):
+    """
+    Converts datetime64 values to int32 minutes since the unix epoch, NaT becomes EMPTY_TIME.
+    :param times: An array of datetime64 values
+    :return: An int32 array of time offsets with the same shape
+    """
+    times = np.asarray(times)
+    offsets = times.astype(f"datetime64[{TIME_UNIT}]").astype(np.int64)
+    return np.where(np.isnat(times), EMPTY_TIME, offsets).astype(np.int32)
+
+
+def offsetsToTimes(offsets):
+    """
+    Converts int32 time offsets back to datetime64[ns] values, EMPTY_TIME becomes NaT.
+    :param offsets: An array of time offsets as returned by timesToOffsets
+    :return: A datetime64[ns] array with the same shape
+    """
+    offsets = np.asarray(offsets)
+    times = offsets.astype(np.int64).astype(f"datetime64[{TIME_UNIT}]").astype("datetime64[ns]")
+    return np.where(offsets == EMPTY_TIME, np.datetime64("NaT", "ns"), times)
+
+
+def blockTopN(values, times, topN, highest = True):
+    """
+    Computes the top N of one block of timesteps.
+    :param values: Values with dims (time, latitude, longitude)
+    :param times: One-dimensional datetime64 times of the block
+    :param topN: Number of top values
+    :param highest: If the highest (True) or lowest (False) values are kept
+    :return: The top values and int32 time offsets with shape (topN, n_points)
+    """
+    values = np.asarray(values)
+    values = values.reshape(values.shape[0], -1)
+    emptyValues = np.full((topN, values.shape[1]), np.nan)
+    emptyOffsets = np.full((topN, values.shape[1]), EMPTY_TIME, dtype=np.int32)
+    return mergeTopN(emptyValues, emptyOffsets, values, timesToOffsets(times), highest=highest)
+
+
+class TopNAccumulator:
+    """
+    Running top N of the highest or lowest values per grid cell that can be kept in memory over many year files.
+    Stores the values and compact int32 time offsets with shape (topN, n_points), can be checkpointed to
+    memory-mapped .npy files and exported to the top10*.nc layout written by update_top_n.
+    Accumulators of different years (partials) can be merged in any order with merge.
+    progress counts the timesteps of the file being processed that are merged, to resume an interrupted file.
+    """
+
+    def __init__(self, latitude, longitude, dataVar, timeVar = "valid_time", highest = True, topN = 10,
+                 values = None, timeOffsets = None, progress = 0):
+        self.latitude = np.asarray(latitude)
+        self.longitude = np.asarray(longitude)
+        self.dataVar = dataVar
+        self.timeVar = timeVar
+        self.highest = highest
+        self.topN = topN
+        self.progress = progress
+        self.lock = threading.Lock()
+
+        nPoints = self.latitude.size * self.longitude.size
+        self.values = np.full((topN, nPoints), np.nan) if values is None else values
+        self.timeOffsets = np.full((topN, nPoints), EMPTY_TIME, dtype=np.int32) if timeOffsets is None else timeOffsets
+
+    @classmethod
+    def fromDataset(cls, topNDataset, dataVar, timeVar = "valid_time", highest = True):
+        """
+        Creates an accumulator from an existing top N dataset as written by update_top_n.
+        :param topNDataset: Dataset with "top_{dataVar}" and "top_{timeVar}" of dims (rank, latitude, longitude)
+        :param dataVar: Name of the data variable
+        :param timeVar: Name of the time variable
+        :param highest: If the top N holds the highest (True) or lowest (False) values
+        :return: The accumulator
+        """
+        values = topNDataset[f"top_{dataVar}"].transpose("rank", "latitude", "longitude").values
+        times = topNDataset[f"top_{timeVar}"].transpose("rank", "latitude", "longitude").values
+        topN = values.shape[0]
+        return cls(topNDataset.latitude.values, topNDataset.longitude.values, dataVar, timeVar, highest, topN,
+                   values.reshape(topN, -1).astype(np.float64), timesToOffsets(times.reshape(topN, -1)))
+
+    def update(self, dataset, timeChunkSize = None, memoryBudget = None):
+        """
+        Merges all timesteps of a dataset into the top N, reading it in time chunks. If the data variable is dask
+        backed, the top N of every dask chunk is computed in parallel on the active dask scheduler and the chunk
+        results are merged in time order.
+        :param dataset: Dataset on the same grid containing the data and time variable
+        :param timeChunkSize: Number of timesteps merged at once
+        :param memoryBudget: Approximate number of bytes used for merging one chunk, if timeChunkSize is not given.
+        Not used for dask backed data, where the dask chunks bound the memory.
+        """
+        data = dataset[self.dataVar]
+        spatialTimes = set(["latitude", "longitude"]).issubset(dataset[self.timeVar].dims)
+
+        if data.chunks is not None and not spatialTimes:
+            timeDim = [dim for dim in data.dims if dim not in ["latitude", "longitude"]][0]
+            data = data.transpose(timeDim, "latitude", "longitude")
+            if timeChunkSize is not None:
+                data = data.chunk({timeDim: timeChunkSize})
+            data = data.chunk({"latitude": -1, "longitude": -1})
+
+            times = dataset[self.timeVar].values.reshape(-1)
+            bounds = np.cumsum((0,) + data.chunks[0])
+            tasks = [dask.delayed(blockTopN)(block, times[bounds[i]:bounds[i + 1]], self.topN, self.highest)
+                     for i, block in enumerate(data.data.to_delayed().ravel())]
+            blockResults = dask.compute(*tasks)
+
+            with self.lock:
+                for blockValues, blockOffsets in blockResults:
+                    self.values, self.timeOffsets = mergeTopN(self.values, self.timeOffsets, blockValues,
+                                                              blockOffsets, highest=self.highest)
+            return
+
+        with self.lock:
+            for chunkValues, chunkTimes in iterTopNChunks(dataset, self.dataVar, self.timeVar, self.topN,
+                                                          timeChunkSize, memoryBudget):
+                self.values, self.timeOffsets = mergeTopN(self.values, self.timeOffsets, chunkValues,
+                                                          timesToOffsets(chunkTimes), highest=self.highest)
+
+    def merge(self, other):
+        """
+        Merges two accumulators of the same top N on the same grid, e.g. the partials of two years.
+        The operation is associative, so any set of partials can be merged in any grouping.
+        :param other: Another accumulator
+        :return: A new accumulator holding the top N of both
+        """
+        if (self.topN, self.highest, self.dataVar) != (other.topN, other.highest, other.dataVar) \
+                or np.shape(self.values) != np.shape(other.values):
+            raise ValueError(f"Can't merge top N of {self.dataVar} with top N of {other.dataVar}")
+
+        values, timeOffsets = mergeTopN(np.asarray(self.values), np.asarray(self.timeOffsets),
+                                        np.asarray(other.values), np.asarray(other.timeOffsets), highest=self.highest)
+        return TopNAccumulator(self.latitude, self.longitude, self.dataVar, self.timeVar, self.highest, self.topN,
+                               values, timeOffsets)
+
+    def withoutYears(self, years):
+        """
+        Removes the values of the given years, e.g. from a legacy partial whose years were processed again.
+        :param years: Iterable of years
+        :return: A new accumulator without the values of these years
+        """
+        offsets = np.asarray(self.timeOffsets)
+        valueYears = offsetsToTimes(offsets).astype("datetime64[Y]").astype(np.int64) + 1970
+        removed = np.isin(valueYears, list(years)) & (offsets != EMPTY_TIME)
+        values = np.where(removed, np.nan, self.values)
+        offsets = np.where(removed, EMPTY_TIME, offsets).astype(np.int32)
+        # Merged into an empty top N to move the remaining values up the ranks
+        result = TopNAccumulator(self.latitude, self.longitude, self.dataVar, self.timeVar, self.highest, self.topN)
+        result.values, result.timeOffsets = mergeTopN(result.values, result.timeOffsets, values, offsets,
+                                                      highest=self.highest)
+        return result
+
+    def toDataset(self):
+        """
+        Exports the top N in the layout of update_top_n.
+        :return: A dataset with "top_{dataVar}" and "top_{timeVar}" of dims (rank, latitude, longitude)
+        """
+        shape = (self.topN, self.latitude.size, self.longitude.size)
+        coords = {"rank": np.arange(1, self.topN + 1), "latitude": self.latitude, "longitude": self.longitude}
+        return xr.Dataset({
+            f"top_{self.dataVar}": xr.DataArray(np.asarray(self.values).reshape(shape),
+                                                dims=["rank", "latitude", "longitude"], coords=coords),
+            f"top_{self.timeVar}": xr.DataArray(offsetsToTimes(self.timeOffsets).reshape(shape),
+                                                dims=["rank", "latitude", "longitude"], coords=coords)
+        })
+
+    def checkpoint(self, path):
+        """
+        Writes the state to memory-mapped .npy files in the directory path. An existing checkpoint of the same
+        shape is overwritten in place.
+        :param path: Checkpoint directory
+        """
+        os.makedirs(path, exist_ok=True)
+
+        with self.lock:
+            # Mark the checkpoint as incomplete while it is rewritten
+            if os.path.exists(os.path.join(path, "metadata.json")):
+                os.remove(os.path.join(path, "metadata.json"))
+
+            for name, array in [("values", self.values), ("timeOffsets", self.timeOffsets),
+                                ("latitude", self.latitude), ("longitude", self.longitude)]:
+                filepath = os.path.join(path, f"{name}.npy")
+                target = None
+                if os.path.exists(filepath):
+                    target = np.load(filepath, mmap_mode="r+")
+                    if target.shape != array.shape or target.dtype != array.dtype:
+                        del target
+                        target = None
+                if target is None:
+                    target = np.lib.format.open_memmap(filepath, mode="w+", dtype=array.dtype, shape=array.shape)
+                target[...] = array
+                target.flush()
+                del target
+
+            # Metadata is written last, so a checkpoint without it is incomplete
+            metadata = {"dataVar": self.dataVar, "timeVar": self.timeVar, "highest": self.highest, "topN": self.topN,
+                        "progress": self.progress}
+            with open(os.path.join(path, "metadata.json.tmp"), "w") as file:
+                json.dump(metadata, file)
+            os.replace(os.path.join(path, "metadata.json.tmp"), os.path.join(path, "metadata.json"))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an accumulator from a checkpoint directory. The arrays stay memory-mapped until the first update.
+        :param path: Checkpoint directory written by checkpoint
+        :return: The accumulator
+        """
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                  for name in ["values", "timeOffsets", "latitude", "longitude"]}
+
+        return cls(np.array(arrays["latitude"]), np.array(arrays["longitude"]), metadata["dataVar"],
+                   metadata["timeVar"], metadata["highest"], metadata["topN"],
+                   arrays["values"], arrays["timeOffsets"], metadata.get("progress", 0))
+
+
+def mergeTopNAccumulators(accumulators, maxWorkers = 1):
+    """
+    Merges any number of accumulators of the same top N on the same grid into one, reducing them pairwise as a
+    tree. The pairs of each tree level are merged in parallel.
+    :param accumulators: A list of accumulators
+    :param maxWorkers: Number of threads merging pairs concurrently
+    :return: The merged accumulator
+    """
+    accumulators = list(accumulators)
+    if not accumulators:
+        raise ValueError("No accumulators to merge")
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while len(accumulators) > 1:
+            pairs = [(accumulators[i], accumulators[i + 1]) for i in range(0, len(accumulators) - 1, 2)]
+            merged = list(executor.map(lambda pair: pair[0].merge(pair[1]), pairs))
+            # An odd accumulator out is carried over to the next level
+            if len(accumulators) % 2 == 1:
+                merged.append(accumulators[-1])
+            accumulators = merged
+
+    return accumulators[0]
+
+
+def topNPartialPath(resultFolder, name, year):
+    return f"{resultFolder}{PARTIAL_FOLDER}/{name}/{year}"
+
+
+def topNResumePath(resultFolder, name, year):
+    return f"{resultFolder}{RESUME_FOLDER}/{name}/{year}"
+
+
+def loadLegacyTopNPartial(resultFolder, name):
+    """
+    Returns the legacy partial of a top N, or None if there is none.
+    """
+    path = topNPartialPath(resultFolder, name, LEGACY_PARTIAL)
+    if not os.path.exists(os.path.join(path, "metadata.json")):
+        return None
+    return TopNAccumulator.load(path)
+
+
+def removeTopNPartial(resultFolder, name, year):
+    """
+    Removes the partial and the resume checkpoint of a year from a top N, e.g. because its input file changed.
+    The values of the year are removed from the legacy partial as well, so the year is left out of the next export
+    until it is processed again.
+    """
+    for path in (topNPartialPath(resultFolder, name, year), topNResumePath(resultFolder, name, year)):
+        shutil.rmtree(path, ignore_errors=True)
+
+    legacy = loadLegacyTopNPartial(resultFolder, name)
+    if legacy is not None:
+        legacy.withoutYears([year]).checkpoint(topNPartialPath(resultFolder, name, LEGACY_PARTIAL))
+
+
+def migrateLegacyTopN(resultFolder, name, dataVar, timeVar = "valid_time", highest = True):
+    """
+    Stores a top10{name}.nc file that was not exported from the partials, e.g. written before the top N was kept
+    per year, as the legacy partial of the top N. The years it holds are kept in the export, except for years that
+    have their own partial. Does nothing if the file was exported from the partials or is already migrated.
+    :param resultFolder: Folder containing the top10 files and partials
+    :param name: Name of the top N
+    :param dataVar: Name of the data variable
+    :param timeVar: Name of the time variable
+    :param highest: If the top N holds the highest (True) or lowest (False) values
+    :return: True if the file was migrated
+    """
+    topNPath = f"{resultFolder}top10{name}.nc"
+    if not os.path.exists(topNPath) or loadLegacyTopNPartial(resultFolder, name) is not None:
+        return False
+
+    with xr.open_dataset(topNPath) as topNDataset:
+        if EXPORT_ATTRIBUTE in topNDataset.attrs:
+            return False
+        legacy = TopNAccumulator.fromDataset(topNDataset, dataVar, timeVar, highest)
+    legacy.checkpoint(topNPartialPath(resultFolder, name, LEGACY_PARTIAL))
+    return True
+
+
+def getTopNPartialYears(resultFolder, name):
+    """
+    Returns all years for which a complete top N partial of name exists.
+    """
+    years = []
+    for path in glob.glob(f"{resultFolder}{PARTIAL_FOLDER}/{name}/*"):
+        if os.path.basename(path).isdigit() and os.path.exists(os.path.join(path, "metadata.json")):
+            years.append(int(os.path.basename(path)))
+    return sorted(years)
+
+
+def updateTopNPartial(resultFolder, name, year, dataset, dataVar, timeVar = "valid_time", highest = True,
+                      memoryBudget = None):
+    """
+    Computes the top N of one year file and stores it as that years partial, replacing an older partial of the
+    same year. Partials of different years are independent, so years can be processed concurrently.
+    :param resultFolder: Folder containing the top10 files and partials
+    :param name: Name of the top N, e.g. "temperatureHigh"
+    :param year: Year of the dataset
+    :param dataset: Dataset containing the data and time variable
+    :param dataVar: Name of the data variable
+    :param timeVar: Name of the time variable
+    :param highest: If the top N holds the highest (True) or lowest (False) values
+    :param memoryBudget: Approximate number of bytes used for merging one time chunk
+    :return: The accumulator of the year
+    """
+    accumulator = TopNAccumulator(dataset.latitude.values, dataset.longitude.values, dataVar, timeVar, highest)
+    accumulator.update(dataset, memoryBudget=memoryBudget)
+    accumulator.checkpoint(topNPartialPath(resultFolder, name, year))
+    return accumulator
+
+
+def combineTopNPartials(resultFolder, name, years = None, maxWorkers = 1):
+    """
+    Combines the stored partials of a top N into the ranking over all (or the given) years.
+    :param resultFolder: Folder containing the partials
+    :param name: Name of the top N
+    :param years: Iterable of years to combine, e.g. range(2010, 2024). Default: all years with a partial and the
+    years of the legacy partial
+    :param maxWorkers: Number of threads merging partials concurrently
+    :return: The combined accumulator
+    """
+    availableYears = getTopNPartialYears(resultFolder, name)
+    if years is not None:
+        missingYears = sorted(set(years) - set(availableYears))
+        if missingYears:
+            raise FileNotFoundError(f"No top N partial of {name} for the years {missingYears}")
+        availableYears = sorted(set(years))
+
+    partials = [TopNAccumulator.load(topNPartialPath(resultFolder, name, year)) for year in availableYears]
+    if years is None:
+        legacy = loadLegacyTopNPartial(resultFolder, name)
+        if legacy is not None:
+            # Years with their own partial replace their values in the legacy partial
+            partials.append(legacy.withoutYears(availableYears))
+    return mergeTopNAccumulators(partials, maxWorkers)
+
+
+def exportTopNPartials(resultFolder, maxWorkers = 1):
+    """
+    Combines the partials of every top N found in the result folder and writes them to their top10{name}.nc files.
+    Existing top10{name}.nc files that were not exported from the partials are migrated to legacy partials first,
+    so the years they hold stay in the export.
+    :param resultFolder: Folder containing the partials
+    :param maxWorkers: Number of threads merging partials concurrently
+    :return: The names of the exported top N
+    """
+    names = sorted(os.path.basename(path) for path in glob.glob(f"{resultFolder}{PARTIAL_FOLDER}/*")
+                   if getTopNPartialYears(resultFolder, os.path.basename(path)))
+
+    for name in names:
+        partial = TopNAccumulator.load(topNPartialPath(resultFolder, name, getTopNPartialYears(resultFolder, name)[0]))
+        migrateLegacyTopN(resultFolder, name, partial.dataVar, partial.timeVar, partial.highest)
+        del partial
+
+        topNDataset = combineTopNPartials(resultFolder, name, maxWorkers=maxWorkers).toDataset()
+        topNDataset.attrs[EXPORT_ATTRIBUTE] = 1
+        # Written next to the target and renamed, so readers never see a partially written file
+        temporaryPath = f"{resultFolder}top10{name}.nc.{os.getpid()}.tmp"
+        topNDataset.to_netcdf(temporaryPath)
+        topNDataset.close()
+        os.replace(temporaryPath, f"{resultFolder}top10{name}.nc")
+
+    return names
@@ -2,10 +2,19 @@ import glob
 from xarray import open_dataset
 from geopy.geocoders import Nominatim
 from math import floor
-from src.config import RESULT_FOLDER, RESULT_DATABASE, RESULT_TABLENAME
+from src.config import RESULT_FOLDER, RESULT_DATABASE, RESULT_TABLENAME, SPATIOTEMPORAL_TABLENAME, FOOTPRINT_TABLENAME, \
+    EVENT_STORE_FOLDER
 import sqlite3
-from src.processing.databaseFunctions import resultDatabaseRecordsToDataframe
+from src.processing.databaseFunctions import resultDatabaseRecordsToDataframe, boundingBoxTableName
+from src.utils.footprints import footprintContains
+from src.utils.eventTimes import epochSecondsToDatetime
 import pandas as pd
+try:
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    # Optional, only needed for reading the columnar event store
+    ds = None
 
 # function to get latitude and longitude from a city name via Nominatim and geopy
 def get_lat_lon(city):
@@ -105,12 +114,107 @@ def getTopTenForCityForEventType(cityname, eventType):
 
 
 
-def getAllRecordsForCity(cityname, resultDatabase = RESULT_DATABASE, tableName = "thresholdResults") -> pd.DataFrame :
+def getFootprints(connection, eventIds, footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Reads the footprints of events from the result database.
+    :param connection: An open connection to the result database
+    :param eventIds: Ids of the events
+    :param footprintTableName: Tablename for the footprint table. Defaults to the table specified in the config.
+    :return: A dict of event id to footprint bytes. Events without a stored footprint are missing.
+    """
+    exists = connection.execute("SELECT exists(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                                (footprintTableName,)).fetchone()[0]
+    if not exists:
+        return {}
+
+    footprints = {}
+    eventIds = list(eventIds)
+    # Stay below the sqlite limit of host parameters per statement
+    for start in range(0, len(eventIds), 900):
+        batch = eventIds[start:start + 900]
+        rows = connection.execute(f"SELECT eventId, footprint FROM {footprintTableName} "
+                                  f"WHERE eventId IN ({','.join('?' * len(batch))})", batch).fetchall()
+        footprints.update(rows)
+    return footprints
+
+
+def filterRecordsByFootprint(connection, records, lat, lon, footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Removes all records whose event didn't cover the grid cell at lat and lon, although its bounding box contains it.
+    Records without a stored footprint are kept.
+    :param connection: An open connection to the result database
+    :param records: Records from the result database, with the event id first
+    :param lat: Latitude of the grid cell
+    :param lon: Longitude of the grid cell
+    :param footprintTableName: Tablename for the footprint table. Defaults to the table specified in the config.
+    :return: The filtered records
+    """
+    footprints = getFootprints(connection, [record[0] for record in records], footprintTableName)
+    return [record for record in records
+            if record[0] not in footprints or footprintContains(footprints[record[0]], lat, lon)]
+
+
+def eventCoversCell(eventId, lat, lon, resultDatabase = RESULT_DATABASE, footprintTableName = FOOTPRINT_TABLENAME):
+    """
+    Checks if an event covered a grid cell, using the stored footprint of the event.
+    :param eventId: Id of the event in the result table
+    :param lat: Latitude of the grid cell
+    :param lon: Longitude of the grid cell (0° to 360° east)
+    :param resultDatabase: Path to the result database. Defaults to the path in the config.
+    :param footprintTableName: Tablename for the footprint table. Defaults to the table specified in the config.
+    :return: True or False, or None if no footprint is stored for the event
+    """
+    connection = sqlite3.connect(resultDatabase)
+    footprints = getFootprints(connection, [eventId], footprintTableName)
+    connection.close()
+
+    if eventId not in footprints:
+        return None
+    return footprintContains(footprints[eventId], lat, lon)
+
+
+def selectRecordsContaining(cursor, tableName, lat, lon, condition = "", parameters = ()):
+    """
+    Selects all records of a result table whose bounding box contains a grid cell. The candidates are looked up in
+    the R*Tree of the table, if the result database has one, else the whole table is scanned. The R*Tree stores the
+    boxes as 32 bit floats rounded outwards, so the candidates are checked against the exact bounding boxes.
+    :param cursor: A cursor of an open connection to the result database
+    :param tableName: Tablename for the result table
+    :param lat: Latitude of the grid cell
+    :param lon: Longitude of the grid cell
+    :param condition: Additional SQL condition on the columns of the table, e.g. "eventType = ?"
+    :param parameters: Parameters of the condition
+    :return: The cursor with the selected records
+    """
+    rtreeName = boundingBoxTableName(tableName)
+    hasRtree = cursor.execute("SELECT exists(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?)",
+                              (rtreeName,)).fetchone()[0]
+
+    boxCondition = (f"{tableName}.minLatitude <= ? AND {tableName}.maxLatitude >= ? "
+                    f"AND {tableName}.minLongitude <= ? AND {tableName}.maxLongitude >= ?")
+    if condition:
+        boxCondition += f" AND {condition}"
+    boxParameters = (lat, lat, lon, lon, *parameters)
+
+    if hasRtree:
+        # CROSS JOIN makes the R*Tree the outer loop, a grid cell is more selective than the few event types
+        return cursor.execute(f"SELECT {tableName}.* FROM {rtreeName} CROSS JOIN {tableName} ON {tableName}.id = {rtreeName}.id "
+                              f"WHERE {rtreeName}.minLatitude <= ? AND {rtreeName}.maxLatitude >= ? "
+                              f"AND {rtreeName}.minLongitude <= ? AND {rtreeName}.maxLongitude >= ? "
+                              f"AND {boxCondition}", (lat, lat, lon, lon, *boxParameters))
+    return cursor.execute(f"SELECT * FROM {tableName} WHERE {boxCondition}", boxParameters)
+
+
+def getAllRecordsForCity(cityname, resultDatabase = RESULT_DATABASE, tableName = "thresholdResults", exact = False,
+                         footprintTableName = FOOTPRINT_TABLENAME) -> pd.DataFrame :
     """
      Given a city and an eventType, returns all records that occurred in the cities grid-box.
      :param cityname: The city name
      :param resultDatabase: Path to the result database. Defaults to the path in the config.
      :param tableName: Tablename for the table in the result database. Defaults to the table specified in the config.
+     :param exact: If True, only returns events whose footprint covers the cities grid-box, instead of all events
+        whose bounding box contains it.
+     :param footprintTableName: Tablename for the footprint table. Defaults to the table specified in the config.
      :return: A dataframe containing all records for the query.
      """
     connection = sqlite3.connect(resultDatabase)
@@ -118,26 +222,28 @@ def getAllRecordsForCity(cityname, resultDatabase = RESULT_DATABASE, tableName =
 
     lat, lon = getCityCoords(cityname)
 
-    records = cursor.execute(f"SELECT * FROM {tableName} "
-                   f"WHERE minLatitude <= {lat} "
-                   f"AND maxLatitude >= {lat} "
-                   f"AND minLongitude <= {lon} "
-                   f"AND maxLongitude >= {lon}")
+    records = selectRecordsContaining(cursor, tableName, lat, lon)
 
     results = records.fetchall()
+    if exact:
+        results = filterRecordsByFootprint(connection, results, lat, lon, footprintTableName)
 
     cursor.close()
     connection.close()
 
     return resultDatabaseRecordsToDataframe(results)
 
-def getAllRecordsForCityAndEventType(cityname,eventType, resultDatabase = RESULT_DATABASE, tableName = RESULT_TABLENAME) -> pd.DataFrame:
+
+def getAllRecordsForCityAndEventType(cityname,eventType, resultDatabase = RESULT_DATABASE, tableName = RESULT_TABLENAME,
+                                     exact = False, footprintTableName = FOOTPRINT_TABLENAME) -> pd.DataFrame:
     """
     Given a city and an eventType, returns all records that occurred for this event in the cities grid-box.
     :param cityname: The city name
     :param eventType: The event type
     :param resultDatabase: Path to the result database. Defaults to the path in the config.
     :param tableName: Tablename for the table in the result database. Defaults to the table specified in the config.
+    :param exact: If True, only returns events whose footprint covers the cities grid-box.
+    :param footprintTableName: Tablename for the footprint table. Defaults to the table specified in the config.
     :return: A dataframe containing all records for the query.
     """
 
@@ -146,19 +252,75 @@ def getAllRecordsForCityAndEventType(cityname,eventType, resultDatabase = RESULT
 
     lat, lon = getCityCoords(cityname)
 
-    records = cursor.execute(f"SELECT * FROM {tableName} "
-                   f"WHERE minLatitude <= {lat} "
-                   f"AND maxLatitude >= {lat} "
-                   f"AND minLongitude <= {lon} "
-                   f"AND maxLongitude >= {lon} "
-                   f"AND eventType = {eventType}")
+    records = selectRecordsContaining(cursor, tableName, lat, lon, f"{tableName}.eventType = ?", (eventType,))
 
     results = records.fetchall()
+    if exact:
+        results = filterRecordsByFootprint(connection, results, lat, lon, footprintTableName)
 
     cursor.close()
     connection.close()
 
     return resultDatabaseRecordsToDataframe(results)
+
+
+def getAllSpatioTemporalRecordsForCity(cityname, resultDatabase = RESULT_DATABASE, tableName = SPATIOTEMPORAL_TABLENAME) -> pd.DataFrame:
+    """
+    Given a city, returns all events labeled across time and space whose swept bounding box contains the cities grid-box.
+    Every row is one event over its whole lifetime, so no grouping with :func:`groupEventsByTime` is necessary.
+    :param cityname: The city name
+    :param resultDatabase: Path to the result database. Defaults to the path in the config.
+    :param tableName: Tablename for the spatio-temporal table. Defaults to the table specified in the config.
+    :return: A dataframe containing all records for the query with startTime, endTime and peakTime as datetimes.
+    """
+    connection = sqlite3.connect(resultDatabase)
+    cursor = connection.cursor()
+
+    lat, lon = getCityCoords(cityname)
+
+    records = selectRecordsContaining(cursor, tableName, lat, lon)
+    df = pd.DataFrame(records.fetchall(), columns=[column[0] for column in records.description])
+
+    cursor.close()
+    connection.close()
+
+    for column in ["startTime", "endTime", "peakTime"]:
+        df[column] = epochSecondsToDatetime(df[column])
+    return df
+
+
+def getEvents(eventTypes = None, startYear = None, endYear = None, columns = None, filters = None,
+              eventStoreFolder = EVENT_STORE_FOLDER) -> pd.DataFrame:
+    """
+    Reads events from the columnar event store (see WRITE_EVENT_STORE), e.g. all rainDaily events of 2010 to 2015
+    above 0.3 m with getEvents(["rainDaily"], 2010, 2015, filters=[("maxEventValue", ">", 0.3)]). Only the partitions
+    of the event types and years and the requested columns are read, and row groups whose statistics don't match the
+    filters are skipped.
+    :param eventTypes: Event types to read. Default: all
+    :param startYear: First year to read. Default: the first year of the store
+    :param endYear: Last year to read. Default: the last year of the store
+    :param columns: Columns to read, of the result table and eventType and year. Default: all
+    :param filters: Conditions on the columns that all have to hold, as (column, operator, value) tuples with the
+        operators of pyarrow.parquet, e.g. "=", "<", ">=" or "in"
+    :param eventStoreFolder: Folder of the event store. Defaults to the folder specified in the config.
+    :return: A dataframe containing the matching events, with eventTime as datetime.
+    """
+    if ds is None:
+        raise ImportError("Reading the event store needs pyarrow, install it with the parquet extra")
+
+    conditions = list(filters or [])
+    if eventTypes is not None:
+        conditions.append(("eventType", "in", list(eventTypes)))
+    if startYear is not None:
+        conditions.append(("year", ">=", startYear))
+    if endYear is not None:
+        conditions.append(("year", "<=", endYear))
+
+    dataset = ds.dataset(eventStoreFolder, format="parquet", partitioning="hive")
+    table = dataset.to_table(columns=columns, filter=pq.filters_to_expression(conditions) if conditions else None)
+    return table.to_pandas()
+
+
 def groupEventsByTime(df: pd.DataFrame) -> pd.DataFrame:
     """
 
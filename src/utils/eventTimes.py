@@ -0,0 +1,32 @@
+# src/utils/eventTimes.py
+import numpy as np
+
+# Event times are stored in the result database as integer seconds since 1970-01-01 UTC, so time range predicates
+# compare integers and reading them back is one cast instead of parsing strings.
+
+
+def epochSeconds(times):
+    """
+    Converts times to integer seconds since 1970-01-01 UTC.
+    :param times: A time or an array of times, as datetime64 values, ISO strings (like str of a numpy datetime64) or
+    seconds since the epoch
+    :return: An int64 array, or an int for a single time
+    """
+    values = np.asarray(times)
+    if values.dtype == object and values.size:
+        # Python ints or strings, e.g. from event dicts
+        values = np.asarray(values.tolist())
+    if np.issubdtype(values.dtype, np.integer):
+        seconds = values.astype(np.int64)
+    else:
+        seconds = values.astype("datetime64[s]").astype(np.int64)
+    return seconds if seconds.ndim else int(seconds)
+
+
+def epochSecondsToDatetime(seconds):
+    """
+    Converts seconds since 1970-01-01 UTC to datetime64[ns] values.
+    :param seconds: An array of seconds, e.g. a column of event times read from the result database
+    :return: A datetime64[ns] array
+    """
+    return np.asarray(seconds, dtype=np.int64).astype("datetime64[s]").astype("datetime64[ns]")
@@ -0,0 +1,92 @@
+# src/utils/footprints.py
+import struct
+import numpy as np
+
+# A footprint is the exact set of grid cells of an event, stored as runs of consecutive cells per grid row.
+# Layout: header with the first latitude, latitude step, first longitude and longitude step of the grid,
+# followed by one (row, first column, length) uint16 triple per run.
+HEADER = struct.Struct("<4f")
+RUN_DTYPE = np.dtype([("row", "<u2"), ("start", "<u2"), ("length", "<u2")])
+
+
+def gridHeader(latitudes, longitudes):
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudeStep = latitudes[1] - latitudes[0] if latitudes.size > 1 else 0.0
+    longitudeStep = longitudes[1] - longitudes[0] if longitudes.size > 1 else 0.0
+    return HEADER.pack(latitudes[0], latitudeStep, longitudes[0], longitudeStep)
+
+
+def encodeFootprints(eventOfRun, rows, starts, lengths, numEvents, latitudes, longitudes):
+    """
+    Encodes the runs of many events into one footprint per event.
+    :param eventOfRun: Event index of every run, ascending
+    :param rows: Grid row (latitude index) of every run
+    :param starts: First grid column (longitude index) of every run
+    :param lengths: Number of cells of every run
+    :param numEvents: Number of events
+    :param latitudes: Latitude coordinate of the grid
+    :param longitudes: Longitude coordinate of the grid
+    :return: An object array with one bytes footprint per event
+    """
+    if len(latitudes) > np.iinfo(np.uint16).max or len(longitudes) > np.iinfo(np.uint16).max:
+        raise ValueError("Grid is too large to be encoded in footprints")
+
+    header = gridHeader(latitudes, longitudes)
+
+    runs = np.empty(len(rows), dtype=RUN_DTYPE)
+    runs["row"] = rows
+    runs["start"] = starts
+    runs["length"] = lengths
+    raw = runs.tobytes()
+
+    # Byte offsets of the runs of every event
+    boundaries = np.searchsorted(eventOfRun, np.arange(numEvents + 1)) * RUN_DTYPE.itemsize
+    footprints = np.empty(numEvents, dtype=object)
+    for event in range(numEvents):
+        footprints[event] = header + raw[boundaries[event]:boundaries[event + 1]]
+    return footprints
+
+
+def decodeFootprint(footprint):
+    """
+    Decodes a footprint.
+    :param footprint: The footprint bytes
+    :return: A tuple of the grid header (first latitude, latitude step, first longitude, longitude step) and the runs
+    """
+    return HEADER.unpack_from(footprint), np.frombuffer(footprint, dtype=RUN_DTYPE, offset=HEADER.size)
+
+
+def gridIndex(value, first, step):
+    if step == 0:
+        return 0 if np.isclose(value, first) else -1
+    return int(round((value - first) / step))
+
+
+def footprintContains(footprint, latitude, longitude):
+    """
+    Checks if an event covered the grid cell at latitude and longitude.
+    :param footprint: The footprint bytes of the event
+    :param latitude: Latitude of the grid cell
+    :param longitude: Longitude of the grid cell
+    :return: True if the cell is part of the event
+    """
+    (firstLatitude, latitudeStep, firstLongitude, longitudeStep), runs = decodeFootprint(footprint)
+    row = gridIndex(latitude, firstLatitude, latitudeStep)
+    column = gridIndex(longitude, firstLongitude, longitudeStep)
+
+    inRow = runs[runs["row"] == row]
+    return bool(np.any((inRow["start"] <= column) & (column < inRow["start"].astype(np.int64) + inRow["length"])))
+
+
+def footprintCells(footprint):
+    """
+    Returns the coordinates of all grid cells of an event.
+    :param footprint: The footprint bytes of the event
+    :return: A tuple of latitude and longitude arrays, one entry per cell
+    """
+    (firstLatitude, latitudeStep, firstLongitude, longitudeStep), runs = decodeFootprint(footprint)
+    rows = np.repeat(runs["row"].astype(np.int64), runs["length"])
+    offsets = np.arange(rows.size) - np.repeat(np.cumsum(runs["length"].astype(np.int64)) - runs["length"], runs["length"])
+    columns = np.repeat(runs["start"].astype(np.int64), runs["length"]) + offsets
+    return firstLatitude + rows * latitudeStep, firstLongitude + columns * longitudeStep
@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from benchmarks.syntheticData import makeSyntheticDataset, parseGrid
+from benchmarks.runBenchmarks import compareResults
+from src.config import EVENT_THRESHOLDS
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_parseGrid(self):
+        self.assertEqual(parseGrid("721x1440"), (721, 1440))
+
+    def test_makeSyntheticDataset(self):
+        dataset = makeSyntheticDataset("windgust", 37, 72, 2, exceedance=0.01)
+        self.assertEqual(dataset.i10fg.shape, (48, 37, 72))
+        self.assertEqual(dataset.latitude.values[0], 90)
+
+        fraction = float((dataset.i10fg > EVENT_THRESHOLDS["windgustHourly"][0]).mean())
+        self.assertAlmostEqual(fraction, 0.01, delta=0.002)
+
+        temperature = makeSyntheticDataset("temperature", 37, 72, 2)
+        self.assertEqual(temperature.t.dims, ("valid_time", "pressure_level", "latitude", "longitude"))
+        self.assertEqual(temperature.valid_time.size, 2)
+
+        precipitation = makeSyntheticDataset("precipitation", 37, 72, 2)
+        self.assertTrue(np.all(precipitation.tp.values >= 0))
+
+    def test_compareResults(self):
+        baseline = {"update_top_n": {"wallSeconds": 1.0, "peakRssMB": 100.0}}
+        faster = {"update_top_n": {"wallSeconds": 0.9, "peakRssMB": 100.0}, "newCase": {"wallSeconds": 5.0, "peakRssMB": 1.0}}
+        slower = {"update_top_n": {"wallSeconds": 1.5, "peakRssMB": 150.0}}
+
+        self.assertEqual(compareResults(faster, baseline), [])
+        self.assertEqual(len(compareResults(slower, baseline)), 2)
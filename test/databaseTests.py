@@ -1,9 +1,26 @@
 import os
+import shutil
 import sqlite3
 import unittest
 
-from src.processing.databaseFunctions import splitFilename, createProcessingDatabase, updateProcessingStatus, \
-    createResultDatabase, insertEventsIntoDatabase, resultDatabaseRecordsToDataframe, updateProcessingDatabase
+import numpy as np
+
+import sys
+from pathlib import Path
+# The processing modules import each other as scripts, like processor.py run from src/processing
+sys.path.append(str(Path(__file__).parent.parent / "src" / "processing"))
+from databaseFunctions import splitFilename, createProcessingDatabase, updateProcessingStatus, \
+    createResultDatabase, insertEventsIntoDatabase, resultDatabaseRecordsToDataframe, updateProcessingDatabase, \
+    createSpatioTemporalTable, insertSpatioTemporalEventsIntoDatabase, getChunkProgress, updateChunkProgress, \
+    deleteEventsInTimeRange, addLeaseColumns, claimNextFile, renewLeases, releaseClaim, countActiveClaims, \
+    getClaimingWorkers, releaseAllClaims, insertStageMetrics, readStageMetrics, shardDatabasePath, shardDatabasePaths, \
+    mergeResultShards
+from stageMetrics import recordFileMetrics, stage, countEvents
+from metricsReport import summarizeFiles, summarizeStages
+from src.querying.queryFunctions import eventCoversCell, selectRecordsContaining
+from resultSink import ResultWriter
+from src.utils.footprints import encodeFootprints
+from processing_functions import processingInputPath
 
 
 class TestProcessingDatabase(unittest.TestCase):
@@ -30,17 +47,17 @@ class TestProcessingDatabase(unittest.TestCase):
 
         if os.path.exists(self.testProcessingDatabase):
             os.remove(self.testProcessingDatabase)
-        if os.path.exists(self.testResultDatabase):
-            os.remove(self.testResultDatabase)
-        for file in os.listdir(self.testDirectory):
-            os.remove(os.path.join(self.testDirectory, file))
-        os.rmdir(self.testDirectory)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.testResultDatabase + suffix):
+                os.remove(self.testResultDatabase + suffix)
+        shutil.rmtree(self.testDirectory)
 
     def testFilenameSplitting(self):
 
         self.assertEqual(splitFilename("var_2023.nc"), ("var","2023"))
         self.assertEqual(splitFilename("thisIsGonnaBeAnError.nc"), (None, None))
         self.assertEqual(splitFilename("var_202323.nc"), (None, None))
+        self.assertEqual(splitFilename("var_2023.zarr"), ("var","2023"))
 
     def testCreateProcessingDatabase(self):
 
@@ -55,7 +72,7 @@ class TestProcessingDatabase(unittest.TestCase):
         connection.close()
 
         self.assertEqual(len(records),1)
-        self.assertEqual(records[0][1:], ("var", 2023, "unprocessed"))
+        self.assertEqual(records[0][1:7], ("var", 2023, "unprocessed", None, None, len("test file")))
 
 
     def testUpdateProcessingDatabase(self):
@@ -69,7 +86,7 @@ class TestProcessingDatabase(unittest.TestCase):
 
         self.assertEqual(len(records),0)
 
-        updateProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+        self.assertEqual(updateProcessingDatabase(self.testDirectory, self.testProcessingDatabase), 1)
 
         records = cursor.execute("SELECT * FROM processing").fetchall()
         self.assertEqual(len(records),1)
@@ -77,6 +94,94 @@ class TestProcessingDatabase(unittest.TestCase):
         cursor.close()
         connection.close()
 
+    def updateWithChangedFiles(self, *args, **kwargs):
+        changedFiles = []
+        return updateProcessingDatabase(*args, changedFiles=changedFiles, **kwargs), changedFiles
+
+    def test_updateProcessingDatabase_changedFiles(self):
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+        updateProcessingStatus(self.testProcessingDatabase, 2023, "var", "processed")
+        with open(os.path.join(self.testDirectory, "var_2022.nc"), "w") as f:
+            f.write("test file")
+
+        with open(os.path.join(self.testDirectory, "var_tmp.nc"), "w") as f:
+            f.write("not an input")
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase), (1, []))
+        updateProcessingStatus(self.testProcessingDatabase, 2022, "var", "processed")
+
+        with open(os.path.join(self.testDirectory, "var_2023.nc"), "w") as f:
+            f.write("re-merged test file")
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase), (0, [("var", 2023)]))
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase), (0, []))
+
+        connection = sqlite3.connect(self.testProcessingDatabase)
+        records = connection.execute("SELECT year, status, fileSize FROM processing ORDER BY year").fetchall()
+        connection.close()
+        self.assertEqual(records, [(2022, "processed", 9), (2023, "unprocessed", 19)])
+
+    def test_updateProcessingDatabase_contentHash(self):
+        path = os.path.join(self.testDirectory, "var_2023.nc")
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase, contentHash=True)
+
+        # Only touched, the contents are the same
+        os.utime(path, (0, 0))
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase, contentHash=True),
+                         (0, []))
+
+        with open(path, "w") as f:
+            f.write("test fil3")
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase, contentHash=True),
+                         (0, [("var", 2023)]))
+
+    def test_updateProcessingDatabase_zarrStores(self):
+        store = os.path.join(self.testDirectory, "var_2022.zarr")
+        os.makedirs(os.path.join(store, "tp"))
+        for name, contents in [(".zmetadata", "{}"), ("tp/0.0.0", "chunk")]:
+            with open(os.path.join(store, name), "w") as f:
+                f.write(contents)
+        # A store converted from a fingerprinted file doesn't make it a changed file
+        shutil.copytree(store, os.path.join(self.testDirectory, "var_2023.zarr"))
+
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+        connection = sqlite3.connect(self.testProcessingDatabase)
+        records = connection.execute("SELECT year, fileSize FROM processing ORDER BY year").fetchall()
+        connection.close()
+        self.assertEqual(records, [(2022, len("{}chunk")), (2023, len("test file"))])
+
+        with open(os.path.join(store, "tp/0.0.0"), "w") as f:
+            f.write("changed chunk")
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase), (0, [("var", 2022)]))
+
+    def test_processingInputPath(self):
+        netcdfPath = os.path.join(self.testDirectory, "var_2023.nc")
+        zarrPath = os.path.join(self.testDirectory, "var_2023.zarr")
+        self.assertEqual(processingInputPath(self.testDirectory, "var", 2023), netcdfPath)
+
+        os.makedirs(zarrPath)
+        self.assertEqual(processingInputPath(self.testDirectory, "var", 2023), zarrPath)
+
+        # The NetCDF file was merged again after the conversion
+        os.utime(zarrPath, (0, 0))
+        self.assertEqual(processingInputPath(self.testDirectory, "var", 2023), netcdfPath)
+        os.remove(netcdfPath)
+        self.assertEqual(processingInputPath(self.testDirectory, "var", 2023), zarrPath)
+
+    def test_updateProcessingDatabase_migration(self):
+        connection = sqlite3.connect(self.testProcessingDatabase)
+        connection.execute("CREATE TABLE processing (id INTEGER PRIMARY KEY, variable TEXT, year INTEGER, status TEXT)")
+        connection.executemany("INSERT INTO processing (variable, year, status) VALUES (?, ?, ?)",
+                               [("var", 2023, "processed"), ("var", 2023, "unprocessed")])
+        connection.commit()
+        connection.close()
+
+        # Files recorded without a fingerprint don't count as changed
+        self.assertEqual(self.updateWithChangedFiles(self.testDirectory, self.testProcessingDatabase), (0, []))
+
+        connection = sqlite3.connect(self.testProcessingDatabase)
+        records = connection.execute("SELECT variable, year, status, fileSize FROM processing").fetchall()
+        connection.close()
+        self.assertEqual(records, [("var", 2023, "processed", 9)])
+
     def testUpdateProcessingStatus(self):
         createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
         updateProcessingStatus(self.testProcessingDatabase, 2023, "var", "processed")
@@ -129,10 +234,366 @@ class TestProcessingDatabase(unittest.TestCase):
 
         self.assertEqual(len(records), 1)
         self.assertEqual(records[0][1:],
-                         ("wind", "2024-01-01", 10.0, 20.0, 30.0, 40.0, 15.0, 35.0, 50.0, 25.0, 100))
+                         ("wind", 1704067200, 10.0, 20.0, 30.0, 40.0, 15.0, 35.0, 50.0, 25.0, 100, None))
+
+    def test_insertColumnarEventsIntoDatabase(self):
+        createResultDatabase(self.testResultDatabase)
+        events = {
+            "eventTime": np.array(["2024-01-01", "2024-01-02"], dtype=object),
+            "eventID": np.array([1, 1]),
+            "minLatitude": np.array([10.0, 11.0]), "maxLatitude": np.array([20.0, 21.0]),
+            "minLongitude": np.array([30.0, 31.0]), "maxLongitude": np.array([40.0, 41.0]),
+            "centroidLatitude": np.array([15.0, 16.0]), "centroidLongitude": np.array([35.0, 36.0]),
+            "maxEventValue": np.array([50.0, 51.0]), "meanEventValue": np.array([25.0, 26.0]),
+            "areaInCells": np.array([100, 101]), "threshold": np.array([20.8, 24.5])
+        }
+        insertEventsIntoDatabase(self.testResultDatabase, "wind", events)
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        cursor = connection.cursor()
+        records = cursor.execute("SELECT * FROM thresholdResults ORDER BY id").fetchall()
+        cursor.close()
+        connection.close()
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1][1:],
+                         ("wind", 1704153600, 11.0, 21.0, 31.0, 41.0, 16.0, 36.0, 51.0, 26.0, 101, 24.5))
+
+    def test_resultDatabaseIndexes(self):
+        # A result table of an older version without indexes
+        connection = sqlite3.connect(self.testResultDatabase)
+        connection.execute("CREATE TABLE thresholdResults (id INTEGER PRIMARY KEY, eventType TEXT, eventTime DATE, "
+                           "minLatitude FLOAT, maxLatitude FLOAT, minLongitude FLOAT, maxLongitude FLOAT, "
+                           "centroidLatitude FLOAT, centroidLongitude FLOAT, maxEventValue FLOAT, "
+                           "meanEventValue FLOAT, eventArea INT)")
+        connection.execute("INSERT INTO thresholdResults (eventType, eventTime, minLatitude, maxLatitude, minLongitude, "
+                           "maxLongitude) VALUES ('wind', '2024-01-01', 49.5, 50.25, 8.0, 9.0)")
+        connection.commit()
+        connection.close()
+
+        createResultDatabase(self.testResultDatabase)
+        insertEventsIntoDatabase(self.testResultDatabase, "rain", [
+            {"eventTime": "2024-01-02", "minLatitude": 50.0, "maxLatitude": 50.0, "minLongitude": 8.5,
+             "maxLongitude": 8.5},
+            {"eventTime": "2024-01-02", "minLatitude": 10.0, "maxLatitude": 20.0, "minLongitude": 30.0,
+             "maxLongitude": 40.0},
+            {"eventTime": "2024-01-03"}])
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        cursor = connection.cursor()
+        self.assertEqual(cursor.execute("SELECT id FROM thresholdResults_rtree ORDER BY id").fetchall(),
+                         [(1,), (2,), (3,)])
+        plan = cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM thresholdResults "
+                              "WHERE eventType = 'rain' AND eventTime >= '2024-01-02'").fetchall()
+        self.assertIn("thresholdResults_type_time", plan[0][3])
+
+        self.assertEqual([record[0] for record in selectRecordsContaining(cursor, "thresholdResults", 50.0, 8.5)],
+                         [1, 2])
+        self.assertEqual([record[0] for record in selectRecordsContaining(
+            cursor, "thresholdResults", 50.0, 8.5, "thresholdResults.eventType = ?", ("rain",))], [2])
+        cursor.close()
+        connection.close()
+
+        deleteEventsInTimeRange(self.testResultDatabase, ["rain"], "2024-01-02", "2024-01-02")
+        connection = sqlite3.connect(self.testResultDatabase)
+        self.assertEqual(connection.execute("SELECT id FROM thresholdResults_rtree").fetchall(), [(1,)])
+        connection.close()
+
+    def test_migrateEventTimes(self):
+        # Result tables of an older version with times stored as strings
+        connection = sqlite3.connect(self.testResultDatabase)
+        connection.execute("CREATE TABLE thresholdResults (id INTEGER PRIMARY KEY, eventType TEXT, eventTime DATE, "
+                           "minLatitude FLOAT, maxLatitude FLOAT, minLongitude FLOAT, maxLongitude FLOAT, "
+                           "centroidLatitude FLOAT, centroidLongitude FLOAT, maxEventValue FLOAT, "
+                           "meanEventValue FLOAT, eventArea INT, threshold FLOAT)")
+        connection.execute("INSERT INTO thresholdResults (id, eventType, eventTime, minLatitude, maxLatitude, "
+                           "minLongitude, maxLongitude) VALUES (5, 'wind', '2024-01-01T01:00:00.000000000', 1, 2, 3, 4)")
+        connection.execute("CREATE TABLE spatioTemporalResults (id INTEGER PRIMARY KEY, eventType TEXT, "
+                           "startTime DATE, endTime DATE, peakTime DATE, minLatitude FLOAT, maxLatitude FLOAT, "
+                           "minLongitude FLOAT, maxLongitude FLOAT)")
+        connection.execute("INSERT INTO spatioTemporalResults (eventType, startTime, endTime, peakTime) VALUES "
+                           "('wind', '2024-01-01T00:00:00.000000000', '2024-01-02T00:00:00.000000000', "
+                           "'2024-01-01T12:00:00.000000000')")
+        connection.commit()
+        connection.close()
+
+        createResultDatabase(self.testResultDatabase)
+        createSpatioTemporalTable(self.testResultDatabase)
+        # A second run finds the migrated tables
+        createResultDatabase(self.testResultDatabase)
+        insertEventsIntoDatabase(self.testResultDatabase, "wind", [{"eventTime": 1704070800, "minLatitude": 1.0,
+                                                                    "maxLatitude": 2.0, "minLongitude": 3.0,
+                                                                    "maxLongitude": 4.0}])
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        self.assertEqual(connection.execute("SELECT id, eventTime, typeof(eventTime) FROM thresholdResults").fetchall(),
+                         [(5, 1704070800, "integer"), (6, 1704070800, "integer")])
+        self.assertEqual(connection.execute("SELECT startTime, endTime, peakTime FROM spatioTemporalResults").fetchall(),
+                         [(1704067200, 1704153600, 1704110400)])
+        self.assertEqual(connection.execute("SELECT id FROM thresholdResults_rtree").fetchall(), [(5,), (6,)])
+        connection.close()
+
+        df = resultDatabaseRecordsToDataframe([(5, "wind", 1704070800) + (None,) * 10])
+        self.assertEqual(str(df.iloc[0]["eventTime"]), "2024-01-01 01:00:00")
+
+    def test_insertEventsWithFootprints(self):
+        createResultDatabase(self.testResultDatabase)
+        insertEventsIntoDatabase(self.testResultDatabase, "wind", [{"eventTime": "2024-01-01", "areaInCells": 1}])
+
+        # Two events on a 0.25° grid: an L over rows 0-1 and a single cell
+        footprints = encodeFootprints(np.array([0, 0, 1]), np.array([0, 1, 3]), np.array([0, 0, 2]),
+                                      np.array([3, 1, 1]), 2, np.array([50.0, 49.75, 49.5, 49.25]),
+                                      np.array([0.0, 0.25, 0.5]))
+        events = {
+            "eventTime": np.array(["2024-01-02", "2024-01-02"], dtype=object),
+            "minLatitude": np.array([49.75, 49.25]), "maxLatitude": np.array([50.0, 49.25]),
+            "minLongitude": np.array([0.0, 0.5]), "maxLongitude": np.array([0.5, 0.5]),
+            "centroidLatitude": np.array([49.9, 49.25]), "centroidLongitude": np.array([0.2, 0.5]),
+            "maxEventValue": np.array([50.0, 51.0]), "meanEventValue": np.array([25.0, 26.0]),
+            "areaInCells": np.array([4, 1]), "threshold": np.array([20.8, 20.8]), "footprint": footprints
+        }
+        insertEventsIntoDatabase(self.testResultDatabase, "wind", events)
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        eventIds = [row[0] for row in connection.execute("SELECT eventId FROM eventFootprints ORDER BY eventId")]
+        connection.close()
+
+        self.assertEqual(eventIds, [2, 3])
+        self.assertTrue(eventCoversCell(2, 49.75, 0.0, self.testResultDatabase))
+        self.assertFalse(eventCoversCell(2, 49.75, 0.5, self.testResultDatabase))
+        self.assertTrue(eventCoversCell(3, 49.25, 0.5, self.testResultDatabase))
+        self.assertIsNone(eventCoversCell(1, 50.0, 0.0, self.testResultDatabase))
+
+    def test_createResultDatabase_addsThresholdColumn(self):
+        connection = sqlite3.connect(self.testResultDatabase)
+        connection.execute("CREATE TABLE thresholdResults (id INTEGER PRIMARY KEY, eventType TEXT, eventTime DATE, "
+                           "minLatitude FLOAT, maxLatitude FLOAT, minLongitude FLOAT, maxLongitude FLOAT, "
+                           "centroidLatitude FLOAT, centroidLongitude FLOAT, maxEventValue FLOAT, "
+                           "meanEventValue FLOAT, eventArea INT)")
+        connection.commit()
+        connection.close()
+
+        createResultDatabase(self.testResultDatabase)
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(thresholdResults)").fetchall()]
+        connection.close()
+
+        self.assertIn("threshold", columns)
+
+    def test_insertSpatioTemporalEventsIntoDatabase(self):
+        createSpatioTemporalTable(self.testResultDatabase)
+        events = {
+            "startTime": np.array(["2024-01-01T00:00:00"], dtype=object),
+            "endTime": np.array(["2024-01-02T05:00:00"], dtype=object),
+            "peakTime": np.array(["2024-01-01T12:00:00"], dtype=object),
+            "durationHours": np.array([30.0]),
+            "minLatitude": np.array([10.0]), "maxLatitude": np.array([20.0]),
+            "minLongitude": np.array([30.0]), "maxLongitude": np.array([40.0]),
+            "centroidLatitude": np.array([15.0]), "centroidLongitude": np.array([35.0]),
+            "maxEventValue": np.array([50.0]), "meanEventValue": np.array([25.0]),
+            "areaInCells": np.array([100]), "cellHours": np.array([100.0])
+        }
+        insertSpatioTemporalEventsIntoDatabase(self.testResultDatabase, "windgustHourly", events)
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        records = connection.execute("SELECT eventType, durationHours, eventArea FROM spatioTemporalResults").fetchall()
+        connection.close()
+
+        self.assertEqual(records, [("windgustHourly", 30.0, 100)])
+
+    def test_chunkProgress(self):
+        self.assertIsNone(getChunkProgress(self.testProcessingDatabase, 2023, "wind"))
+
+        updateChunkProgress(self.testProcessingDatabase, 2023, "wind", 0)
+        updateChunkProgress(self.testProcessingDatabase, 2023, "wind", 168)
+        self.assertEqual(getChunkProgress(self.testProcessingDatabase, 2023, "wind"), 168)
+        self.assertIsNone(getChunkProgress(self.testProcessingDatabase, 2022, "wind"))
+
+        updateChunkProgress(self.testProcessingDatabase, 2023, "wind", None)
+        self.assertIsNone(getChunkProgress(self.testProcessingDatabase, 2023, "wind"))
+
+    def test_deleteEventsInTimeRange(self):
+        createResultDatabase(self.testResultDatabase)
+        createSpatioTemporalTable(self.testResultDatabase)
+        footprints = encodeFootprints(np.arange(3), np.zeros(3), np.zeros(3), np.ones(3), 3,
+                                      np.array([50.0, 49.75]), np.array([0.0, 0.25]))
+        events = {
+            "eventTime": np.array(["2024-01-01T00:00:00", "2024-01-02T00:00:00", "2024-01-03T00:00:00"], dtype=object),
+            "areaInCells": np.array([1, 1, 1]), "footprint": footprints
+        }
+        insertEventsIntoDatabase(self.testResultDatabase, "wind", events)
+        insertEventsIntoDatabase(self.testResultDatabase, "rainHourly", events)
+        insertSpatioTemporalEventsIntoDatabase(self.testResultDatabase, "wind", {
+            "startTime": np.array(["2024-01-01T00:00:00"], dtype=object)})
+
+        deleted = deleteEventsInTimeRange(self.testResultDatabase, ["wind"], "2024-01-02T00:00:00",
+                                          "2024-01-03T00:00:00", "2024-01-01T00:00:00")
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        remaining = connection.execute("SELECT eventType, eventTime FROM thresholdResults ORDER BY id").fetchall()
+        numFootprints = connection.execute("SELECT count(*) FROM eventFootprints").fetchone()[0]
+        numSpatioTemporal = connection.execute("SELECT count(*) FROM spatioTemporalResults").fetchone()[0]
+        connection.close()
+
+        self.assertEqual(deleted, 3)
+        self.assertEqual(remaining[0], ("wind", 1704067200))
+        self.assertEqual(len(remaining), 4)
+        self.assertEqual(numFootprints, 4)
+        self.assertEqual(numSpatioTemporal, 0)
+
+    def test_mergeResultShards(self):
+        createResultDatabase(self.testResultDatabase)
+        createSpatioTemporalTable(self.testResultDatabase)
+        footprints = encodeFootprints(np.arange(3), np.zeros(3), np.zeros(3), np.ones(3), 3, np.array([50.0]),
+                                      np.array([0.0]))
+        insertEventsIntoDatabase(self.testResultDatabase, "wind",
+                                 {"eventTime": np.array(["2023-01-01"]), "minLatitude": np.array([50.0]),
+                                  "maxLatitude": np.array([50.0]), "minLongitude": np.array([0.0]),
+                                  "maxLongitude": np.array([0.0]), "areaInCells": np.array([1]),
+                                  "footprint": footprints[:1]})
+
+        shards = [shardDatabasePath(f"host:{pid}:task0", self.testDirectory) for pid in (1, 2)]
+        for index, shard in enumerate(shards):
+            createResultDatabase(shard, indexes=False)
+            createSpatioTemporalTable(shard, indexes=False)
+            insertEventsIntoDatabase(shard, "rain",
+                                     {"eventTime": np.array([f"2023-01-0{index + 2}"]), "minLatitude": np.array([50.0]),
+                                      "maxLatitude": np.array([50.0]), "minLongitude": np.array([0.0]),
+                                      "maxLongitude": np.array([0.0]), "areaInCells": np.array([1]),
+                                      "footprint": footprints[index + 1:index + 2]})
+            insertSpatioTemporalEventsIntoDatabase(shard, "rain", {"startTime": np.array(["2023-01-05"])})
+        self.assertEqual(shardDatabasePaths(self.testDirectory), shards)
+        connection = sqlite3.connect(shards[0])
+        self.assertEqual(connection.execute("SELECT name FROM sqlite_master WHERE name LIKE '%rtree%'").fetchall(), [])
+        connection.close()
+
+        # The writer of the second shard deletes the events an interrupted run stored in the first shard
+        writer = ResultWriter(shards[1], self.testProcessingDatabase, otherDatabases=lambda: shards)
+        with writer:
+            writer.deleteEvents(["rain"], "2023-01-02", "2023-01-02")
+        connection = sqlite3.connect(shards[0])
+        self.assertEqual(connection.execute("SELECT count(*) FROM thresholdResults").fetchone()[0], 0)
+        connection.close()
+
+        self.assertEqual(mergeResultShards(self.testResultDatabase, shards), 3)
+        self.assertEqual(shardDatabasePaths(self.testDirectory), [])
+
+        connection = sqlite3.connect(self.testResultDatabase)
+        self.assertEqual(connection.execute("SELECT id, eventType, eventTime FROM thresholdResults ORDER BY id").fetchall(),
+                         [(1, "wind", 1672531200), (2, "rain", 1672704000)])
+        self.assertEqual(connection.execute("SELECT count(*) FROM spatioTemporalResults").fetchone()[0], 2)
+        self.assertEqual(connection.execute("SELECT id FROM thresholdResults_rtree ORDER BY id").fetchall(), [(1,), (2,)])
+        self.assertEqual(connection.execute("SELECT eventId, footprint FROM eventFootprints ORDER BY eventId").fetchall(),
+                         [(1, footprints[0]), (2, footprints[2])])
+        connection.close()
+
+        # A node finalizing after the merge finds no shards and keeps the indexes
+        self.assertEqual(mergeResultShards(self.testResultDatabase, shards), 0)
+        connection = sqlite3.connect(self.testResultDatabase)
+        self.assertEqual(connection.execute("SELECT id FROM thresholdResults_rtree ORDER BY id").fetchall(), [(1,), (2,)])
+        connection.close()
+
+    def test_claimNextFile(self):
+        with open(os.path.join(self.testDirectory, "var_2022.nc"), "w") as f:
+            f.write("test file")
+        with open(os.path.join(self.testDirectory, "other_2023.nc"), "w") as f:
+            f.write("test file")
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+
+        first = claimNextFile(self.testProcessingDatabase, "node1", 60, excluded=[(2023, "other")])
+        # Another variable comes before the next year of the claimed one
+        second = claimNextFile(self.testProcessingDatabase, "node2", 60)
+        third = claimNextFile(self.testProcessingDatabase, "node2", 60, excluded=[(2022, "var")])
+
+        self.assertEqual(first, (2023, "var"))
+        self.assertEqual(second, (2023, "other"))
+        self.assertIsNone(third)
+        self.assertEqual(countActiveClaims(self.testProcessingDatabase), 2)
+
+        releaseClaim(self.testProcessingDatabase, 2023, "var", "node1")
+        updateProcessingStatus(self.testProcessingDatabase, 2023, "var", "processed")
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "node1", 60), (2022, "var"))
+        self.assertIsNone(claimNextFile(self.testProcessingDatabase, "node1", 60))
+
+    def test_claimNextFile_runtimes(self):
+        with open(os.path.join(self.testDirectory, "other_2022.nc"), "w") as f:
+            f.write("test file")
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+        runtimes = {"var": 10.0, "other": 60.0}
+
+        # The files of the longer running variable come first, the variable in progress comes last
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "node1", 60, runtimes=runtimes), (2022, "other"))
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "node1", 60, runtimes=runtimes), (2023, "var"))
+
+    def test_expiredLeaseIsReclaimed(self):
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "crashed", -1), (2023, "var"))
+        self.assertEqual(countActiveClaims(self.testProcessingDatabase), 0)
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "node1", 60), (2023, "var"))
+
+        # The crashed worker lost its claim and can't renew or release it anymore
+        self.assertEqual(renewLeases(self.testProcessingDatabase, "crashed", 60), 0)
+        self.assertEqual(renewLeases(self.testProcessingDatabase, "node1", 60), 1)
+        releaseClaim(self.testProcessingDatabase, 2023, "var", "crashed")
+        self.assertEqual(countActiveClaims(self.testProcessingDatabase), 1)
+        self.assertEqual(getClaimingWorkers(self.testProcessingDatabase), ["node1"])
+
+        self.assertEqual(releaseAllClaims(self.testProcessingDatabase, "node1"), 1)
+        self.assertEqual(countActiveClaims(self.testProcessingDatabase), 0)
+
+    def test_addLeaseColumns(self):
+        connection = sqlite3.connect(self.testProcessingDatabase)
+        connection.execute("CREATE TABLE processing (id INTEGER PRIMARY KEY, variable TEXT, year INTEGER, status TEXT)")
+        connection.execute("INSERT INTO processing (variable, year, status) VALUES ('var', 2023, 'failed')")
+        connection.commit()
+        connection.close()
+
+        addLeaseColumns(self.testProcessingDatabase)
+        addLeaseColumns(self.testProcessingDatabase)
+
+        self.assertEqual(claimNextFile(self.testProcessingDatabase, "node1", 60), (2023, "var"))
+
+    def test_recordFileMetrics(self):
+        with recordFileMetrics(2023, "var", enabled=True) as metrics:
+            for _ in range(2):
+                with stage("labeling"):
+                    countEvents({"eventTime": np.array(["2023-01-01", "2023-01-02"])})
+                with stage("insert"):
+                    pass
+        # Outside of a file nothing is recorded
+        with stage("labeling"):
+            countEvents([1])
+
+        rows = {row[0]: row for row in metrics.rows()}
+        self.assertEqual(set(rows), {"file", "labeling", "insert"})
+        self.assertEqual(rows["labeling"][1], 2)
+        self.assertEqual(rows["labeling"][6], 4)
+        self.assertEqual(rows["file"][6], 4)
+        self.assertEqual(rows["insert"][6], 0)
+        self.assertGreaterEqual(rows["file"][2], rows["labeling"][2] + rows["insert"][2])
+
+    def test_stageMetrics(self):
+        insertStageMetrics(self.testProcessingDatabase, 2023, "var", "2024-01-01T00:00:00",
+                           [("file", 1, 8.0, 6.0, 100.0, 1024**2, 10), ("labeling", 2, 4.0, 4.0, 90.0, 0, 10)])
+        insertStageMetrics(self.testProcessingDatabase, 2023, "var", "2024-02-01T00:00:00",
+                           [("file", 1, 4.0, 2.0, 100.0, 2 * 1024**2, 10), ("labeling", 2, 1.0, 1.0, 90.0, 0, 10)])
+
+        self.assertEqual(len(readStageMetrics(self.testProcessingDatabase, latestOnly=False)), 4)
+        metrics = readStageMetrics(self.testProcessingDatabase)
+        files = summarizeFiles(metrics)
+        stages = summarizeStages(metrics)
+
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files.iloc[0]["wallSeconds"], 4.0)
+        self.assertEqual(files.iloc[0]["readMBPerSecond"], 0.5)
+        self.assertEqual(files.iloc[0]["eventsPerSecond"], 2.5)
+        self.assertEqual(stages.iloc[0]["stage"], "labeling")
+        self.assertEqual(stages.iloc[0]["shareOfFile"], 0.25)
 
     def test_resultDatabaseRecordsToDataframe(self):
-        records = [(1, "wind", "2024-01-01", 10.0, 20.0, 30.0, 40.0, 15.0, 35.0, 50.0, 25.0, 100)]
+        records = [(1, "wind", 1704067200, 10.0, 20.0, 30.0, 40.0, 15.0, 35.0, 50.0, 25.0, 100, 20.8)]
         df = resultDatabaseRecordsToDataframe(records)
 
         self.assertEqual(len(df), 1)
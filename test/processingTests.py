@@ -1,8 +1,32 @@
 import unittest
 import numpy as np
 import xarray as xr
-from src.processing.processing_functions import update_top_n, labelSlice, getLabeledEvents, getConnectedEvents
+import sys
+from pathlib import Path
+# The processing modules import each other as scripts, like processor.py run from src/processing
+sys.path.append(str(Path(__file__).parent.parent / "src" / "processing"))
+from processing_functions import update_top_n, labelSlice, getLabeledEvents, getConnectedEvents, \
+    getLabeledStatistics, labelVolume, getSpatioTemporalEvents, labelNestedThresholds, splitPrecipitationChunk, \
+    convertToZarr, openProcessingDataset, zarr, mergeTopN
 import warnings
+import tempfile
+from topNAccumulator import TopNAccumulator, mergeTopNAccumulators, updateTopNPartial, \
+    combineTopNPartials, exportTopNPartials, removeTopNPartial
+from src.utils.footprints import footprintContains, footprintCells
+from src.utils.eventTimes import epochSeconds
+from samplingProfiler import SamplingProfiler, shouldProfile
+from inputPrefetcher import InputPrefetcher, Prefetch
+from databaseFunctions import createChunkProgressTable, createResultDatabase, createSpatioTemporalTable
+from resultSink import DatabaseSink, useResultSink
+from processWind import windPipeline
+from processWindgust import windgustPipeline
+from thresholdEvents import processThresholdEvents
+from stageMetrics import recordFileMetrics
+from memoryScheduler import JobEstimate, MemoryBudget, estimateJob, VOLUME_LABELING_BYTES, LABELING_BYTES
+from src.config import SPATIOTEMPORAL_TABLENAME, EVENT_THRESHOLDS
+import os
+import time
+import sqlite3
 
 class TestProcessingFunctions(unittest.TestCase):
 
@@ -33,6 +57,41 @@ class TestProcessingFunctions(unittest.TestCase):
         self.assertIn("top_valid_time", result, "Output dataset should contain corresponding times")
         self.assertEqual(result[f"top_test_var"].shape[0], 10, "Top values dataset should have rank 10")
 
+    def test_update_top_n_streaming(self):
+        full = update_top_n(self.dataset, "test_var", topN=2)
+        chunked = update_top_n(self.dataset, "test_var", topN=2, timeChunkSize=1)
+        lowest = update_top_n(self.dataset, "test_var", topN=2, highest=False)
+        lowestChunked = update_top_n(self.dataset, "test_var", topN=2, highest=False, memoryBudget=1)
+        xr.testing.assert_identical(full, chunked)
+        xr.testing.assert_identical(lowest, lowestChunked)
+
+        # the running top N of the first two timesteps merged with the last one equals the top N of all timesteps
+        partial = update_top_n(self.dataset.isel(valid_time=slice(0, 2)), "test_var", topN=2)
+        merged = update_top_n(self.dataset.isel(valid_time=slice(2, 3)), "test_var", oldTop10=partial, topN=2)
+        xr.testing.assert_identical(full, merged)
+
+    def test_mergeTopN_ties(self):
+        # Few distinct values, so most ranks are tied
+        values = np.random.randint(0, 4, (48, 20)).astype(float)
+        times = np.arange(48)
+        empty = (np.full((5, 20), np.nan), np.zeros((5, 20), dtype=int))
+        expected = mergeTopN(*empty, values, times)
+
+        # Equal values are ranked and kept by their earliest time
+        for point in range(20):
+            ranking = sorted(zip(-values[:, point], times))[:5]
+            np.testing.assert_array_equal(expected[0][:, point], [-value for value, _ in ranking])
+            np.testing.assert_array_equal(expected[1][:, point], [time for _, time in ranking])
+
+        # The result doesn't depend on how the candidates are split into chunks or on their order
+        for chunkSize in [1, 7, 16]:
+            for starts in [range(0, 48, chunkSize), reversed(range(0, 48, chunkSize))]:
+                top = empty
+                for start in starts:
+                    top = mergeTopN(*top, values[start:start + chunkSize], times[start:start + chunkSize])
+                np.testing.assert_array_equal(top[0], expected[0])
+                np.testing.assert_array_equal(top[1], expected[1])
+
     def test_labelSlice(self):
         testArray = np.array([[1, 1, 0], [0, 1, 1], [1, 0, 0]])
         labeled = labelSlice(testArray, diagonals=True)
@@ -65,6 +124,570 @@ class TestProcessingFunctions(unittest.TestCase):
         events = getConnectedEvents(empty_dataset, "test_var", 1.0)
         self.assertEqual(len(events), 0, "Should return an empty list when no events exceed the threshold")
 
+        noTimes = self.dataset.isel(valid_time=slice(0, 0))
+        self.assertEqual(getConnectedEvents(noTimes, "test_var", 1.0), [])
+
+    def test_getLabeledStatistics(self):
+        labels = np.array([[1, 1, 0], [0, 0, 2], [0, 2, 2]])
+        values = np.array([[1.0, 3.0, 0.0], [0.0, 0.0, 4.0], [0.0, 6.0, 2.0]])
+        stats = getLabeledStatistics(labels, values, np.array([10.0, 20.0, 30.0]), np.array([0.0, 1.0, 2.0]))
+
+        self.assertEqual(stats["eventID"].tolist(), [1, 2])
+        self.assertEqual(stats["areaInCells"].tolist(), [2, 3])
+        self.assertEqual(stats["minLatitude"].tolist(), [10.0, 20.0])
+        self.assertEqual(stats["maxLongitude"].tolist(), [1.0, 2.0])
+        self.assertEqual(stats["maxEventValue"].tolist(), [3.0, 6.0])
+        self.assertAlmostEqual(stats["meanEventValue"][1], 4.0)
+        self.assertAlmostEqual(stats["centroidLatitude"][1], 80.0 / 3)
+
+    def test_getConnectedEvents_columnar(self):
+        events = getConnectedEvents(self.dataset, "test_var", 0.5)
+        columns = getConnectedEvents(self.dataset, "test_var", 0.5, timeChunkSize=2, columnar=True)
+
+        self.assertEqual(len(columns["eventID"]), len(events))
+        for i, event in enumerate(events):
+            self.assertEqual(event["eventTime"], columns["eventTime"][i])
+            self.assertEqual(event["areaInCells"], columns["areaInCells"][i])
+            self.assertAlmostEqual(event["meanEventValue"], columns["meanEventValue"][i])
+
+    def test_getConnectedEvents_dask(self):
+        eager = getConnectedEvents(self.dataset, "test_var", 0.5, columnar=True)
+        chunked = getConnectedEvents(self.dataset.chunk({"valid_time": 2}), "test_var", 0.5, columnar=True)
+
+        self.assertEqual(eager.keys(), chunked.keys())
+        for name in eager:
+            self.assertEqual(eager[name].tolist(), chunked[name].tolist())
+
+    def test_labelNestedThresholds(self):
+        values = np.random.rand(20, 30)
+        thresholds = [0.3, 0.6, 0.9, 2.0]
+        for diagonals in [True, False]:
+            labels = labelNestedThresholds(values, thresholds, diagonals)
+
+            self.assertEqual(len(labels), len(thresholds))
+            for threshold, levelLabels in zip(thresholds, labels):
+                np.testing.assert_array_equal(levelLabels, labelSlice(values > threshold, diagonals))
+
+        # Few small regions on a large grid are labeled one lower region at a time
+        sparse = np.zeros((400, 500))
+        sparse[350:380, 10:40] = np.random.rand(30, 30)
+        sparse[5:25, 450:480] = np.random.rand(20, 30)
+        for threshold, levelLabels in zip(thresholds, labelNestedThresholds(sparse, thresholds)):
+            np.testing.assert_array_equal(levelLabels, labelSlice(sparse > threshold))
+
+    def test_getConnectedEvents_multipleThresholds(self):
+        events = getConnectedEvents(self.dataset, "test_var", [0.8, 0.5], timeChunkSize=2, columnar=True)
+
+        offset = 0
+        for threshold in [0.5, 0.8]:
+            single = getConnectedEvents(self.dataset, "test_var", threshold, columnar=True)
+            count = len(single["eventID"])
+            for name in single:
+                self.assertEqual(single[name].tolist(), events[name][offset:offset + count].tolist())
+            self.assertTrue(np.all(single["threshold"] == threshold))
+            offset += count
+        self.assertEqual(offset, len(events["eventID"]))
+
+    def test_labelVolume(self):
+        volume = np.zeros((3, 5, 5), dtype=bool)
+        volume[0, 0, 0] = volume[1, 1, 1] = volume[2, 1, 1] = True
+        volume[0, 4, 4] = True
+        self.assertEqual(labelVolume(volume, diagonals=True).max(), 2)
+        self.assertEqual(labelVolume(volume, diagonals=False).max(), 3)
+
+    def test_getSpatioTemporalEvents(self):
+        data = np.zeros((len(self.times), len(self.latitudes), len(self.longitudes)))
+        # one event moving over all three timesteps and one single cell event
+        data[0, 1, 1] = 2.0
+        data[1, 1, 2] = 5.0
+        data[2, 2, 2] = 3.0
+        data[2, 4, 0] = 1.5
+        dataset = self.dataset.assign(test_var=(['valid_time', 'latitude', 'longitude'], data))
+
+        events = getSpatioTemporalEvents(dataset, "test_var", 1.0)
+        times = dataset.valid_time.values
+
+        self.assertEqual(len(events["startTime"]), 2)
+        self.assertEqual(events["startTime"][0], epochSeconds(times[0]))
+        self.assertEqual(events["endTime"][0], epochSeconds(times[2]))
+        self.assertEqual(events["peakTime"][0], epochSeconds(times[1]))
+        self.assertEqual(events["durationHours"].tolist(), [72.0, 24.0])
+        self.assertEqual(events["maxEventValue"].tolist(), [5.0, 1.5])
+        self.assertEqual(events["areaInCells"].tolist(), [3, 1])
+        self.assertEqual(events["cellHours"].tolist(), [72.0, 24.0])
+        self.assertEqual(events["minLongitude"][0], self.longitudes[1])
+        self.assertEqual(events["maxLatitude"][0], self.latitudes[2])
+
+    def test_splitPrecipitationChunk(self):
+        rng = np.random.default_rng(0)
+        times = np.datetime64('2023-01-01T00', 'h') + np.arange(48)
+        tp = rng.random((48, 5, 5)).astype(np.float32)
+        tp[3, 2, 2] = np.nan
+        ptype = rng.choice([0, 1, 3, 5, 6, np.nan], tp.shape).astype(np.float32)
+        dims = ['valid_time', 'latitude', 'longitude']
+        dataset = xr.Dataset({"tp": (dims, tp), "ptype": (dims, ptype)},
+                             coords={"valid_time": times, "latitude": self.latitudes, "longitude": self.longitudes})
+
+        rainHourly, dailyTotal, dailyRain, dailySnow = splitPrecipitationChunk(tp, ptype, [1, 3, 7, 12], [5, 6, 8])
+
+        expectedRain = dataset.tp.where(dataset.ptype.isin([1, 3, 7, 12]), 0)
+        expectedSnow = dataset.tp.where(dataset.ptype.isin([5, 6, 8]), 0)
+        np.testing.assert_array_equal(rainHourly, expectedRain.values)
+        np.testing.assert_allclose(dailyTotal, dataset.tp.coarsen(valid_time=24).sum().values, rtol=1e-6)
+        np.testing.assert_allclose(dailyRain, expectedRain.coarsen(valid_time=24).sum().values, rtol=1e-6)
+        np.testing.assert_allclose(dailySnow, expectedSnow.coarsen(valid_time=24).sum().values, rtol=1e-6)
+
+        with self.assertRaises(ValueError):
+            splitPrecipitationChunk(tp[:30], ptype[:30], [1], [5])
+
+    def test_getConnectedEvents_footprints(self):
+        data = np.zeros((len(self.times), len(self.latitudes), len(self.longitudes)))
+        # L-shaped event, its bounding box contains cells it doesn't cover
+        data[0, 0, 0:3] = 2.0
+        data[0, 1:4, 0] = 2.0
+        data[1, 4, 4] = 2.0
+        dataset = self.dataset.assign(test_var=(['valid_time', 'latitude', 'longitude'], data))
+
+        events = getConnectedEvents(dataset, "test_var", 1.0, columnar=True, footprints=True)
+        self.assertEqual(len(events["footprint"]), 2)
+
+        latitudes, longitudes = footprintCells(events["footprint"][0])
+        self.assertEqual(sorted(zip(latitudes.tolist(), longitudes.tolist())),
+                         sorted((self.latitudes[i], self.longitudes[j]) for i, j in zip(*np.nonzero(data[0]))))
+        self.assertTrue(footprintContains(events["footprint"][0], self.latitudes[3], self.longitudes[0]))
+        self.assertFalse(footprintContains(events["footprint"][0], self.latitudes[2], self.longitudes[2]))
+        self.assertTrue(footprintContains(events["footprint"][1], self.latitudes[4], self.longitudes[4]))
+
+    @unittest.skipIf(zarr is None, "zarr is not installed")
+    def test_convertToZarr(self):
+        with tempfile.TemporaryDirectory() as directory:
+            netcdfPath = os.path.join(directory, "test_2023.nc")
+            self.dataset.to_netcdf(netcdfPath)
+
+            zarrPath = convertToZarr(netcdfPath, timeChunk=2, spaceChunk=3)
+            self.assertEqual(zarrPath, os.path.join(directory, "test_2023.zarr"))
+
+            for processingMode in ["eager", "dask"]:
+                with openProcessingDataset(zarrPath, processingMode) as converted:
+                    np.testing.assert_array_equal(converted.valid_time.values, self.dataset.valid_time.values)
+                    np.testing.assert_array_equal(converted.test_var.values, self.dataset.test_var.values)
+            with openProcessingDataset(zarrPath, "eager") as converted:
+                self.assertEqual(tuple(converted.test_var.encoding["preferred_chunks"].values()), (2, 3, 3))
+
+
+class TestTopNAccumulator(unittest.TestCase):
+
+    def setUp(self):
+        times = np.arange(6).astype("datetime64[D]").astype("datetime64[ns]")
+        data = np.random.rand(len(times), 4, 5)
+        data[0, 0, 0] = np.nan
+        self.dataset = xr.Dataset(
+            {"test_var": (['valid_time', 'latitude', 'longitude'], data)},
+            coords={"valid_time": times, "latitude": np.linspace(-90, 90, 4), "longitude": np.linspace(0, 270, 5)}
+        )
+
+    def test_update_matches_update_top_n(self):
+        for highest in [True, False]:
+            accumulator = TopNAccumulator(self.dataset.latitude, self.dataset.longitude, "test_var", highest=highest, topN=3)
+            accumulator.update(self.dataset.isel(valid_time=slice(0, 3)))
+            accumulator.update(self.dataset.isel(valid_time=slice(3, 6)), timeChunkSize=2)
+
+            expected = update_top_n(self.dataset, "test_var", highest=highest, topN=3)
+            xr.testing.assert_identical(accumulator.toDataset(), expected)
+
+    def test_update_dask(self):
+        accumulator = TopNAccumulator(self.dataset.latitude, self.dataset.longitude, "test_var", topN=3)
+        accumulator.update(self.dataset.chunk({"valid_time": 2}))
+
+        expected = update_top_n(self.dataset, "test_var", topN=3)
+        xr.testing.assert_identical(accumulator.toDataset(), expected)
+
+    def test_checkpoint_and_load(self):
+        accumulator = TopNAccumulator(self.dataset.latitude, self.dataset.longitude, "test_var", topN=3)
+        accumulator.update(self.dataset.isel(valid_time=slice(0, 3)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            accumulator.checkpoint(directory)
+            accumulator.update(self.dataset.isel(valid_time=slice(3, 6)))
+            accumulator.progress = 6
+            accumulator.checkpoint(directory)
+
+            loaded = TopNAccumulator.load(directory)
+            xr.testing.assert_identical(loaded.toDataset(), accumulator.toDataset())
+            self.assertEqual(loaded.progress, 6)
+            del loaded
+
+    def test_fromDataset(self):
+        topN = update_top_n(self.dataset.isel(valid_time=slice(0, 4)), "test_var", topN=3)
+        accumulator = TopNAccumulator.fromDataset(topN, "test_var")
+        accumulator.update(self.dataset.isel(valid_time=slice(4, 6)))
+
+        expected = update_top_n(self.dataset, "test_var", topN=3)
+        xr.testing.assert_identical(accumulator.toDataset(), expected)
+
+    def test_mergeTopNAccumulators(self):
+        partials = []
+        for day in range(6):
+            partial = TopNAccumulator(self.dataset.latitude, self.dataset.longitude, "test_var", topN=3)
+            partial.update(self.dataset.isel(valid_time=slice(day, day + 1)))
+            partials.append(partial)
+
+        expected = update_top_n(self.dataset, "test_var", topN=3)
+        xr.testing.assert_identical(mergeTopNAccumulators(partials, maxWorkers=2).toDataset(), expected)
+        xr.testing.assert_identical(mergeTopNAccumulators(partials[::-1]).toDataset(), expected)
+
+    def test_combineTopNPartials(self):
+        with tempfile.TemporaryDirectory() as directory:
+            folder = directory + "/"
+            updateTopNPartial(folder, "test", 2000, self.dataset.isel(valid_time=slice(0, 2)), "test_var")
+            updateTopNPartial(folder, "test", 2001, self.dataset.isel(valid_time=slice(2, 4)), "test_var")
+            updateTopNPartial(folder, "test", 2002, self.dataset.isel(valid_time=slice(4, 6)), "test_var")
+
+            combined = combineTopNPartials(folder, "test").toDataset()
+            xr.testing.assert_identical(combined, update_top_n(self.dataset, "test_var"))
+
+            yearRange = combineTopNPartials(folder, "test", years=range(2001, 2003)).toDataset()
+            xr.testing.assert_identical(yearRange, update_top_n(self.dataset.isel(valid_time=slice(2, 6)), "test_var"))
+
+            with self.assertRaises(FileNotFoundError):
+                combineTopNPartials(folder, "test", years=[1999])
+
+    def test_exportTopNPartials_legacy(self):
+        legacyData = self.dataset.copy(deep=True)
+        legacyData["test_var"][1] = 100
+        legacyData["test_var"][2] = 50
+        legacyData = legacyData.assign_coords(valid_time=np.array(["2023-01-01", "2023-01-02", "2024-01-01",
+                                                                   "2024-01-02", "2024-01-03", "2024-01-04"],
+                                                                  dtype="datetime64[ns]"))
+        newData = legacyData.isel(valid_time=slice(2, 6)).copy(deep=True)
+        newData["test_var"][:] = np.random.rand(4, 4, 5) * 5
+
+        with tempfile.TemporaryDirectory() as directory:
+            folder = directory + "/"
+            # Written before the top N was kept per year
+            update_top_n(legacyData, "test_var", topN=10).to_netcdf(f"{folder}top10test.nc")
+            updateTopNPartial(folder, "test", 2024, newData, "test_var")
+
+            # 2023 is kept from the old file, 2024 is replaced by its partial
+            expected = update_top_n(xr.concat([legacyData.isel(valid_time=slice(0, 2)), newData], "valid_time"),
+                                    "test_var", topN=10)
+            for _ in range(2):
+                self.assertEqual(exportTopNPartials(folder), ["test"])
+                with xr.open_dataset(f"{folder}top10test.nc") as exported:
+                    self.assertEqual(float(exported["top_test_var"].max()), 100.0)
+                    xr.testing.assert_equal(exported, expected)
+
+            # A removed year is left out until it is processed again
+            removeTopNPartial(folder, "test", 2023)
+            exportTopNPartials(folder)
+            with xr.open_dataset(f"{folder}top10test.nc") as exported:
+                xr.testing.assert_equal(exported, update_top_n(newData, "test_var", topN=10))
+
+
+def busyLoop(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedSink(DatabaseSink):
+    """
+    Stops processing like a killed process: after the given number of event inserts, or before the given number of
+    chunk progress updates.
+    """
+
+    def __init__(self, resultDatabase, processingDatabase, method, calls):
+        super().__init__(resultDatabase, processingDatabase)
+        self.method = method
+        self.calls = calls
+
+    def countCall(self, method):
+        if method == self.method:
+            self.calls -= 1
+            if self.calls == 0:
+                raise Interrupted()
+
+    def insertEvents(self, eventType, events):
+        super().insertEvents(eventType, events)
+        self.countCall("insertEvents")
+
+    def updateChunkProgress(self, year, var, nextTimeIndex):
+        self.countCall("updateChunkProgress")
+        super().updateChunkProgress(year, var, nextTimeIndex)
+
+
+class TestFilePipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.folder = self.directory.name + "/"
+        times = np.arange("2000-01-01", "2000-01-11", dtype="datetime64[h]").astype("datetime64[ns]")
+        shape = (times.size, 6, 7)
+        # Whole numbers, so many windspeeds are equal and the top N has ties
+        self.dataset = xr.Dataset(
+            {name: (["valid_time", "latitude", "longitude"], np.round(np.random.gamma(2, 6, shape)))
+             for name in ["u10", "v10", "i10fg"]},
+            coords={"valid_time": times, "latitude": np.linspace(60, 50, 6), "longitude": np.linspace(0, 12, 7)})
+        self.path = f"{self.folder}wind_2000.nc"
+        self.dataset.to_netcdf(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def createRunFolder(self, name):
+        runFolder = f"{self.folder}{name}/"
+        os.makedirs(runFolder, exist_ok=True)
+        createChunkProgressTable(f"{runFolder}processing.db")
+        createResultDatabase(f"{runFolder}results.db")
+        createSpatioTemporalTable(f"{runFolder}results.db")
+        return runFolder
+
+    def process(self, name, pipeline = windPipeline, path = None, sink = None, **kwargs):
+        """
+        Processes the file into the databases and top N partials of the run folder, which is created if needed.
+        :param sink: The result sink. Default: a DatabaseSink writing to the databases of the run folder
+        :return: The run folder
+        """
+        runFolder = self.createRunFolder(name)
+        if sink is None:
+            sink = DatabaseSink(f"{runFolder}results.db", f"{runFolder}processing.db")
+        with useResultSink(sink):
+            pipeline.process(self.path if path is None else path, resultFolder=runFolder,
+                             processingDatabase=f"{runFolder}processing.db", **kwargs)
+        return runFolder
+
+    def processWholeFile(self, name, dataset, variable, eventType):
+        """
+        Stores the events of a variable as the processors did before the pipeline, from the whole dataset at once.
+        :return: The run folder
+        """
+        runFolder = self.createRunFolder(name)
+        with useResultSink(DatabaseSink(f"{runFolder}results.db", f"{runFolder}processing.db")):
+            processThresholdEvents(dataset, variable, EVENT_THRESHOLDS[eventType], eventType, "both")
+        return runFolder
+
+    def events(self, runFolder, tableName = "thresholdResults"):
+        connection = sqlite3.connect(f"{runFolder}results.db")
+        # Without the ids, which depend on the order of the inserts
+        rows = sorted(row[1:] for row in connection.execute(f"SELECT * FROM {tableName}"))
+        connection.close()
+        return rows
+
+    def test_process_matchesWholeFile(self):
+        run = self.process("pipeline", labelingMode="both", chunkDays=4, processingMode="eager")
+
+        with xr.open_dataset(self.path) as dataset:
+            dataset["windspeed"] = np.sqrt(dataset["u10"]**2 + dataset["v10"]**2)
+            expected = self.processWholeFile("wholeFile", dataset, "windspeed", "windspeedDaily")
+            expectedTopN = update_top_n(dataset, "windspeed")
+
+        self.assertGreater(len(self.events(expected)), 0)
+        self.assertEqual(self.events(run), self.events(expected))
+        self.assertEqual(self.events(run, SPATIOTEMPORAL_TABLENAME), self.events(expected, SPATIOTEMPORAL_TABLENAME))
+        xr.testing.assert_identical(combineTopNPartials(run, "wind").toDataset(), expectedTopN)
+
+    def test_process_readsOncePerChunk(self):
+        with recordFileMetrics(2000, "wind", enabled=True) as metrics:
+            self.process("pipeline", labelingMode="both", chunkDays=4, processingMode="eager")
+
+        # Three chunks of u10 and v10, the windspeed is derived once per chunk for the top N and the events
+        self.assertEqual(metrics.stages["read"]["calls"], 6)
+        self.assertEqual(metrics.stages["derive"]["calls"], 3)
+
+    def test_process_windgust(self):
+        path = f"{self.folder}windgust_2000.nc"
+        self.dataset[["i10fg"]].to_netcdf(path)
+        run = self.process("windgust", pipeline=windgustPipeline, path=path, labelingMode="slice", chunkDays=3,
+                           processingMode="eager")
+
+        with xr.open_dataset(path) as dataset:
+            expectedTopN = update_top_n(dataset, "i10fg")
+        xr.testing.assert_identical(combineTopNPartials(run, "windgustHourly").toDataset(), expectedTopN)
+        self.assertEqual(exportTopNPartials(run), ["windgustHourly"])
+        self.assertTrue(os.path.exists(f"{run}top10windgustHourly.nc"))
+
+    def test_process_spatioTemporalWholeYear(self):
+        # Events across time and space span the one day chunks, they are labeled on the whole year after the last one
+        run = self.process("pipeline", labelingMode="spatiotemporal", chunkDays=1, processingMode="eager")
+
+        with xr.open_dataset(self.path) as dataset:
+            dataset["windspeed"] = np.sqrt(dataset["u10"]**2 + dataset["v10"]**2)
+            expected = self.processWholeFile("wholeFile", dataset, "windspeed", "windspeedDaily")
+
+        spatioTemporalEvents = self.events(run, SPATIOTEMPORAL_TABLENAME)
+        days = lambda seconds: seconds // 86400
+        self.assertTrue(any(days(startTime) != days(endTime) for _, startTime, endTime, *_ in spatioTemporalEvents))
+        self.assertEqual(spatioTemporalEvents, self.events(expected, SPATIOTEMPORAL_TABLENAME))
+        self.assertEqual(self.events(run), [])
+
+    def test_process_resume(self):
+        complete = self.process("complete", labelingMode="both", chunkDays=2, processingMode="eager")
+        chunkStarts = epochSeconds(self.dataset.valid_time.values[::48])
+
+        # Killed after the events of the third chunk were inserted, and while committing the third chunk after its
+        # top N checkpoint was written. The first update of the chunk progress is the start of the file.
+        for name, method, calls in [("afterInsert", "insertEvents", 3), ("inCommit", "updateChunkProgress", 4)]:
+            runFolder = self.createRunFolder(name)
+            sink = InterruptedSink(f"{runFolder}results.db", f"{runFolder}processing.db", method, calls)
+            with self.assertRaises(Interrupted):
+                self.process(name, sink=sink, labelingMode="both", chunkDays=2, processingMode="eager")
+            # The interrupted run stored some events of the third chunk
+            self.assertTrue(any(row[1] >= chunkStarts[2] for row in self.events(runFolder)))
+
+            self.process(name, labelingMode="both", chunkDays=2, processingMode="eager")
+            self.assertEqual(self.events(runFolder), self.events(complete))
+            self.assertEqual(self.events(runFolder, SPATIOTEMPORAL_TABLENAME),
+                             self.events(complete, SPATIOTEMPORAL_TABLENAME))
+            xr.testing.assert_identical(combineTopNPartials(runFolder, "wind").toDataset(),
+                                        combineTopNPartials(complete, "wind").toDataset())
+
+    def test_process_dask(self):
+        eager = self.process("eager", labelingMode="both", chunkDays=4, processingMode="eager")
+        dask = self.process("dask", labelingMode="both", chunkDays=4, processingMode="dask")
+
+        self.assertGreater(len(self.events(eager)), 0)
+        self.assertEqual(self.events(dask), self.events(eager))
+        self.assertEqual(self.events(dask, SPATIOTEMPORAL_TABLENAME), self.events(eager, SPATIOTEMPORAL_TABLENAME))
+        xr.testing.assert_identical(combineTopNPartials(dask, "wind").toDataset(),
+                                    combineTopNPartials(eager, "wind").toDataset())
+
+
+class TestMemoryScheduler(unittest.TestCase):
+
+    def test_largestChunkDays(self):
+        estimate = JobEstimate(100, 10)
+        self.assertEqual(estimate.largestChunkDays(1000, maxChunkDays=7), 7)
+        self.assertEqual(estimate.largestChunkDays(155, maxChunkDays=7), 5)
+        self.assertIsNone(estimate.largestChunkDays(105, maxChunkDays=7))
+        self.assertEqual(JobEstimate(100, 0).largestChunkDays(100, maxChunkDays=7), 7)
+        self.assertIsNone(JobEstimate(100, 0).largestChunkDays(99, maxChunkDays=7))
+
+    def test_memoryBudget(self):
+        budget = MemoryBudget(1000)
+        estimate = JobEstimate(200, 50)
+        self.assertEqual(budget.fit(estimate, maxChunkDays=7), 7)
+        budget.reserve("2023:wind", estimate, 7)
+        self.assertEqual(budget.available(), 450)
+
+        # The second job only fits with shorter chunks, the third not at all
+        self.assertEqual(budget.fit(estimate, maxChunkDays=7), 5)
+        budget.reserve("2022:wind", estimate, 5)
+        self.assertIsNone(budget.fit(estimate, maxChunkDays=7))
+        # Jobs without an estimate always run
+        self.assertEqual(budget.fit(None, maxChunkDays=7), 7)
+
+        budget.release("2023:wind")
+        self.assertEqual(budget.fit(estimate, maxChunkDays=7), 7)
+
+        # A job that needs more than the whole budget never fits
+        self.assertIsNone(MemoryBudget(1000).fit(JobEstimate(990, 20), maxChunkDays=7))
+
+    def test_estimateJob(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "wind_2000.nc")
+            times = np.arange("2000-01-01", "2000-01-03", dtype="datetime64[h]").astype("datetime64[ns]")
+            xr.Dataset({name: (["valid_time", "latitude", "longitude"], np.zeros((48, 6, 7), dtype="float32"))
+                        for name in ["u10", "v10", "i10fg"]},
+                       coords={"valid_time": times, "latitude": np.arange(6.0), "longitude": np.arange(7.0)}
+                       ).to_netcdf(path)
+
+            sliceEstimate = estimateJob(path, windPipeline, "slice", pastSeconds=30.0)
+            spatioTemporalEstimate = estimateJob(path, windPipeline, "spatiotemporal")
+
+        # u10, v10 and the windspeed per timestep of a chunk, the gusts aren't used
+        self.assertEqual(sliceEstimate.bytesPerChunkDay, (3 * 4 + LABELING_BYTES) * 24 * 42)
+        self.assertEqual(spatioTemporalEstimate.bytesPerChunkDay, 3 * 4 * 24 * 42)
+        # Labeling across time and space holds the windspeed of the whole file
+        self.assertEqual(spatioTemporalEstimate.fixedBytes - sliceEstimate.fixedBytes,
+                         (4 + VOLUME_LABELING_BYTES) * 48 * 42)
+        self.assertEqual(sliceEstimate.seconds, 30.0)
+        self.assertEqual(sliceEstimate.memory(3), sliceEstimate.fixedBytes + 3 * sliceEstimate.bytesPerChunkDay)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def test_shouldProfile(self):
+        self.assertTrue(shouldProfile("2021:wind", jobs=["*:wind"]))
+        self.assertTrue(shouldProfile("2021:wind", jobs=["2020:wind", " 2021:wind"]))
+        self.assertFalse(shouldProfile("2021:windgust", jobs=["*:wind"], sampleFraction=0))
+        self.assertTrue(shouldProfile("2021:windgust", jobs=[], sampleFraction=1))
+
+    def test_writeFolded(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        busyLoop(0.2)
+        profiler.stop()
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "profile.folded")
+            profiler.writeFolded(path)
+            with open(path) as file:
+                lines = file.read().splitlines()
+
+        stacks = [line.rsplit(" ", 1) for line in lines]
+        self.assertTrue(all(count.isdigit() for _, count in stacks))
+        busySamples = sum(int(count) for stack, count in stacks if stack.split(";")[-1].startswith("busyLoop"))
+        self.assertGreater(busySamples, 0)
+        self.assertTrue(all("test_writeFolded" in stack for stack, _ in stacks))
+
+
+class TestInputPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.netcdfPath = os.path.join(self.directory.name, "wind_2023.nc")
+        with open(self.netcdfPath, "wb") as file:
+            file.write(b"x" * 1000)
+        self.zarrPath = os.path.join(self.directory.name, "wind_2024.zarr")
+        os.makedirs(os.path.join(self.zarrPath, "u10"))
+        for name in ["zarr.json", "u10/c0", "u10/c1"]:
+            with open(os.path.join(self.zarrPath, name), "wb") as file:
+                file.write(b"y" * 100)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_readAhead(self):
+        prefetch = Prefetch(self.netcdfPath, maxBytes=10)
+        prefetch.start()
+        prefetch.thread.join()
+        self.assertTrue(prefetch.complete)
+        # Whole blocks are read until maxBytes is reached
+        self.assertEqual(prefetch.bytesRead, 1000)
+
+        with InputPrefetcher("cache", memoryBytes=10) as prefetcher:
+            prefetcher.start("2023:wind", self.netcdfPath)
+            self.assertEqual(prefetcher.inputPath("2023:wind", self.netcdfPath), self.netcdfPath)
+            self.assertEqual(prefetcher.prefetches, {})
+
+    def test_scratchCopies(self):
+        scratchFolder = os.path.join(self.directory.name, "scratch")
+        with InputPrefetcher("scratch", diskBytes=1300, scratchFolder=scratchFolder) as prefetcher:
+            prefetcher.start("2023:wind", self.netcdfPath)
+            prefetcher.start("2024:wind", self.zarrPath)
+            for prefetch, _ in prefetcher.prefetches.values():
+                prefetch.thread.join()
+
+            netcdfCopy = prefetcher.inputPath("2023:wind", self.netcdfPath)
+            zarrCopy = prefetcher.inputPath("2024:wind", self.zarrPath)
+            self.assertEqual(os.path.basename(netcdfCopy), "wind_2023.nc")
+            self.assertTrue(netcdfCopy.startswith(scratchFolder))
+            with open(os.path.join(zarrCopy, "u10", "c1"), "rb") as file:
+                self.assertEqual(file.read(), b"y" * 100)
+
+            # Only 1300 bytes of copies are allowed
+            prefetcher.start("2022:wind", self.netcdfPath)
+            self.assertNotIn("2022:wind", prefetcher.prefetches)
+
+            prefetcher.release("2023:wind")
+            self.assertFalse(os.path.exists(netcdfCopy))
+        self.assertFalse(os.path.exists(zarrCopy))
+        self.assertEqual(os.listdir(scratchFolder), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -92,7 +92,7 @@ class TestQueryFunctions(unittest.TestCase):
         mock_connect.return_value = mock_conn
         mock_conn.cursor.return_value = mock_cursor
         mock_cursor.execute.return_value = mock_records
-        mock_records.fetchall.return_value = [(1, "wind", "2024-01-01", 40, -40, -73, -73, 40, -73, 10, 10, 1)]
+        mock_records.fetchall.return_value = [(1, "wind", 1704067200, 40, -40, -73, -73, 40, -73, 10, 10, 1, 20.8)]
 
         df = getAllRecordsForCity("New York")
         self.assertFalse(df.empty)
@@ -0,0 +1,148 @@
+import os
+import queue
+import sqlite3
+import tempfile
+import unittest
+from concurrent.futures import Future
+
+import numpy as np
+
+import sys
+from pathlib import Path
+# The processing modules import each other as scripts, like processor.py run from src/processing
+sys.path.append(str(Path(__file__).parent.parent / "src" / "processing"))
+from databaseFunctions import createProcessingDatabase, createResultDatabase, getChunkProgress
+from resultSink import DatabaseSink, QueueSink, coordinateWrites, ResultWriter
+from eventStore import EventStore, pa
+from src.querying.queryFunctions import getEvents
+from src.utils.footprints import encodeFootprints
+
+
+class TestResultSink(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Creates the processing database of one input file and an empty result database in a temporary directory.
+        """
+        self.directory = tempfile.TemporaryDirectory()
+        self.testDirectory = self.directory.name + "/"
+        self.testProcessingDatabase = os.path.join(self.testDirectory, "testProcessing.db")
+        self.testResultDatabase = os.path.join(self.testDirectory, "testResult.db")
+
+        with open(os.path.join(self.testDirectory, "var_2023.nc"), "w") as f:
+            f.write("test file")
+        createProcessingDatabase(self.testDirectory, self.testProcessingDatabase)
+        createResultDatabase(self.testResultDatabase)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def query(self, database, sql):
+        connection = sqlite3.connect(database)
+        rows = connection.execute(sql).fetchall()
+        connection.close()
+        return rows
+
+    def status(self, year = 2023):
+        return self.query(self.testProcessingDatabase, f"SELECT status FROM processing WHERE year = {year}")[0][0]
+
+    def test_coordinateWrites(self):
+        writeQueue = queue.Queue()
+        workerSink = QueueSink(writeQueue)
+        workerSink.updateStatus(2023, "var", "processing")
+        workerSink.insertEvents("wind", [{"eventTime": "2024-01-01", "areaInCells": 3}])
+        workerSink.updateStatus(2023, "var", "processed")
+        workerSink.taskDone("2023:var")
+
+        finished, died = Future(), Future()
+        finished.set_result(None)
+        died.set_exception(RuntimeError("worker killed"))
+
+        doneTasks, diedTasks = coordinateWrites(writeQueue,
+                                                DatabaseSink(self.testResultDatabase, self.testProcessingDatabase),
+                                                {"2023:var": finished, "2022:var": died}, pollSeconds=0.01)
+
+        self.assertEqual(doneTasks, {"2023:var"})
+        self.assertEqual(diedTasks, {"2022:var"})
+        self.assertEqual(self.query(self.testResultDatabase, "SELECT eventType, eventArea FROM thresholdResults"),
+                         [("wind", 3)])
+        self.assertEqual(self.status(), "processed")
+
+    def test_resultWriter(self):
+        with ResultWriter(self.testResultDatabase, self.testProcessingDatabase, queueSize=2, batchRows=2,
+                          batchSeconds=60) as writer:
+            writer.insertEvents("wind", {"eventTime": np.array(["2023-01-01", "2023-01-02"]),
+                                         "areaInCells": np.array([3, 4]),
+                                         "footprint": encodeFootprints(np.arange(2), np.zeros(2), np.zeros(2),
+                                                                       np.ones(2), 2, np.array([50.0]),
+                                                                       np.array([0.0]))})
+            writer.updateChunkProgress(2023, "var", 48)
+            writer.insertEvents("wind", [{"eventTime": "2023-01-03", "areaInCells": 5}])
+            writer.deleteEvents(["wind"], "2023-01-02", "2023-01-02")
+            writer.updateStatus(2023, "var", "processed")
+            writer.flush()
+
+            self.assertEqual(getChunkProgress(self.testProcessingDatabase, 2023, "var"), 48)
+            self.assertEqual(self.query(self.testResultDatabase, "SELECT eventTime, eventArea FROM thresholdResults"),
+                             [(1672531200, 3), (1672704000, 5)])
+            self.assertEqual(self.query(self.testResultDatabase, "SELECT eventId FROM eventFootprints"), [(1,)])
+            self.assertEqual(self.query(self.testResultDatabase, "PRAGMA journal_mode"), [("wal",)])
+
+        self.assertEqual(writer.rows, 3)
+        self.assertEqual(self.status(), "processed")
+
+    def test_resultWriterFailure(self):
+        writer = ResultWriter(self.testResultDatabase, self.testProcessingDatabase)
+        writer.start()
+        writer.insertEvents("wind", [{"eventTime": "2023-01-01", "areaInCells": 3}])
+        # Status updates are applied with the events before them, so they are lost with them
+        writer.updateStatus(2023, "var", "processed")
+        writer.insertSpatioTemporalEvents("wind", {"startTime": np.array(["2023-01-01"])})
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+        with self.assertRaises(RuntimeError):
+            writer.insertEvents("wind", [{"eventTime": "2023-01-02", "areaInCells": 3}])
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+        self.assertEqual(self.query(self.testResultDatabase, "SELECT count(*) FROM thresholdResults"), [(0,)])
+        self.assertEqual(self.status(), "unprocessed")
+
+    @unittest.skipIf(pa is None, "pyarrow is not installed")
+    def test_eventStore(self):
+        folder = os.path.join(self.testDirectory, "events")
+
+        def events(times, values):
+            return {"eventTime": np.array(times, dtype="datetime64[ns]").astype(str),
+                    "minLatitude": np.zeros(len(times)), "maxLatitude": np.zeros(len(times)),
+                    "minLongitude": np.zeros(len(times)), "maxLongitude": np.zeros(len(times)),
+                    "maxEventValue": np.array(values), "areaInCells": np.ones(len(times), dtype=int)}
+
+        writer = ResultWriter(self.testResultDatabase, self.testProcessingDatabase, eventStore=EventStore(folder))
+        with writer:
+            writer.insertEvents("rainDaily", events(["2010-12-31", "2011-01-01", "2011-01-02"], [0.2, 0.4, 0.5]))
+            writer.insertEvents("windgustHourly", events(["2011-01-01T05"], [30.0]))
+            # The events are only written out with the progress of their file
+            writer.flush()
+            self.assertFalse(os.path.exists(folder))
+            writer.updateChunkProgress(2023, "var", 10)
+            writer.flush()
+            self.assertEqual(len(getEvents(eventStoreFolder=folder)), 4)
+
+            # Events of an interrupted file are deleted from the files, also of other writers
+            writer.deleteEvents(["rainDaily"], "2011-01-02T00:00:00.000000000", "2011-12-31T23:00:00.000000000")
+            writer.insertEvents("rainDaily", events(["2011-01-02"], [0.6]))
+
+        self.assertEqual(sorted(os.listdir(os.path.join(folder, "eventType=rainDaily"))), ["year=2010", "year=2011"])
+        self.assertEqual(len(os.listdir(os.path.join(folder, "eventType=rainDaily", "year=2011"))), 2)
+
+        df = getEvents(["rainDaily"], 2011, 2015, columns=["eventTime", "maxEventValue"], eventStoreFolder=folder,
+                       filters=[("maxEventValue", ">", 0.3)])
+        self.assertEqual(list(df.columns), ["eventTime", "maxEventValue"])
+        self.assertEqual(sorted(df["maxEventValue"]), [0.4, 0.6])
+        self.assertEqual(str(df["eventTime"].min()), "2011-01-01 00:00:00")
+        self.assertEqual(getEvents(["windgustHourly"], eventStoreFolder=folder)["eventArea"].tolist(), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()